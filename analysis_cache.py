@@ -0,0 +1,180 @@
+# --- Файл: analysis_cache.py ---
+
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+from typing import Optional, Dict, List, Any, Iterable
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Имя файла кэша в каталоге кэша приложения
+ANALYSIS_CACHE_FILENAME = "analysis_cache.sqlite"
+# Версия формата записей. При несовместимых изменениях старые записи просто перестают находиться.
+ANALYSIS_CACHE_VERSION = 1
+# Верхняя граница числа записей; при превышении удаляются давно не использованные
+ANALYSIS_CACHE_MAX_ENTRIES = 500000
+
+CACHE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS cache_entries (
+    key TEXT PRIMARY KEY,      -- sha256 от (вид записи + составные части ключа)
+    kind TEXT NOT NULL,        -- 'summary', 'structure', 'chunks', 'embeddings'
+    value BLOB NOT NULL,       -- JSON (utf-8) или сырые float32 для эмбеддингов
+    last_used_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_cache_last_used ON cache_entries (last_used_at);
+"""
+
+
+def content_hash(text: str) -> str:
+    """Возвращает sha256 содержимого файла (ключевая часть всех записей кэша)."""
+    return hashlib.sha256(text.encode("utf-8", errors="ignore")).hexdigest()
+
+
+class AnalysisCache:
+    """
+    Постоянный (между сессиями) кэш результатов анализа файлов: саммари, структура,
+    чанки и эмбеддинги. Записи адресуются хэшем содержимого файла и параметрами,
+    от которых зависит результат (модель, шаблон промпта, параметры разбиения).
+    Потокобезопасен: используется одновременно из нескольких потоков анализа.
+    Чтение не пишет в файл: время использования найденных записей копится в памяти
+    и записывается одной транзакцией в flush_usage() (в конце анализа и при закрытии).
+    """
+
+    def __init__(self, filepath: str):
+        self.filepath = filepath
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+        self.hits = 0
+        self.misses = 0
+        self._touched: Dict[str, float] = {} # key -> время последнего попадания, еще не записанное в файл
+        self._open()
+
+    def _open(self):
+        try:
+            dir_name = os.path.dirname(self.filepath)
+            if dir_name:
+                os.makedirs(dir_name, exist_ok=True)
+            self._conn = sqlite3.connect(self.filepath, timeout=10, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL;")
+            self._conn.execute("PRAGMA synchronous=NORMAL;")
+            self._conn.executescript(CACHE_SCHEMA)
+            self._prune()
+            logger.info(f"Кэш анализа открыт: {self.filepath}")
+        except (sqlite3.Error, OSError) as e:
+            logger.error(f"Не удалось открыть кэш анализа '{self.filepath}': {e}. Кэширование отключено.")
+            self._conn = None
+
+    def is_available(self) -> bool:
+        return self._conn is not None
+
+    def close(self):
+        self.flush_usage()
+        with self._lock:
+            if self._conn:
+                self._conn.close()
+                self._conn = None
+
+    def flush_usage(self):
+        """Записывает накопленное время использования записей (last_used_at) одной транзакцией."""
+        with self._lock:
+            if not self._conn or not self._touched: return
+            touched, self._touched = self._touched, {}
+            try:
+                self._conn.executemany(
+                    "UPDATE cache_entries SET last_used_at = ? WHERE key = ?",
+                    [(used_at, key) for key, used_at in touched.items()]
+                )
+                self._conn.commit()
+            except sqlite3.Error as e:
+                logger.warning(f"Не удалось записать время использования записей кэша анализа: {e}")
+
+    def reset_stats(self):
+        with self._lock:
+            self.hits = 0
+            self.misses = 0
+
+    def get_stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses}
+
+    @staticmethod
+    def make_key(kind: str, parts: Iterable[Any]) -> str:
+        raw = "\x1f".join([f"v{ANALYSIS_CACHE_VERSION}", kind] + [str(p) for p in parts])
+        return hashlib.sha256(raw.encode("utf-8", errors="ignore")).hexdigest()
+
+    # --- Низкоуровневый доступ ---
+    def _get_raw(self, key: str) -> Optional[bytes]:
+        if not self._conn: return None
+        with self._lock:
+            try:
+                row = self._conn.execute("SELECT value FROM cache_entries WHERE key = ?", (key,)).fetchone()
+                if row is None:
+                    self.misses += 1
+                    return None
+                self.hits += 1
+                self._touched[key] = time.time()
+                return row[0]
+            except sqlite3.Error as e:
+                logger.warning(f"Ошибка чтения кэша анализа: {e}")
+                return None
+
+    def _put_raw(self, key: str, kind: str, value: bytes):
+        if not self._conn: return
+        with self._lock:
+            try:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO cache_entries (key, kind, value, last_used_at) VALUES (?, ?, ?, ?)",
+                    (key, kind, value, time.time())
+                )
+                self._conn.commit()
+            except sqlite3.Error as e:
+                logger.warning(f"Ошибка записи в кэш анализа: {e}")
+
+    def _prune(self):
+        """Удаляет самые старые записи, если кэш разросся сверх ANALYSIS_CACHE_MAX_ENTRIES."""
+        count = self._conn.execute("SELECT COUNT(*) FROM cache_entries").fetchone()[0]
+        excess = count - ANALYSIS_CACHE_MAX_ENTRIES
+        if excess > 0:
+            self._conn.execute(
+                "DELETE FROM cache_entries WHERE key IN (SELECT key FROM cache_entries ORDER BY last_used_at ASC LIMIT ?)",
+                (excess,)
+            )
+            self._conn.commit()
+            logger.info(f"Кэш анализа: удалено {excess} устаревших записей.")
+
+    # --- Типизированный доступ ---
+    def get_json(self, kind: str, key: str) -> Optional[Any]:
+        raw = self._get_raw(key)
+        if raw is None: return None
+        try:
+            return json.loads(raw.decode("utf-8") if isinstance(raw, bytes) else raw)
+        except (ValueError, UnicodeDecodeError):
+            return None
+
+    def put_json(self, kind: str, key: str, value: Any):
+        self._put_raw(key, kind, json.dumps(value, ensure_ascii=False).encode("utf-8"))
+
+    def get_embeddings(self, key: str) -> Optional[List[np.ndarray]]:
+        """Возвращает список векторов (по одному на чанк) или None."""
+        raw = self._get_raw(key)
+        if raw is None: return None
+        try:
+            header_len = int.from_bytes(raw[:8], "little")
+            header = json.loads(raw[8:8 + header_len].decode("utf-8"))
+            matrix = np.frombuffer(raw, dtype=np.float32, offset=8 + header_len).reshape(header["count"], header["dim"])
+            return [row.astype(np.float64) for row in matrix]
+        except Exception as e:
+            logger.warning(f"Поврежденная запись эмбеддингов в кэше анализа: {e}")
+            return None
+
+    def put_embeddings(self, key: str, embeddings: List[np.ndarray]):
+        if not embeddings or any(e is None for e in embeddings): return
+        matrix = np.asarray(np.vstack(embeddings), dtype=np.float32)
+        header = json.dumps({"count": matrix.shape[0], "dim": matrix.shape[1]}).encode("utf-8")
+        self._put_raw(key, "embeddings", len(header).to_bytes(8, "little") + header + matrix.tobytes())
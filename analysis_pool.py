@@ -0,0 +1,123 @@
+# --- Файл: analysis_pool.py ---
+
+import os
+import logging
+import multiprocessing
+from io import BytesIO
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Optional, List, Any, Tuple
+
+from code_splitter import TreeSitterSplitter, RecursiveCharacterSplitter, DEFAULT_CHUNK_TOKENS
+from ast_parser import ASTParser
+
+logger = logging.getLogger(__name__)
+
+# Пул процессов для CPU-этапов анализа (разбор Tree-sitter, разбиение на чанки,
+# извлечение текста из PDF/DOCX). 0 - все выполняется в потоках SummarizerWorker.
+DEFAULT_ANALYSIS_PROCESSES = 0
+MAX_ANALYSIS_PROCESSES = max(1, min(16, os.cpu_count() or 1))
+
+try:
+    import docx
+except ImportError:
+    docx = None
+    logging.warning("Библиотека 'python-docx' не найдена. DOCX файлы будут проигнорированы.")
+try:
+    from PyPDF2 import PdfReader
+except ImportError:
+    PdfReader = None
+    logging.warning("Библиотека 'PyPDF2' не найдена. PDF файлы будут проигнорированы.")
+
+
+class EncryptedDocumentError(Exception):
+    """Документ зашифрован, текст из него не извлечь."""
+
+
+def is_document_supported(file_ext: str) -> bool:
+    """Установлена ли библиотека для извлечения текста из документа с расширением file_ext (.docx, .pdf)."""
+    return (docx is not None) if file_ext == '.docx' else (PdfReader is not None)
+
+
+def extract_document_text(file_ext: str, content_bytes: bytes) -> str:
+    """Текст документа DOCX или PDF. Для зашифрованного PDF - EncryptedDocumentError."""
+    if file_ext == '.docx':
+        doc = docx.Document(BytesIO(content_bytes))
+        return '\n'.join([p.text for p in doc.paragraphs])
+    reader = PdfReader(BytesIO(content_bytes))
+    if reader.is_encrypted: raise EncryptedDocumentError()
+    return '\n'.join([p.extract_text() or "" for p in reader.pages])
+
+
+def prepare_source(content: str, language: Optional[str], need_structure: bool, need_chunks: bool,
+                   ast_parser: Optional[ASTParser], ts_splitter: Optional[TreeSitterSplitter],
+                   fallback_splitter: RecursiveCharacterSplitter) -> Tuple[Optional[Dict[str, Any]], Optional[List[str]]]:
+    """
+    Структура кода и чанки файла за один разбор (см. ast_parser.ParsedSource).
+    Возвращает (структура или None, чанки или None) - только то, что запрошено.
+    Парсеры Tree-sitter не потокобезопасны: вызывающий отвечает за блокировку.
+    """
+    use_tree_sitter = bool(ts_splitter and language and ts_splitter.is_language_supported(language))
+    parsed = None
+    if use_tree_sitter:
+        parsed = ts_splitter.parse(content, language)
+    elif language and ast_parser:
+        parsed = ast_parser.parse(content, language)
+
+    structure = ast_parser.parse_code_structure(content, language, parsed) if need_structure and ast_parser else None
+    chunks = None
+    if need_chunks:
+        chunks = ts_splitter.split_text(content, language, parsed) if use_tree_sitter else fallback_splitter.split_text(content)
+    return structure, chunks
+
+
+# --- Процессы пула ---
+# Грамматики загружаются один раз на процесс (в _init_process), а не на каждый файл.
+_process_tools: Optional[Tuple[Optional[ASTParser], Optional[TreeSitterSplitter], RecursiveCharacterSplitter]] = None
+
+
+def _init_process(grammar_library_path: Optional[str], chunk_tokens: int, chunk_size: int, chunk_overlap: int):
+    global _process_tools
+    ast_parser, ts_splitter = None, None
+    if grammar_library_path:
+        try:
+            ast_parser = ASTParser(grammar_library_path)
+            ts_splitter = TreeSitterSplitter(grammar_library_path, chunk_tokens=chunk_tokens)
+        except Exception as e:
+            logger.error(f"Процесс анализа {os.getpid()}: не удалось загрузить грамматики: {e}")
+    _process_tools = (ast_parser, ts_splitter, RecursiveCharacterSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap))
+
+
+def _prepare_source_in_process(content: str, language: Optional[str], need_structure: bool, need_chunks: bool):
+    return prepare_source(content, language, need_structure, need_chunks, *_process_tools)
+
+
+class AnalysisProcessPool:
+    """
+    Пул процессов для CPU-этапов анализа. Потоки SummarizerWorker читают файлы и ходят в API,
+    а разбор, разбиение на чанки и извлечение текста документов отправляют сюда, поэтому
+    они идут параллельно на нескольких ядрах, не упираясь в GIL. Обратно возвращаются только
+    компактные результаты: текст, словарь структуры, список чанков.
+    Методы можно вызывать из нескольких потоков одновременно; каждый ждет свой результат.
+    """
+
+    def __init__(self, processes: int, grammar_library_path: Optional[str], fallback_splitter: RecursiveCharacterSplitter,
+                 chunk_tokens: int = DEFAULT_CHUNK_TOKENS):
+        # spawn, а не fork: в процессе уже работают потоки Qt
+        self._executor = ProcessPoolExecutor(
+            max_workers=max(1, min(int(processes), MAX_ANALYSIS_PROCESSES)),
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_process,
+            initargs=(grammar_library_path, chunk_tokens, fallback_splitter.chunk_size, fallback_splitter.chunk_overlap)
+        )
+
+    def prepare_source(self, content: str, language: Optional[str], need_structure: bool,
+                       need_chunks: bool) -> Tuple[Optional[Dict[str, Any]], Optional[List[str]]]:
+        """См. prepare_source() - то же самое в процессе пула."""
+        return self._executor.submit(_prepare_source_in_process, content, language, need_structure, need_chunks).result()
+
+    def extract_document_text(self, file_ext: str, content_bytes: bytes) -> str:
+        """См. extract_document_text() - то же самое в процессе пула."""
+        return self._executor.submit(extract_document_text, file_ext, content_bytes).result()
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True, cancel_futures=True)
@@ -2,7 +2,7 @@
 
 import os
 import logging
-from typing import Dict, Any, Optional, List
+from typing import Dict, Any, Optional, List, Tuple
 
 from tree_sitter import Language, Parser
 
@@ -18,6 +18,10 @@ LANGUAGE_MAP: Dict[str, str] = {
     # Добавьте другие языки по мере необходимости
 }
 
+# Версия извлечения структуры кода (parse_code_structure). Входит в ключ кэша анализа (analysis_cache.py)
+# вместе с хэшем запроса языка из LANGUAGE_QUERIES: увеличьте ее при изменении обработки результатов запроса.
+STRUCTURE_VERSION = 1
+
 # Запросы Tree-sitter для извлечения структуры кода для каждого языка.
 # Это "сердце" нашего парсера.
 LANGUAGE_QUERIES: Dict[str, str] = {
@@ -45,6 +49,62 @@ LANGUAGE_QUERIES: Dict[str, str] = {
 }
 
 
+class QueryCache:
+    """
+    Скомпилированные запросы Tree-sitter: S-выражение компилируется один раз на язык
+    при первом обращении, а не для каждого файла. Запрос, который не удалось скомпилировать
+    (например, в грамматике нет такого типа узла), тоже запоминается - как None.
+    """
+
+    def __init__(self):
+        self._queries: Dict[Tuple[str, str], Any] = {}
+
+    def get(self, language: str, lang_obj: Language, source: str):
+        key = (language, source)
+        if key not in self._queries:
+            try:
+                self._queries[key] = lang_obj.query(source)
+            except Exception as e:
+                logger.warning(f"Не удалось скомпилировать запрос Tree-sitter для языка '{language}': {e}")
+                self._queries[key] = None
+        return self._queries[key]
+
+
+class ParsedSource:
+    """
+    Один разбор файла, общий для извлечения структуры (ASTParser.parse_code_structure)
+    и разбиения на чанки (TreeSitterSplitter.split_text): текст кодируется в UTF-8
+    и разбирается Tree-sitter не больше одного раза - при первом обращении к tree.
+    Если оба результата взяты из кэша анализа, разбор не выполняется вовсе.
+    Не потокобезопасен, как и Parser, которым он разбирается.
+    """
+
+    def __init__(self, code: str, language: str, parser: Parser, lang_obj: Language):
+        self.code = code
+        self.language = language
+        self._parser = parser
+        self._lang_obj = lang_obj
+        self._source_bytes: Optional[bytes] = None
+        self._tree = None
+
+    @property
+    def source_bytes(self) -> bytes:
+        if self._source_bytes is None:
+            self._source_bytes = self.code.encode("utf-8")
+        return self._source_bytes
+
+    @property
+    def tree(self):
+        if self._tree is None:
+            self._parser.set_language(self._lang_obj)
+            self._tree = self._parser.parse(self.source_bytes)
+        return self._tree
+
+    def text(self, start_byte: int, end_byte: int) -> str:
+        """Текст между байтовыми смещениями (смещения узлов Tree-sitter - в байтах UTF-8, а не в символах)."""
+        return self.source_bytes[start_byte:end_byte].decode("utf-8", errors="ignore")
+
+
 class ASTParser:
     """
     Парсер, который использует Tree-sitter для извлечения
@@ -58,6 +118,7 @@ class ASTParser:
         self.library_path = compiled_library_path
         self.parser = Parser()
         self.languages: Dict[str, Language] = {}
+        self.queries = QueryCache()
         self._load_languages()
 
     def _load_languages(self):
@@ -74,9 +135,15 @@ class ASTParser:
         """Возвращает имя языка по расширению файла."""
         return LANGUAGE_MAP.get(file_extension.lower())
 
-    def parse_code_structure(self, code_content: str, language: str) -> Dict[str, Any]:
+    def parse(self, code_content: str, language: str) -> Optional[ParsedSource]:
+        """Готовит общий разбор файла (см. ParsedSource) или возвращает None для неподдерживаемого языка."""
+        lang_obj = self.languages.get(language)
+        return ParsedSource(code_content, language, self.parser, lang_obj) if lang_obj else None
+
+    def parse_code_structure(self, code_content: str, language: str, parsed: Optional[ParsedSource] = None) -> Dict[str, Any]:
         """
         Анализирует код и возвращает словарь со структурной информацией.
+        parsed - уже подготовленный разбор этого же кода (см. ParsedSource), чтобы не разбирать его повторно.
         """
         structure = {
             "imports": set(),
@@ -88,13 +155,15 @@ class ASTParser:
             return structure
 
         lang_obj = self.languages[language]
-        self.parser.set_language(lang_obj)
-        
+        if parsed is None or parsed.language != language:
+            parsed = ParsedSource(code_content, language, self.parser, lang_obj)
+
+        query = self.queries.get(language, lang_obj, LANGUAGE_QUERIES[language])
+        if query is None:
+            return structure
+
         try:
-            tree = self.parser.parse(bytes(code_content, "utf8"))
-            query_str = LANGUAGE_QUERIES[language]
-            query = lang_obj.query(query_str)
-            captures = query.captures(tree.root_node)
+            captures = query.captures(parsed.tree.root_node)
         except Exception as e:
             logger.error(f"ASTParser: Ошибка при парсинге или выполнении запроса для языка '{language}': {e}")
             return structure
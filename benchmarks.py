@@ -0,0 +1,614 @@
+# --- Файл: benchmarks.py ---
+"""
+Замеры производительности отдельных подсистем без запуска GUI и без обращений к API.
+
+Запуск:
+    python benchmarks.py vector_search --vectors 300000 --dim 768 --nprobe 4 16 64
+    python benchmarks.py session_open --chunks 100000 --dim 768
+    python benchmarks.py session_io --chunks 100000 --dim 768
+    python benchmarks.py keyword_search --chunks 100000 --queries 200
+    python benchmarks.py project_context --chunks 100000 --dim 768
+    python benchmarks.py workspace_catalog --sessions 500 --messages 200
+    python benchmarks.py code_parsing --megabytes 4
+    python benchmarks.py text_splitting --megabytes 1 4 16
+"""
+
+import os
+import sys
+import time
+import argparse
+import logging
+import tempfile
+import tracemalloc
+import multiprocessing
+
+import numpy as np
+
+# Настройка простого логгера для скрипта
+logging.basicConfig(level=logging.INFO, format='%(message)s')
+logger = logging.getLogger(__name__)
+
+
+def make_clustered_embeddings(count: int, dim: int, clusters: int, noise: float, rng: np.random.Generator) -> np.ndarray:
+    """Синтетические эмбеддинги, сгруппированные вокруг тем (как чанки реальных проектов)."""
+    centers = rng.standard_normal((clusters, dim)).astype(np.float32)
+    labels = rng.integers(0, clusters, count)
+    return centers[labels] + noise * rng.standard_normal((count, dim)).astype(np.float32)
+
+
+def bench_vector_search(args: argparse.Namespace):
+    """Полнота recall@k и задержка приближенного (IVF) поиска относительно точного."""
+    from vector_index import VectorIndex
+
+    rng = np.random.default_rng(args.seed)
+    logger.info(f"Генерация {args.vectors} векторов размерности {args.dim}...")
+    embeddings = make_clustered_embeddings(args.vectors, args.dim, args.clusters, args.noise, rng)
+    # Тот же seed дает те же центры тем, поэтому запросы "о том же", что и корпус
+    queries = make_clustered_embeddings(args.queries, args.dim, args.clusters, args.noise, np.random.default_rng(args.seed))
+
+    index = VectorIndex()
+    started = time.perf_counter()
+    batch = 10000
+    for start in range(0, args.vectors, batch):
+        end = min(start + batch, args.vectors)
+        index.add([(f"file_{i // 20}", i % 20) for i in range(start, end)], embeddings[start:end])
+    logger.info(f"Построение индекса: {time.perf_counter() - started:.2f} с")
+
+    exact_results, exact_seconds = [], 0.0
+    for query in queries:
+        started = time.perf_counter()
+        exact_results.append({key for key, _ in index.search(query, args.top_k, exact=True)})
+        exact_seconds += time.perf_counter() - started
+    logger.info(f"Точный поиск: {exact_seconds / len(queries) * 1000:.2f} мс/запрос")
+
+    index.configure_ann(True)
+    started = time.perf_counter()
+    index.search(queries[0], args.top_k) # Первый запрос обучает кластеры
+    logger.info(f"Обучение IVF: {time.perf_counter() - started:.2f} с")
+
+    logger.info(f"{'nprobe':>8} {'recall@' + str(args.top_k):>10} {'мс/запрос':>10} {'ускорение':>10}")
+    for nprobe in args.nprobe:
+        index.configure_ann(True, nprobe)
+        recall, ann_seconds = 0.0, 0.0
+        for query, expected in zip(queries, exact_results):
+            started = time.perf_counter()
+            found = {key for key, _ in index.search(query, args.top_k)}
+            ann_seconds += time.perf_counter() - started
+            recall += len(found & expected) / max(1, len(expected))
+        per_query = ann_seconds / len(queries)
+        speedup = exact_seconds / ann_seconds if ann_seconds > 0 else 0.0
+        logger.info(f"{nprobe:>8} {recall / len(queries):>10.3f} {per_query * 1000:>10.2f} {speedup:>9.1f}x")
+
+
+SYNTHETIC_METADATA = {
+    "project_type": "local", "repo_url": None, "repo_branch": None, "local_path": "/tmp/project",
+    "rag_enabled": True, "model_name": "bench", "max_output_tokens": 8192, "extensions": ".py",
+    "instructions": "", "ann_enabled": False, "ann_nprobe": 16
+}
+
+
+# Словарь синтетических идентификаторов: текст чанков различается, как в настоящем коде
+SYNTHETIC_VOCABULARY_SIZE = 20000
+
+
+def make_synthetic_text(rng: np.random.Generator, chars: int) -> str:
+    """Похожий на код текст длиной chars из идентификаторов словаря SYNTHETIC_VOCABULARY_SIZE."""
+    words = rng.zipf(1.3, chars // 6) % SYNTHETIC_VOCABULARY_SIZE
+    lines = [f"    value_{a} = call_{b}(arg_{c})" for a, b, c in words[: len(words) // 3 * 3].reshape(-1, 3)]
+    return ("def handler(request):\n" + "\n".join(lines))[:chars]
+
+
+def make_synthetic_session(path: str, chunks: int, dim: int, chunk_chars: int, seed: int, page_size: int = 0) -> float:
+    """
+    Файл сессии с chunks чанками (по 20 на файл), саммари файлов, эмбеддингами и векторным индексом.
+    page_size - размер страницы SQLite для нового файла (0 - по умолчанию db_manager). Возвращает время записи.
+    """
+    import db_manager
+    from vector_index import VectorIndex
+
+    logging.getLogger().setLevel(logging.WARNING)
+    if page_size: db_manager.SESSION_PAGE_SIZE = page_size
+    rng = np.random.default_rng(seed)
+    embeddings = rng.standard_normal((chunks, dim)).astype(np.float32)
+    context = []
+    for i in range(chunks):
+        file_path = f"src/module_{i // 20}.py"
+        if i % 20 == 0:
+            context.append({'file_path': file_path, 'type': 'summary', 'chunk_num': 0, 'content': f"Модуль {i // 20}.", 'embedding': None})
+        context.append({'file_path': file_path, 'type': 'chunk', 'chunk_num': i % 20,
+                        'content': make_synthetic_text(rng, chunk_chars), 'embedding': embeddings[i]})
+    index = VectorIndex()
+    index.add([(item['file_path'], item['chunk_num']) for item in context if item['type'] == 'chunk'], embeddings)
+    messages = [{"role": "user" if i % 2 == 0 else "model", "parts": [f"Сообщение {i}"], "excluded": False} for i in range(200)]
+    started = time.perf_counter()
+    if not db_manager.save_session_data(path, dict(SYNTHETIC_METADATA), messages, context, vector_index_state=index.export_state()):
+        raise RuntimeError(f"Не удалось создать синтетическую сессию {path}")
+    seconds = time.perf_counter() - started
+    db_manager.close_all_sessions()
+    return seconds
+
+
+def _peak_rss_mb() -> float:
+    """Пиковый RSS процесса в МБ (где доступен модуль resource), иначе 0."""
+    try:
+        import resource
+    except ImportError:
+        return 0.0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def _load_vector_index(path: str, context: list):
+    """
+    Собирает векторный индекс сессии так же, как ChatModel: из эмбеддингов элементов при полной загрузке
+    и из файла по id строк для ленивой (ChatModel._ensure_vector_index, при первом семантическом поиске).
+    """
+    import db_manager
+    from vector_index import VectorIndex
+
+    index = VectorIndex()
+    chunks = [item for item in context if item['type'] == 'chunk']
+    if chunks and 'row_id' in chunks[0]:
+        vectors, _ = db_manager.load_chunk_embeddings(path, [item['row_id'] for item in chunks])
+        chunks = [dict(item, embedding=vectors[item['row_id']]) for item in chunks if item['row_id'] in vectors]
+    index.add([(item['file_path'], item['chunk_num']) for item in chunks], [item.get('embedding') for item in chunks])
+    state = db_manager.load_vector_index_state(path)
+    if state and len(index): index.restore_state(state)
+    return index
+
+
+def _open_session(path: str, lazy: bool, trace_memory: bool) -> tuple:
+    """
+    Открывает сессию так же, как ChatModel (полная - данные и векторный индекс, ленивая - только данные),
+    затем отдельно замеряет сборку отложенного индекса ленивой сессии. Выполняется в отдельном процессе.
+    """
+    import db_manager
+
+    logging.getLogger().setLevel(logging.WARNING)
+    rss_before = _peak_rss_mb()
+    if trace_memory: tracemalloc.start()
+    started = time.perf_counter()
+    _, _, context = db_manager.load_session_data(path, lazy=lazy)
+    index = None if lazy else _load_vector_index(path, context)
+    seconds = time.perf_counter() - started
+    index_seconds = 0.0
+    if index is None:
+        started = time.perf_counter()
+        index = _load_vector_index(path, context)
+        index_seconds = time.perf_counter() - started
+    traced_peak = tracemalloc.get_traced_memory()[1] / (1024 * 1024) if trace_memory else 0.0
+    return seconds, index_seconds, traced_peak, _peak_rss_mb() - rss_before, len(context), len(index)
+
+
+def bench_session_open(args: argparse.Namespace):
+    """
+    Время открытия и память для большой сессии: полная загрузка против ленивой.
+    Для ленивой отдельно показана сборка векторного индекса при первом семантическом поиске;
+    память - вместе с ним.
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "bench.cpai")
+        # Каждый шаг - в свежем процессе, чтобы не мешали кэши и уже выделенная память
+        # (пиковый RSS наследуется дочерним процессом, поэтому и сессия создается не здесь)
+        context = multiprocessing.get_context("spawn")
+        logger.info(f"Создание синтетической сессии: {args.chunks} чанков, размерность {args.dim}...")
+        started = time.perf_counter()
+        with context.Pool(1) as pool:
+            pool.apply(make_synthetic_session, (path, args.chunks, args.dim, args.chunk_chars, args.seed))
+        logger.info(f"Сессия создана за {time.perf_counter() - started:.1f} с, размер файла {os.path.getsize(path) / (1024 * 1024):.0f} МБ")
+
+        logger.info(f"{'режим':>8} {'время, с':>10} {'индекс, с':>10} {'Python, МБ':>11} {'RSS, МБ':>9}")
+        for lazy in (False, True):
+            with context.Pool(1) as pool:
+                seconds, index_seconds, _, rss, items, vectors = pool.apply(_open_session, (path, lazy, False))
+            with context.Pool(1) as pool:
+                _, _, traced, _, _, _ = pool.apply(_open_session, (path, lazy, True))
+            mode = "ленивый" if lazy else "полный"
+            logger.info(f"{mode:>8} {seconds:>10.2f} {index_seconds:>10.2f} {traced:>11.0f} {rss:>9.0f}   (элементов {items}, векторов {vectors})")
+
+
+def _session_io(path: str, repeats: int) -> dict:
+    """Открытие сессии и серия маленьких сохранений (одно сообщение + один чанк). Выполняется в отдельном процессе."""
+    import db_manager
+
+    logging.getLogger().setLevel(logging.WARNING)
+    started = time.perf_counter()
+    _, messages, context = db_manager.load_session_data(path, lazy=True)
+    result = {"open": time.perf_counter() - started}
+
+    def save_once(step: int):
+        messages.append({"role": "user", "parts": [f"Новое сообщение {step}"], "excluded": False})
+        chunk = {'file_path': "src/new.py", 'type': 'chunk', 'chunk_num': step, 'content': "x = 1\n" * 200,
+                 'embedding': np.ones(8, dtype=np.float32)}
+        db_manager.save_session_delta(path, dict(SYNTHETIC_METADATA), messages, [len(messages) - 1], [chunk], set())
+
+    for mode in ("persistent", "reopen"):
+        started = time.perf_counter()
+        for step in range(repeats):
+            if mode == "reopen": db_manager.close_all_sessions() # Как раньше: новое соединение на каждую операцию
+            save_once(len(messages))
+        result[mode] = (time.perf_counter() - started) / repeats
+    db_manager.close_all_sessions()
+    return result
+
+
+def bench_session_io(args: argparse.Namespace):
+    """Сохранение и открытие большой сессии: размер страницы SQLite и долгоживущее соединение."""
+    import db_manager
+
+    context = multiprocessing.get_context("spawn")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        logger.info(f"Синтетическая сессия: {args.chunks} чанков, размерность {args.dim}; маленьких сохранений: {args.repeats}")
+        logger.info(f"{'страница':>9} {'полная запись, с':>17} {'открытие, с':>12} {'сохранение, мс':>15} {'с переоткрытием, мс':>20}")
+        for page_size in (4096, db_manager.SESSION_PAGE_SIZE):
+            path = os.path.join(tmp_dir, f"bench_{page_size}.cpai")
+            with context.Pool(1) as pool:
+                write_seconds = pool.apply(make_synthetic_session, (path, args.chunks, args.dim, args.chunk_chars, args.seed, page_size))
+            with context.Pool(1) as pool:
+                result = pool.apply(_session_io, (path, args.repeats))
+            logger.info(
+                f"{page_size:>9} {write_seconds:>17.2f} {result['open']:>12.2f} "
+                f"{result['persistent'] * 1000:>15.1f} {result['reopen'] * 1000:>20.1f}"
+            )
+
+
+def bench_keyword_search(args: argparse.Namespace):
+    """Задержка поиска BM25 по индексу context_fts файла сессии против построения индекса в памяти."""
+    import db_manager
+    from keyword_index import KeywordIndex, build_match_query
+
+    rng = np.random.default_rng(args.seed + 1)
+    queries = [
+        " ".join(f"{prefix}_{rng.integers(0, SYNTHETIC_VOCABULARY_SIZE)}" for prefix in rng.choice(["value", "call", "arg"], 3))
+        for _ in range(args.queries)
+    ]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "bench.cpai")
+        logger.info(f"Создание синтетической сессии: {args.chunks} чанков...")
+        with multiprocessing.get_context("spawn").Pool(1) as pool:
+            write_seconds = pool.apply(make_synthetic_session, (path, args.chunks, args.dim, args.chunk_chars, args.seed))
+        logger.info(f"Сессия создана за {write_seconds:.1f} с (вместе с индексом FTS), размер файла {os.path.getsize(path) / (1024 * 1024):.0f} МБ")
+
+        started = time.perf_counter()
+        _, _, context = db_manager.load_session_data(path, lazy=False)
+        logger.info(f"Полная загрузка сессии: {time.perf_counter() - started:.2f} с")
+
+        latencies, found = [], 0
+        for query in queries:
+            started = time.perf_counter()
+            hits = db_manager.search_context_fts(path, build_match_query(query), args.top_k)
+            latencies.append(time.perf_counter() - started)
+            found += bool(hits)
+        latencies_ms = np.array(latencies) * 1000
+        logger.info(
+            f"Индекс в файле: медиана {np.median(latencies_ms):.1f} мс, p95 {np.percentile(latencies_ms, 95):.1f} мс "
+            f"(запросов с результатами: {found}/{len(queries)})"
+        )
+
+        started = time.perf_counter()
+        memory_index = KeywordIndex(context)
+        build_seconds = time.perf_counter() - started
+        latencies = []
+        for query in queries:
+            started = time.perf_counter()
+            memory_index.search(build_match_query(query), args.top_k)
+            latencies.append(time.perf_counter() - started)
+        latencies_ms = np.array(latencies) * 1000
+        logger.info(
+            f"Индекс в памяти: построение {build_seconds:.1f} с, медиана {np.median(latencies_ms):.1f} мс, "
+            f"p95 {np.percentile(latencies_ms, 95):.1f} мс"
+        )
+        memory_index.close()
+        db_manager.close_all_sessions()
+
+
+def _make_context_items(files: int, chunks_per_file: int, dim: int, rng: np.random.Generator, tag: str = "") -> list:
+    """Элементы контекста в том виде, в каком их выдает SummarizerWorker (с эмбеддингами чанков)."""
+    items = []
+    for f in range(files):
+        path = f"pkg{f % 97}/module_{f}.py"
+        items.append({'file_path': path, 'type': 'summary', 'chunk_num': 0, 'content': f"Обзор {path} {tag}", 'embedding': None})
+        items.append({'file_path': path, 'type': 'structure', 'chunk_num': 0, 'content': {'imports': ['os'], 'functions': [f"f{f}()"]}, 'embedding': None})
+        vectors = rng.standard_normal((chunks_per_file, dim)).astype(np.float32)
+        for i in range(chunks_per_file):
+            items.append({'file_path': path, 'type': 'chunk', 'chunk_num': i, 'content': f"def f{f}_{i}(): {tag}", 'embedding': vectors[i].copy()})
+    return items
+
+
+def _median_ms(func, args_list: list) -> float:
+    """Медианное время вызова func(arg) по всем аргументам args_list, в мс."""
+    latencies = []
+    for arg in args_list:
+        started = time.perf_counter()
+        func(arg)
+        latencies.append(time.perf_counter() - started)
+    return float(np.median(latencies) * 1000)
+
+
+def bench_project_context(args: argparse.Namespace):
+    """Память и задержка выборок: список словарей с эмбеддингами против ProjectContextStore."""
+    from vector_index import VectorIndex
+    from project_context import ProjectContextStore
+
+    files = max(1, args.chunks // args.chunks_per_file)
+    rng = np.random.default_rng(args.seed)
+    probe_paths = [f"pkg{f % 97}/module_{f}.py" for f in rng.integers(0, files, args.repeats)]
+    replacement = _make_context_items(1, args.chunks_per_file, args.dim, rng, tag="v2")
+    logger.info(f"Контекст: {files} файлов, {files * args.chunks_per_file} чанков размерности {args.dim}")
+    logger.info(f"{'вариант':>10} {'память, МБ':>11} {'тип, мс':>9} {'файл, мс':>9} {'замена файла, мс':>17}")
+
+    def fresh_items(path: str) -> list:
+        return [dict(item, file_path=path) for item in replacement]
+
+    # Прежняя схема: плоский список (эмбеддинги в элементах) плюс нормированная копия векторов в индексе
+    tracemalloc.start()
+    context = _make_context_items(files, args.chunks_per_file, args.dim, rng)
+    index = VectorIndex()
+    chunks = [item for item in context if item['type'] == 'chunk']
+    index.add([(item['file_path'], item['chunk_num']) for item in chunks], [item['embedding'] for item in chunks])
+    del chunks
+    memory = tracemalloc.get_traced_memory()[0] / (1024 * 1024)
+    tracemalloc.stop()
+
+    def replace_in_list(path: str):
+        nonlocal context
+        context = [item for item in context if item['file_path'] != path]
+        index.remove_files({path})
+        items = fresh_items(path)
+        context.extend(items)
+        index.add([(path, item['chunk_num']) for item in items if item['type'] == 'chunk'],
+                  [item['embedding'] for item in items if item['type'] == 'chunk'])
+
+    type_ms = _median_ms(lambda item_type: [item for item in context if item['type'] == item_type], ['chunk'] * args.repeats)
+    file_ms = _median_ms(lambda path: [item for item in context if item['file_path'] == path], probe_paths)
+    replace_ms = _median_ms(replace_in_list, probe_paths)
+    logger.info(f"{'список':>10} {memory:>11.0f} {type_ms:>9.2f} {file_ms:>9.3f} {replace_ms:>17.2f}")
+    del context, index
+
+    tracemalloc.start()
+    store = ProjectContextStore()
+    store.add(_make_context_items(files, args.chunks_per_file, args.dim, rng))
+    memory = tracemalloc.get_traced_memory()[0] / (1024 * 1024)
+    tracemalloc.stop()
+
+    def select_type(item_type: str):
+        store._type_views.clear() # Худший случай: первая выборка после изменения контекста
+        store.of_type(item_type)
+
+    type_ms = _median_ms(select_type, ['chunk'] * args.repeats)
+    file_ms = _median_ms(store.file_items, probe_paths)
+    replace_ms = _median_ms(lambda path: store.replace_file(path, fresh_items(path)), probe_paths)
+    logger.info(f"{'хранилище':>10} {memory:>11.0f} {type_ms:>9.2f} {file_ms:>9.3f} {replace_ms:>17.2f}")
+
+def bench_workspace_catalog(args: argparse.Namespace):
+    """Заполнение каталога сессий, задержка списка недавних и полнотекстового поиска по всем сессиям."""
+    from workspace_catalog import WorkspaceCatalog
+
+    rng = np.random.default_rng(args.seed)
+    queries = [f"value_{rng.integers(0, SYNTHETIC_VOCABULARY_SIZE)} call_{rng.integers(0, SYNTHETIC_VOCABULARY_SIZE)}"
+               for _ in range(args.queries)]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        catalog = WorkspaceCatalog(os.path.join(tmp_dir, "catalog.sqlite"))
+        started = time.perf_counter()
+        for s in range(args.sessions):
+            words = rng.integers(0, SYNTHETIC_VOCABULARY_SIZE, (args.messages + args.files, 12))
+            messages = [
+                {'role': 'user' if m % 2 == 0 else 'model', 'parts': [" ".join(f"value_{w} call_{w}" for w in words[m])]}
+                for m in range(args.messages)
+            ]
+            summaries = [
+                {'file_path': f"module_{f}.py", 'type': 'summary', 'content': " ".join(f"value_{w}" for w in words[args.messages + f])}
+                for f in range(args.files)
+            ]
+            info = {'project_type': 'local', 'project_source': f"/projects/p{s}", 'message_count': len(messages),
+                    'file_count': args.files, 'chunk_count': args.files * 20}
+            catalog.record_session(os.path.join(tmp_dir, f"session_{s}.cpai"), info, messages, summaries)
+        logger.info(
+            f"Каталог: {args.sessions} сессий по {args.messages} сообщений и {args.files} саммари заполнен за "
+            f"{time.perf_counter() - started:.1f} с, размер {os.path.getsize(catalog.filepath) / (1024 * 1024):.0f} МБ"
+        )
+        logger.info(f"Список недавних (100): медиана {_median_ms(catalog.list_sessions, [100] * args.queries):.2f} мс")
+        logging.getLogger("workspace_catalog").setLevel(logging.WARNING)
+        logger.info(f"Поиск по всем сессиям: медиана {_median_ms(catalog.search, queries):.1f} мс")
+        catalog.close()
+
+
+def _grammar_library_path() -> str:
+    """Путь к библиотеке грамматик, собранной build_grammars.py (как его ищет SummarizerWorker)."""
+    lib_name = {'win32': 'languages.dll', 'darwin': 'languages.dylib'}.get(sys.platform, 'languages.so')
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), 'resources', 'grammars', lib_name)
+
+
+def make_python_source(megabytes: float, seed: int) -> str:
+    """Синтетический модуль Python заданного размера: импорты, классы с методами и функции."""
+    rng = np.random.default_rng(seed)
+    parts = ["import os\nimport sys\nfrom typing import List, Dict\n"]
+    size, n = 0, 0
+    while size < megabytes * 1024 * 1024:
+        body = "\n".join(f"        value_{i} = call_{rng.integers(0, SYNTHETIC_VOCABULARY_SIZE)}(arg, {i})  # шаг {i}" for i in range(8))
+        part = (
+            f"\n\nclass Handler{n}(Base):\n    \"\"\"Обработчик {n}.\"\"\"\n\n"
+            f"    def process(self, arg: int) -> int:\n{body}\n        return value_7\n\n"
+            f"def helper_{n}(items: List[int]) -> int:\n    return sum(item * {n} for item in items)\n"
+        )
+        parts.append(part)
+        size += len(part.encode("utf-8"))
+        n += 1
+    return "".join(parts)
+
+
+def bench_code_parsing(args: argparse.Namespace):
+    """Время разбора на МБ кода: отдельный разбор для структуры и для чанков против общего ParsedSource."""
+    from ast_parser import ASTParser
+    from code_splitter import TreeSitterSplitter
+
+    lib_path = args.grammars or _grammar_library_path()
+    ast_parser, splitter = ASTParser(lib_path), TreeSitterSplitter(lib_path)
+    code = make_python_source(args.megabytes, args.seed)
+    megabytes = len(code.encode("utf-8")) / (1024 * 1024)
+    logger.info(f"Код: {megabytes:.1f} МБ Python")
+
+    def separate(_):
+        ast_parser.parse_code_structure(code, "python")
+        splitter.split_text(code, "python")
+
+    def shared(_):
+        parsed = splitter.parse(code, "python")
+        ast_parser.parse_code_structure(code, "python", parsed)
+        splitter.split_text(code, "python", parsed)
+
+    def parse_only(_):
+        splitter.parse(code, "python").tree
+
+    parse_ms = _median_ms(parse_only, range(args.repeats))
+    separate_ms = _median_ms(separate, range(args.repeats))
+    shared_ms = _median_ms(shared, range(args.repeats))
+    logger.info(f"Один разбор: {parse_ms / megabytes:.1f} мс/МБ")
+    logger.info(f"Структура + чанки, два разбора: {separate_ms / megabytes:.1f} мс/МБ")
+    logger.info(f"Структура + чанки, общий разбор: {shared_ms / megabytes:.1f} мс/МБ")
+
+
+def make_document_text(megabytes: float, seed: int) -> str:
+    """Синтетический текст документа (как извлеченный из большого PDF): абзацы из строк слов."""
+    rng = np.random.default_rng(seed)
+    vocabulary = np.array([f"слово{i}" for i in range(2000)] + [f"term{i}" for i in range(2000)])
+    lines, size = [], 0
+    while size < megabytes * 1024 * 1024:
+        line = " ".join(vocabulary[rng.integers(0, len(vocabulary), rng.integers(6, 14))])
+        lines.append(line + ("\n\n" if rng.random() < 0.1 else "\n"))
+        size += len(lines[-1].encode("utf-8"))
+    return "".join(lines)
+
+
+def _legacy_split_text(text: str, chunk_size: int, chunk_overlap: int) -> list:
+    """Прежний RecursiveCharacterSplitter (склейка строк, поиск разделителя на каждый блок) - для сравнения."""
+    separators = ["\n\n", "\n", " ", ""]
+
+    def split_blocks(blocks, separator, final_chunks):
+        current_chunk = ""
+        for block in blocks:
+            if not block: continue
+            if len(block) > chunk_size:
+                next_index = separators.index(separator) + 1
+                if separators[next_index]:
+                    split_blocks(block.split(separators[next_index]), separators[next_index], final_chunks)
+                else:
+                    if current_chunk: final_chunks.append(current_chunk)
+                    final_chunks.extend(block[i:i + chunk_size] for i in range(0, len(block), chunk_size - chunk_overlap))
+                    current_chunk = ""
+            elif len(current_chunk + separator + block) <= chunk_size:
+                current_chunk += separator + block
+            else:
+                if current_chunk: final_chunks.append(current_chunk)
+                current_chunk = block
+        if current_chunk: final_chunks.append(current_chunk)
+
+    chunks = []
+    split_blocks(text.split(separators[0]), separators[0], chunks)
+    return chunks
+
+
+def bench_text_splitting(args: argparse.Namespace):
+    """Время разбиения больших документов: прежний сплиттер против сплиттера на смещениях."""
+    from code_splitter import RecursiveCharacterSplitter
+
+    splitter = RecursiveCharacterSplitter(chunk_size=args.chunk_size, chunk_overlap=args.chunk_overlap)
+    logger.info(f"{'МБ':>6} {'прежний, с':>11} {'чанков':>8} {'смещения, с':>12} {'чанков':>8} {'перекрытие, симв.':>18}")
+    for megabytes in args.megabytes:
+        text = make_document_text(megabytes, args.seed)
+        started = time.perf_counter()
+        legacy_chunks = _legacy_split_text(text, args.chunk_size, args.chunk_overlap)
+        legacy_seconds = time.perf_counter() - started
+        started = time.perf_counter()
+        spans = splitter.split_spans(text)
+        seconds = time.perf_counter() - started
+        overlaps = [max(0, end - next_start) for (_, end), (next_start, _) in zip(spans, spans[1:])]
+        logger.info(
+            f"{megabytes:>6.1f} {legacy_seconds:>11.2f} {len(legacy_chunks):>8} {seconds:>12.2f} {len(spans):>8} "
+            f"{np.mean(overlaps) if overlaps else 0:>18.0f}"
+        )
+
+
+BENCHMARKS = {
+    "vector_search": bench_vector_search,
+    "session_open": bench_session_open,
+    "session_io": bench_session_io,
+    "keyword_search": bench_keyword_search,
+    "project_context": bench_project_context,
+    "workspace_catalog": bench_workspace_catalog,
+    "code_parsing": bench_code_parsing,
+    "text_splitting": bench_text_splitting,
+}
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Замеры производительности CodePilotAI")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    vector = subparsers.add_parser("vector_search", help="recall@k и задержка IVF против точного поиска")
+    vector.add_argument("--vectors", type=int, default=300000)
+    vector.add_argument("--dim", type=int, default=768)
+    vector.add_argument("--clusters", type=int, default=3000, help="число 'тем' в синтетических данных")
+    vector.add_argument("--noise", type=float, default=0.6)
+    vector.add_argument("--queries", type=int, default=100)
+    vector.add_argument("--top-k", type=int, default=10)
+    vector.add_argument("--nprobe", type=int, nargs="+", default=[1, 4, 16, 64])
+    vector.add_argument("--seed", type=int, default=0)
+
+    session = subparsers.add_parser("session_open", help="время открытия и память: полная загрузка против ленивой")
+    session.add_argument("--chunks", type=int, default=100000)
+    session.add_argument("--dim", type=int, default=768)
+    session.add_argument("--chunk-chars", type=int, default=1500)
+    session.add_argument("--seed", type=int, default=0)
+
+    session_io = subparsers.add_parser("session_io", help="сохранение и открытие: размер страницы, долгоживущее соединение")
+    session_io.add_argument("--chunks", type=int, default=100000)
+    session_io.add_argument("--dim", type=int, default=768)
+    session_io.add_argument("--chunk-chars", type=int, default=1500)
+    session_io.add_argument("--repeats", type=int, default=20)
+    session_io.add_argument("--seed", type=int, default=0)
+
+    keyword = subparsers.add_parser("keyword_search", help="задержка поиска BM25 по индексу FTS5 в файле сессии")
+    keyword.add_argument("--chunks", type=int, default=100000)
+    keyword.add_argument("--dim", type=int, default=64, help="размерность эмбеддингов (на поиск не влияет)")
+    keyword.add_argument("--chunk-chars", type=int, default=1500)
+    keyword.add_argument("--queries", type=int, default=200)
+    keyword.add_argument("--top-k", type=int, default=20)
+    keyword.add_argument("--seed", type=int, default=0)
+
+    project = subparsers.add_parser("project_context", help="память и выборки контекста проекта: список словарей против хранилища")
+    project.add_argument("--chunks", type=int, default=100000)
+    project.add_argument("--chunks-per-file", type=int, default=20)
+    project.add_argument("--dim", type=int, default=768)
+    project.add_argument("--repeats", type=int, default=20)
+    project.add_argument("--seed", type=int, default=0)
+
+    catalog = subparsers.add_parser("workspace_catalog", help="каталог сессий: заполнение, список недавних, поиск по всем сессиям")
+    catalog.add_argument("--sessions", type=int, default=500)
+    catalog.add_argument("--messages", type=int, default=200)
+    catalog.add_argument("--files", type=int, default=100)
+    catalog.add_argument("--queries", type=int, default=200)
+    catalog.add_argument("--seed", type=int, default=0)
+
+    parsing = subparsers.add_parser("code_parsing", help="разбор Tree-sitter на МБ кода: структура и чанки по отдельности и с общим разбором")
+    parsing.add_argument("--megabytes", type=float, default=4)
+    parsing.add_argument("--repeats", type=int, default=5)
+    parsing.add_argument("--grammars", help="путь к библиотеке грамматик (по умолчанию resources/grammars)")
+    parsing.add_argument("--seed", type=int, default=0)
+
+    splitting = subparsers.add_parser("text_splitting", help="разбиение больших документов: прежний сплиттер против сплиттера на смещениях")
+    splitting.add_argument("--megabytes", type=float, nargs="+", default=[1, 4, 16])
+    splitting.add_argument("--chunk-size", type=int, default=1000)
+    splitting.add_argument("--chunk-overlap", type=int, default=150)
+    splitting.add_argument("--seed", type=int, default=0)
+    return parser
+
+
+def main(argv=None) -> int:
+    args = build_parser().parse_args(argv)
+    BENCHMARKS[args.benchmark](args)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -6,7 +6,8 @@ import json
 import logging
 import hashlib
 import html
-from typing import Optional, List, Dict, Any, Tuple, Union
+import time
+from typing import Optional, List, Dict, Any, Tuple, Union, Iterable
 from io import BytesIO
 
 try:
@@ -15,7 +16,7 @@ except ImportError:
     git = None
     logging.warning("Библиотека 'GitPython' не найдена. Функция обновления из Git будет недоступна.")
 
-from PySide6.QtCore import QObject, Signal, Slot, QThread, QDir
+from PySide6.QtCore import QObject, Signal, Slot, QThread, QTimer, QDir, QStandardPaths
 
 import db_manager
 from dotenv import load_dotenv, set_key, find_dotenv
@@ -27,7 +28,19 @@ import numpy as np
 # Наши модули
 from github_manager import GitHubManager
 from github.Repository import Repository
-from summarizer import SummarizerWorker
+from summarizer import SummarizerWorker, DEFAULT_ANALYSIS_CONCURRENCY, MAX_ANALYSIS_CONCURRENCY, EMBEDDING_MODEL
+from analysis_pool import DEFAULT_ANALYSIS_PROCESSES, MAX_ANALYSIS_PROCESSES
+from analysis_cache import AnalysisCache, ANALYSIS_CACHE_FILENAME
+from workspace_catalog import WorkspaceCatalog, WORKSPACE_CATALOG_FILENAME
+from vector_index import VectorIndex, DEFAULT_ANN_NPROBE, MAX_ANN_NPROBE
+from token_estimator import TokenEstimator
+from prompt_cache import PromptPrefixCache, PromptTextBlock
+from session_changes import SessionChanges
+from project_context import ProjectContextStore, chunk_key
+from keyword_index import (
+    KeywordIndex, RETRIEVAL_MODES, DEFAULT_RETRIEVAL_MODE, build_match_query, fuse_rankings, retrieval_uses_embeddings
+)
+from session_writer import SessionWriter, AUTOSAVE_INTERVAL_MS
 
 logger = logging.getLogger(__name__)
 try:
@@ -43,19 +56,30 @@ except ImportError:
 
 # Глобальный лимит контекстного окна
 CONTEXT_WINDOW_LIMIT = 1048576
+# Доля бюджета промпта, при превышении которой локальная оценка токенов сверяется с API
+TOKEN_ESTIMATE_VERIFY_THRESHOLD = 0.9
+# Сколько кандидатов на каждый итоговый фрагмент берет из каждого списка гибридный поиск
+HYBRID_CANDIDATES_FACTOR = 3
 
 # --- Воркер для Gemini API ---
 class GeminiWorker(QThread):
     response_received = Signal(str)
     error_occurred = Signal(str)
     finished_work = Signal()
+    prompt_tokens_counted = Signal(int) # Точное число токенов промпта по данным API
+    chunk_received = Signal(str) # Очередной фрагмент ответа (в потоковом режиме)
+    first_token_received = Signal(float) # Время до первого фрагмента ответа, с
 
-    def __init__(self, api_key: str, model_name: str, prompt_parts: List[Dict[str, Any]], max_output_tokens: int):
+    def __init__(self, api_key: str, model_name: str, prompt_parts: List[Dict[str, Any]], max_output_tokens: int,
+                 count_prompt_tokens: bool = False, stream: bool = True):
         super().__init__()
         self.api_key = api_key
         self.model_name = model_name
         self.prompt_parts = prompt_parts
         self.max_output_tokens_config = max_output_tokens
+        # Запросить точный подсчет токенов перед генерацией (для калибровки локальной оценки)
+        self.count_prompt_tokens = count_prompt_tokens
+        self.stream = stream
         self._is_cancelled = False
 
     def cancel(self):
@@ -76,21 +100,43 @@ class GeminiWorker(QThread):
             logger.info(f"GeminiWorker: Отправка запроса к Gemini API для модели '{self.model_name}'...")
             generation_config = genai_types.GenerationConfig(max_output_tokens=self.max_output_tokens_config)
 
+            prompt_tokens_reported = False
+            if self.count_prompt_tokens:
+                try:
+                    self.prompt_tokens_counted.emit(model.count_tokens(self.prompt_parts).total_tokens)
+                    prompt_tokens_reported = True
+                except Exception as e:
+                    logger.warning(f"GeminiWorker: Не удалось подсчитать токены промпта: {e}")
+
+            request_started = time.perf_counter()
             response = model.generate_content(
                 self.prompt_parts,
                 generation_config=generation_config,
                 request_options={"timeout": 180},
+                stream=self.stream,
             )
-            logger.info(f"GeminiWorker: Получен ответ от Gemini API.")
+            if self.stream:
+                response_text = self._consume_stream(response, request_started)
+                if response_text is None: # Отменено во время получения ответа
+                    logger.info("GeminiWorker: Выполнение отменено во время получения ответа.")
+                    return
+            else:
+                response_text = response.text if hasattr(response, "text") else ""
+            logger.info(f"GeminiWorker: Получен ответ от Gemini API за {time.perf_counter() - request_started:.2f} с.")
+
+            # Метаданные ответа содержат точное число токенов промпта - это бесплатная калибровка
+            usage = getattr(response, "usage_metadata", None)
+            if not prompt_tokens_reported and usage and getattr(usage, "prompt_token_count", 0):
+                self.prompt_tokens_counted.emit(usage.prompt_token_count)
 
             if self._is_cancelled:
                 logger.info("GeminiWorker: Выполнение отменено во время работы.")
                 self.finished_work.emit()
                 return
 
-            if hasattr(response, "text") and response.text:
-                logger.info(f"GeminiWorker: Ответ получен. Длина текста: {len(response.text)}.")
-                self.response_received.emit(response.text)
+            if response_text:
+                logger.info(f"GeminiWorker: Ответ получен. Длина текста: {len(response_text)}.")
+                self.response_received.emit(response_text)
             else:
                 reason = "Неизвестно"
                 if response.prompt_feedback and response.prompt_feedback.block_reason:
@@ -109,6 +155,26 @@ class GeminiWorker(QThread):
             self.finished_work.emit()
             self.deleteLater()
 
+    def _consume_stream(self, response, request_started: float) -> Optional[str]:
+        """Читает потоковый ответ, отправляя фрагменты по мере поступления. None - если операция отменена."""
+        text_parts = []
+        for chunk in response:
+            if self._is_cancelled:
+                return None
+            try:
+                chunk_text = chunk.text
+            except ValueError:
+                # Фрагмент без текста (например, только метаданные или причина остановки)
+                continue
+            if not chunk_text: continue
+            if not text_parts:
+                time_to_first_token = time.perf_counter() - request_started
+                logger.info(f"GeminiWorker: Первый фрагмент ответа через {time_to_first_token:.2f} с.")
+                self.first_token_received.emit(time_to_first_token)
+            text_parts.append(chunk_text)
+            self.chunk_received.emit(chunk_text)
+        return "".join(text_parts)
+
 
 class ChatModel(QObject):
     # --- Сигналы ---
@@ -127,11 +193,16 @@ class ChatModel(QObject):
     fileSummariesChanged = Signal(dict)
     apiRequestStarted = Signal()
     apiResponseReceived = Signal(str)
+    apiResponseChunkReceived = Signal(str) # Фрагмент ответа, пока он генерируется
     apiIntermediateStep = Signal(str)
     apiErrorOccurred = Signal(str)
     apiRequestFinished = Signal()
     statusMessage = Signal(str, int)
     tokenCountUpdated = Signal(int, int)
+    _sessionWriteRequested = Signal(dict) # Снимок сессии для SessionWriter (в его потоке)
+    _sessionCompactRequested = Signal(str, int) # Путь и поколение сессии для SessionWriter.compact
+    _messageJournalRequested = Signal(str, list, int) # Записи журнала истории чата для SessionWriter.append_journal
+    _catalogUpdateRequested = Signal(dict) # Снимок открытой сессии для SessionWriter.update_catalog
 
     def __init__(self, app_lang: str = 'en', parent=None):
         super().__init__(parent)
@@ -147,10 +218,16 @@ class ChatModel(QObject):
         # --- Состояние сессии ---
         # Общие для всех типов проектов
         self._chat_history: List[Dict[str, Any]] = []
-        self._project_context: List[Dict[str, Any]] = [] # Теперь хранит как саммари, так и чанки/полные файлы
+        self._project_context = ProjectContextStore() # Саммари, структура, чанки/полные файлы и эмбеддинги чанков (см. _vector_index)
+        # Поиск по словам среди элементов, которых нет в файле: пополняется по мере поступления элементов (см. _reset_keyword_overlay)
+        self._keyword_overlay = KeywordIndex()
+        self._keyword_overlay_covers_all = True # Содержит ли индекс весь контекст, а не только добавленное после загрузки
         self._file_summaries_for_display: Dict[str, str] = {} # Для отображения саммари
         self._current_session_filepath: Optional[str] = None
         self._is_dirty: bool = False
+        self._session_changes = SessionChanges() # Что записать в файл сессии при следующем сохранении
+        self._lazy_context_source: Optional[str] = None # Файл, откуда догружается текст чанков ленивой сессии
+        self._deferred_vector_source: Optional[str] = None # Файл, из которого еще не собран векторный индекс ленивой сессии
         # Специфичные для проекта
         self._project_type: Optional[str] = None  # 'github' или 'local'
         self._is_git_repo: bool = False
@@ -171,9 +248,20 @@ class ChatModel(QObject):
         self._instructions: str = ""
         self._rag_enabled: bool = True
         self._semantic_search_enabled: bool = False # Новый режим по умолчанию выключен
+        self._ann_enabled: bool = False # Приближенный (IVF) поиск для очень больших проектов
+        self._ann_nprobe: int = DEFAULT_ANN_NPROBE
+        self._embedding_storage: str = db_manager.DEFAULT_EMBEDDING_STORAGE
+        self._retrieval_mode: str = DEFAULT_RETRIEVAL_MODE # Как отбирать фрагменты при включенном поиске
+        self._analysis_concurrency: int = DEFAULT_ANALYSIS_CONCURRENCY # Настройка приложения, не сессии
+        self._analysis_processes: int = DEFAULT_ANALYSIS_PROCESSES # Настройка приложения, не сессии
 
         # --- Состояние токенов ---
         self._current_prompt_tokens: int = 0
+        self._token_estimator = TokenEstimator()
+        self._current_prompt_raw_tokens: float = 0.0 # Оценка без калибровки для сверки с API
+        self._prompt_prefix_cache = PromptPrefixCache()
+        self._stream_responses: bool = True # Получать ответ модели по частям
+        self._prompt_context_version: int = 0 # Увеличивается при каждом изменении контекста проекта
         self._token_limit_for_display: int = CONTEXT_WINDOW_LIMIT
 
         # --- Воркеры и менеджеры ---
@@ -181,6 +269,31 @@ class ChatModel(QObject):
         self._analysis_thread: Optional[QThread] = None
         self._github_manager: Optional[GitHubManager] = None
         self._gemini_worker: Optional[GeminiWorker] = None
+        self._analysis_cache: Optional[AnalysisCache] = None # Открывается при первом анализе
+        self._last_cache_stats: Optional[Tuple[int, int]] = None
+
+        # --- Фоновая запись сессии ---
+        self._session_generation: int = 0 # Увеличивается при смене сессии
+        self._pending_save_path: Optional[str] = None # Запрос на сохранение, пришедший во время записи
+        self._pending_save_is_autosave: bool = False
+        self._saving_is_autosave: bool = False
+        self._autosave_enabled: bool = True # Настройка приложения, не сессии
+        self._workspace_catalog = self._open_workspace_catalog()
+        self._session_writer_thread = QThread()
+        self._session_writer = SessionWriter(self._workspace_catalog)
+        self._session_writer.moveToThread(self._session_writer_thread)
+        self._sessionWriteRequested.connect(self._session_writer.write)
+        self._session_writer.write_finished.connect(self._on_session_write_finished)
+        self._sessionCompactRequested.connect(self._session_writer.compact)
+        self._session_writer.compact_finished.connect(self._on_session_compact_finished)
+        self._messageJournalRequested.connect(self._session_writer.append_journal)
+        self._session_writer.journal_finished.connect(self._on_message_journal_finished)
+        self._catalogUpdateRequested.connect(self._session_writer.update_catalog)
+        self._session_writer_thread.start()
+        self._autosave_timer = QTimer(self)
+        self._autosave_timer.setInterval(AUTOSAVE_INTERVAL_MS)
+        self._autosave_timer.timeout.connect(self._on_autosave_timer)
+        self._autosave_timer.start()
 
         self._load_credentials()
         self.new_session()
@@ -296,9 +409,13 @@ class ChatModel(QObject):
             github_manager=self._github_manager,
             rag_enabled=self._rag_enabled,
             semantic_search_enabled=self._semantic_search_enabled,
+            retrieval_mode=self._retrieval_mode,
             gemini_api_key=self._gemini_api_key,
             model_name=self._model_name,
-            app_lang=self._app_language
+            app_lang=self._app_language,
+            max_workers=self._analysis_concurrency,
+            cache=self._get_analysis_cache(),
+            processes=self._analysis_processes
         )
 
         # 2. Перемещаем воркер в поток
@@ -310,6 +427,7 @@ class ChatModel(QObject):
         self._analysis_worker.file_summarized.connect(self._on_file_summarized)
         self._analysis_worker.progress_updated.connect(self.analysisProgressUpdated)
         self._analysis_worker.error_occurred.connect(self.analysisError)
+        self._analysis_worker.cache_stats_ready.connect(self._on_cache_stats_ready)
         
         # Запуск воркера при старте потока
         self._analysis_thread.started.connect(self._analysis_worker.run)
@@ -325,6 +443,23 @@ class ChatModel(QObject):
         # 4. Запускаем поток
         self._analysis_thread.start()
 
+    def _get_analysis_cache(self) -> Optional[AnalysisCache]:
+        """Лениво открывает постоянный кэш анализа в каталоге кэша приложения."""
+        if self._analysis_cache is None:
+            cache_dir = QStandardPaths.writableLocation(QStandardPaths.StandardLocation.CacheLocation)
+            if not cache_dir:
+                cache_dir = os.path.join(os.path.expanduser("~"), ".codepilotai")
+            self._analysis_cache = AnalysisCache(os.path.join(cache_dir, ANALYSIS_CACHE_FILENAME))
+        return self._analysis_cache if self._analysis_cache.is_available() else None
+
+    def _open_workspace_catalog(self) -> Optional[WorkspaceCatalog]:
+        """Открывает каталог сессий (недавние проекты, поиск по сессиям) в каталоге данных приложения."""
+        data_dir = QStandardPaths.writableLocation(QStandardPaths.StandardLocation.AppDataLocation)
+        if not data_dir:
+            data_dir = os.path.join(os.path.expanduser("~"), ".codepilotai")
+        catalog = WorkspaceCatalog(os.path.join(data_dir, WORKSPACE_CATALOG_FILENAME))
+        return catalog if catalog.is_available() else None
+
     def _is_ready_for_analysis(self) -> Tuple[bool, str]:
         """Проверяет, все ли готово к запуску анализа."""
         if not self._gemini_api_key_loaded and (self._rag_enabled or self._semantic_search_enabled):
@@ -416,15 +551,10 @@ class ChatModel(QObject):
             self._last_updated_files = sorted(list(relative_paths_to_remove))
             # --- КОНЕЦ НОВОГО КОДА ---
 
-            self._project_context = [
-                item for item in self._project_context 
-                if item.get('file_path') not in relative_paths_to_remove
-            ]
-            
-            self._project_context = [
-                item for item in self._project_context 
-                if item.get('file_path') not in relative_paths_to_remove
-            ]
+            self._project_context.remove_files(relative_paths_to_remove)
+            self._keyword_overlay.remove_files(relative_paths_to_remove)
+            self._session_changes.context_files_removed(relative_paths_to_remove)
+            self._invalidate_prompt_prefix()
             for rel_path in relative_paths_to_remove:
                 self._file_summaries_for_display.pop(rel_path, None)
 
@@ -439,15 +569,20 @@ class ChatModel(QObject):
                 github_manager=None,
                 rag_enabled=self._rag_enabled,
                 semantic_search_enabled=self._semantic_search_enabled,
+                retrieval_mode=self._retrieval_mode,
                 gemini_api_key=self._gemini_api_key,
                 model_name=self._model_name,
-                app_lang=self._app_language
+                app_lang=self._app_language,
+                max_workers=self._analysis_concurrency,
+                cache=self._get_analysis_cache(),
+                processes=self._analysis_processes
             )
             self._analysis_worker.moveToThread(self._analysis_thread)
             self._analysis_worker.context_data_ready.connect(self._on_context_data_ready)
             self._analysis_worker.file_summarized.connect(self._on_file_summarized)
             self._analysis_worker.progress_updated.connect(self.analysisProgressUpdated)
             self._analysis_worker.error_occurred.connect(self.analysisError)
+            self._analysis_worker.cache_stats_ready.connect(self._on_cache_stats_ready)
             self._analysis_thread.started.connect(self._analysis_worker.run)
             self._analysis_worker.finished.connect(self._on_analysis_finished)
             self._analysis_worker.finished.connect(self._analysis_thread.quit)
@@ -465,26 +600,119 @@ class ChatModel(QObject):
 
     @Slot(list)
     def _on_context_data_ready(self, context_data_batch: List[Dict[str, Any]]):
-        self._project_context.extend(context_data_batch)
+        self._project_context.add(context_data_batch)
+        self._keyword_overlay.add(context_data_batch)
+        self._session_changes.context_added(context_data_batch)
+        self._invalidate_prompt_prefix()
         self._mark_dirty()
 
+    @property
+    def _vector_index(self) -> VectorIndex:
+        """Эмбеддинги чанков для семантического поиска (одна матрица на весь контекст проекта)."""
+        return self._project_context.vector_index
+
+    def _restore_vector_index(self, filepath: str, items: List[Dict[str, Any]]) -> VectorIndex:
+        """
+        Собирает векторный индекс из эмбеддингов чанков сессии (в файле они хранятся только вместе с чанками)
+        и восстанавливает сохраненные кластеры IVF, если они есть. Для ленивой сессии индекс остается пустым.
+        """
+        index = VectorIndex()
+        index.configure_ann(self._ann_enabled, self._ann_nprobe)
+        if self._deferred_vector_source: return index
+        started = time.perf_counter()
+        self._add_chunk_vectors(index, [item for item in items if item.get('type') == 'chunk'])
+        if not len(index): return index
+        logger.info(f"Векторный индекс собран: {len(index)} векторов за {(time.perf_counter() - started) * 1000:.1f} мс.")
+        self._restore_ann_state(index, filepath)
+        return index
+
+    def _ensure_vector_index(self):
+        """
+        Собирает векторный индекс ленивой сессии: читает из файла эмбеддинги загруженных с ним чанков.
+        Чанки, добавленные или переанализированные после открытия, уже в индексе (у них нет 'row_id').
+        Вызывается перед семантическим поиском и полной перезаписью файла.
+        """
+        filepath = self._deferred_vector_source
+        if not filepath: return
+        self._deferred_vector_source = None
+        started = time.perf_counter()
+        index = self._vector_index
+        pending = [item for item in self._project_context.of_type('chunk') if 'row_id' in item and chunk_key(item) not in index]
+        vectors, has_legacy = db_manager.load_chunk_embeddings(filepath, [item['row_id'] for item in pending])
+        rows = [item for item in pending if item['row_id'] in vectors]
+        try:
+            index.add([chunk_key(item) for item in rows], [vectors[item['row_id']] for item in rows])
+        except ValueError as e:
+            logger.error(f"Не удалось добавить эмбеддинги в векторный индекс: {e}")
+        if has_legacy:
+            logger.info("Эмбеддинги сессии хранятся в старом формате (np.save) и будут сконвертированы при сохранении.")
+            self._session_changes.require_full_save()
+        if not len(index): return
+        logger.info(f"Векторный индекс ленивой сессии собран: {len(index)} векторов за {(time.perf_counter() - started) * 1000:.1f} мс.")
+        self._restore_ann_state(index, filepath)
+
+    def _restore_ann_state(self, index: VectorIndex, filepath: str):
+        state = db_manager.load_vector_index_state(filepath)
+        if not state: return
+        try:
+            index.restore_state(state)
+            logger.info(f"Кластеры IVF векторного индекса загружены из сессии: {state['ann_nlist']}.")
+        except (ValueError, KeyError, TypeError) as e:
+            logger.warning(f"Не удалось восстановить кластеры IVF из сессии: {e}. Они будут обучены заново при поиске.")
+
+    def _add_chunk_vectors(self, index: VectorIndex, rows: List[Dict[str, Any]]):
+        try:
+            index.add([chunk_key(row) for row in rows], [row.get('embedding') for row in rows])
+        except ValueError as e:
+            logger.error(f"Не удалось добавить эмбеддинги в векторный индекс: {e}")
+
+    def _ensure_context_loaded(self, items: List[Dict[str, Any]]):
+        """Догружает из файла сессии текст элементов, отложенный при ленивой загрузке."""
+        if not self._lazy_context_source: return
+        pending = [item for item in items if item.get('content') is None and 'row_id' in item]
+        if not pending: return
+        started = time.perf_counter()
+        contents = db_manager.load_context_contents(self._lazy_context_source, [item['row_id'] for item in pending])
+        for item in pending:
+            item['content'] = contents.get(item['row_id'], "")
+        logger.info(f"Догружен текст {len(pending)} фрагментов за {(time.perf_counter() - started) * 1000:.1f} мс.")
+
+    def _materialize_lazy_context(self):
+        """
+        Полностью загружает ленивую сессию (нужно перед полной перезаписью файла).
+        Догружается только текст: эмбеддинги уже в векторном индексе, из него они и записываются.
+        """
+        if not self._lazy_context_source: return
+        self._ensure_context_loaded(list(self._project_context))
+        self._lazy_context_source = None
+        logger.info("Ленивая сессия полностью загружена в память.")
+
     @Slot(str, str)
     def _on_file_summarized(self, file_path: str, summary: str):
         self._file_summaries_for_display[file_path] = summary
         self.fileSummariesChanged.emit(self._file_summaries_for_display)
 
+    @Slot(int, int)
+    def _on_cache_stats_ready(self, hits: int, misses: int):
+        self._last_cache_stats = (hits, misses)
+
     @Slot()
     def _on_analysis_finished(self):
+        cache_info = ""
+        if self._last_cache_stats:
+            cache_info = " " + self.tr("Кэш: попаданий {0}, промахов {1}.").format(*self._last_cache_stats)
+            self._last_cache_stats = None
+
         if self._is_partial_update and self._last_updated_files:
             files_str = ", ".join(self._last_updated_files)
             msg = self.tr("[Система]: Контекст был обновлен для следующих файлов: {0}").format(files_str)
             self.add_system_message(msg)
-            self.statusMessage.emit(self.tr("Обновление контекста завершено."), 5000)
+            self.statusMessage.emit(self.tr("Обновление контекста завершено.") + cache_info, 5000)
             # Сбрасываем флаги
             self._is_partial_update = False
             self._last_updated_files = []
         else:
-            self.statusMessage.emit(self.tr("Анализ проекта завершен."), 5000)
+            self.statusMessage.emit(self.tr("Анализ проекта завершен.") + cache_info, 5000)
 
         self.analysisFinished.emit()
         self.fileSummariesChanged.emit(self._file_summaries_for_display)
@@ -508,12 +736,20 @@ class ChatModel(QObject):
 
         self.statusMessage.emit(self.tr("Отправка запроса ({0} т.)...").format(self._current_prompt_tokens), 0)
 
+        prompt_token_budget = CONTEXT_WINDOW_LIMIT - self._max_output_tokens
+        count_prompt_tokens = (self._token_estimator.needs_calibration()
+                               or self._current_prompt_tokens >= prompt_token_budget * TOKEN_ESTIMATE_VERIFY_THRESHOLD)
         self._gemini_worker = GeminiWorker(
             api_key=self._gemini_api_key,
             model_name=self._model_name,
             prompt_parts=final_prompt_parts,
             max_output_tokens=self._max_output_tokens,
+            count_prompt_tokens=count_prompt_tokens,
+            stream=self._stream_responses,
         )
+        self._gemini_worker.prompt_tokens_counted.connect(self._on_prompt_tokens_counted)
+        self._gemini_worker.chunk_received.connect(self.apiResponseChunkReceived)
+        self._gemini_worker.first_token_received.connect(self._on_first_token_received)
         self._gemini_worker.response_received.connect(self._on_api_response_received)
         self._gemini_worker.error_occurred.connect(self._handle_final_api_error)
         self._gemini_worker.finished_work.connect(self.apiRequestFinished)
@@ -538,24 +774,9 @@ class ChatModel(QObject):
             cleaned_parts = [str(p) for p in msg.get("parts", []) if p is not None]
             return {"role": msg["role"], "parts": cleaned_parts}
 
-        def _count_tokens_helper(parts_list: List[Dict[str, Any]]) -> Optional[int]:
-            if not parts_list: return 0
-            try:
-                temp_model = genai.GenerativeModel(self._model_name)
-                # API Gemini требует чередования ролей для count_tokens
-                temp_prompt = []
-                last_role = None
-                for msg in parts_list:
-                    if not msg.get("role") or not msg.get("parts"): continue
-                    if last_role == msg["role"] and len(temp_prompt) > 0:
-                        temp_prompt[-1] = clean_message(msg)
-                    else:
-                        temp_prompt.append(clean_message(msg))
-                        last_role = msg["role"]
-                return temp_model.count_tokens(temp_prompt).total_tokens
-            except Exception as e:
-                logger.warning(self.tr("Ошибка при подсчете токенов: {0}. Использование грубой оценки.").format(e))
-                return sum(len(p) for msg in parts_list for p in msg.get("parts", [])) // 4
+        # Локальная оценка токенов: сообщения истории берут ее из кэша в своих словарях
+        estimator = self._token_estimator
+        raw_total = 0.0
 
         # --- Начало сборки ---
         self.apiIntermediateStep.emit(self.tr("Подготовка промпта..."))
@@ -564,35 +785,31 @@ class ChatModel(QObject):
         prompt_token_budget = CONTEXT_WINDOW_LIMIT - self._max_output_tokens
         current_tokens = 0
 
-        # --- НОВЫЙ ШАГ: Сборка карты проекта (Code Graph) ---
-        project_structure_map = self._build_project_structure_map()
-        # --- КОНЕЦ НОВОГО ШАГА ---
+        # Неизменная между ходами часть: инструкции с картой проекта (Code Graph) и блоки контекста
+        prefix = self._get_prompt_prefix()
 
         # 1. Системные инструкции
-        instructions_text = self._build_system_instructions(project_structure_map)
-        instructions_part = [
-            {"role": "user", "parts": [instructions_text]},
-            {"role": "model", "parts": [self.tr("OK. Я готов к работе.")]}
-        ]
-        instr_tokens = _count_tokens_helper(instructions_part)
-        if instr_tokens is None or current_tokens + instr_tokens >= prompt_token_budget:
+        instructions_part = [{"role": m["role"], "parts": list(m["parts"])} for m in prefix["instructions_part"]]
+        instr_raw = prefix["instructions_raw"]
+        instr_tokens = estimator.tokens(instr_raw)
+        if current_tokens + instr_tokens >= prompt_token_budget:
             self.apiErrorOccurred.emit(self.tr("Системные инструкции слишком длинные.")); return []
-        final_prompt_parts.extend(instructions_part); current_tokens += instr_tokens
+        final_prompt_parts.extend(instructions_part); current_tokens += instr_tokens; raw_total += instr_raw
 
         # 2. Контекст проекта (саммари и чанки)
-        context_str = self._build_context_string(prompt_token_budget - current_tokens)
+        context_str, context_str_raw = self._build_context_string(prompt_token_budget - current_tokens, prefix)
         if context_str:
             context_part = [
                 {"role": "user", "parts": [self.tr("**Контекст из файлов проекта:**\n{0}").format(context_str)]},
                 {"role": "model", "parts": [self.tr("OK. Контекст получен.")]}
             ]
-            context_tokens = _count_tokens_helper(context_part)
-            if context_tokens and current_tokens + context_tokens < prompt_token_budget:
-                final_prompt_parts.extend(context_part); current_tokens += context_tokens
+            context_raw = context_str_raw + prefix["context_wrapper_raw"]
+            context_tokens = estimator.tokens(context_raw)
+            if current_tokens + context_tokens < prompt_token_budget:
+                final_prompt_parts.extend(context_part); current_tokens += context_tokens; raw_total += context_raw
             else:
                 self.apiIntermediateStep.emit(self.tr("Контекст проекта частично урезан из-за лимита токенов."))
 
-        # 3. История чата
         # 3. История чата
         history_to_consider = self._chat_history[:-1]
         history_part = []
@@ -605,10 +822,11 @@ class ChatModel(QObject):
                 message_for_api["role"] = "user"
             # --- КОНЕЦ НОВОЙ ЛОГИКИ ---
 
-            message_tokens = _count_tokens_helper([message_for_api])
-            if message_tokens and current_tokens + message_tokens <= prompt_token_budget:
+            message_raw = estimator.raw_message(message) # Кэшируется в записи истории
+            message_tokens = estimator.tokens(message_raw)
+            if current_tokens + message_tokens <= prompt_token_budget:
                 history_part.insert(0, message_for_api)
-                current_tokens += message_tokens
+                current_tokens += message_tokens; raw_total += message_raw
             else:
                 self.apiIntermediateStep.emit(self.tr("Часть истории чата исключена из-за лимита токенов."))
                 break
@@ -617,14 +835,16 @@ class ChatModel(QObject):
         # 4. Последний запрос пользователя
         last_user_message = self._chat_history[-1]
         cleaned_last_message = clean_message(last_user_message)
-        last_message_tokens = _count_tokens_helper([cleaned_last_message])
-        if not last_message_tokens or (current_tokens + last_message_tokens > prompt_token_budget):
+        last_message_raw = estimator.raw_message(last_user_message)
+        last_message_tokens = estimator.tokens(last_message_raw)
+        if current_tokens + last_message_tokens > prompt_token_budget:
             self.apiErrorOccurred.emit(self.tr("Недостаточно места для вашего запроса. Попробуйте исключить сообщения из истории.")); return []
-        final_prompt_parts.append(cleaned_last_message); current_tokens += last_message_tokens
+        final_prompt_parts.append(cleaned_last_message); current_tokens += last_message_tokens; raw_total += last_message_raw
 
-        # 5. Финальная очистка и подсчет
+        # 5. Финальная очистка и подсчет (сумма оценок частей; точное значение придет от API)
         final_cleaned_messages = self._cleanup_roles(final_prompt_parts)
-        self._current_prompt_tokens = _count_tokens_helper(final_cleaned_messages) or 0
+        self._current_prompt_raw_tokens = raw_total
+        self._current_prompt_tokens = current_tokens
         self.tokenCountUpdated.emit(self._current_prompt_tokens, CONTEXT_WINDOW_LIMIT)
 
         return final_cleaned_messages
@@ -689,7 +909,7 @@ class ChatModel(QObject):
         Собирает текстовое представление структуры проекта (Code Graph)
         из данных, полученных от AST-парсера.
         """
-        structure_items = [item for item in self._project_context if item.get('type') == 'structure']
+        structure_items = self._project_context.of_type('structure')
         if not structure_items:
             return ""
 
@@ -731,92 +951,247 @@ class ChatModel(QObject):
         output_lines.append("\n--- Конец обзора структуры ---")
         return "\n".join(output_lines)
 
-    def _build_context_string(self, remaining_budget_tokens: int) -> str:
+    def _get_prompt_prefix(self) -> Dict[str, Any]:
         """
-        Собирает строку контекста проекта, используя либо семантический поиск, либо полный контекст.
+        Возвращает неизменную между ходами часть промпта из кэша или собирает ее заново.
+        Кэш действителен, пока не изменились контекст проекта (версия), инструкции или настройки.
         """
-        if not self._project_context or not self.get_chat_history(): return ""
+        key = (self._prompt_context_version, self._instructions, self._rag_enabled,
+               self._semantic_search_enabled, self._app_language)
+        prefix = self._prompt_prefix_cache.get(key)
+        if prefix is not None:
+            logger.info(
+                f"Префикс промпта взят из кэша (сэкономлено ~{self._prompt_prefix_cache.last_build_seconds() * 1000:.1f} мс, "
+                f"всего {self._prompt_prefix_cache.seconds_saved * 1000:.1f} мс; "
+                f"попаданий {self._prompt_prefix_cache.hit_rate():.0%})."
+            )
+            return prefix
 
-        last_user_message = self.get_chat_history()[-1]["parts"][0]
+        started = time.perf_counter()
+        instructions_text = self._build_system_instructions(self._build_project_structure_map())
+        instructions_part = [
+            {"role": "user", "parts": [instructions_text]},
+            {"role": "model", "parts": [self.tr("OK. Я готов к работе.")]}
+        ]
+        context_wrapper_part = [
+            {"role": "user", "parts": [self.tr("**Контекст из файлов проекта:**\n{0}").format("")]},
+            {"role": "model", "parts": [self.tr("OK. Контекст получен.")]}
+        ]
 
-        # --- Шаг 1: Разделяем контекст на саммари и чанки ---
-        all_summaries = [item for item in self._project_context if item['type'] == 'summary']
-        all_chunks = [item for item in self._project_context if item['type'] == 'chunk']
+        all_summaries = self._project_context.of_type('summary')
+        all_chunks = self._project_context.of_type('chunk')
+        prefix = {
+            "instructions_part": instructions_part,
+            "instructions_raw": self._token_estimator.raw_messages(instructions_part),
+            "context_wrapper_raw": self._token_estimator.raw_messages(context_wrapper_part),
+            "summaries": PromptTextBlock([self._format_context_item(item) for item in all_summaries] if self._rag_enabled else []),
+            "all_chunks": all_chunks,
+            "static_items": None, # Собирается по требованию в _get_static_context_block()
+        }
+        elapsed = time.perf_counter() - started
+        self._prompt_prefix_cache.put(key, prefix, elapsed)
+        logger.info(f"Префикс промпта собран заново за {elapsed * 1000:.1f} мс (попаданий в кэш {self._prompt_prefix_cache.hit_rate():.0%}).")
+        return prefix
+
+    def _get_static_context_block(self, prefix: Dict[str, Any]) -> PromptTextBlock:
+        """Все чанки (RAG без семантического поиска) или все файлы целиком (без RAG), отформатированные один раз."""
+        if prefix["static_items"] is None:
+            if self._rag_enabled:
+                items = prefix["all_chunks"]
+            else:
+                items = self._project_context.of_type('full_file')
+            self._ensure_context_loaded(items)
+            prefix["static_items"] = PromptTextBlock([self._format_context_item(item) for item in items])
+        return prefix["static_items"]
+
+    def _format_context_item(self, item: Dict[str, Any]) -> str:
+        if item['type'] == 'summary':
+            header = self.tr("--- Обзор файла: {0} ---\n").format(item['file_path'])
+        elif item['type'] == 'chunk':
+            header = self.tr("--- Фрагмент ({0}) из файла: {1} ---\n").format(item.get('chunk_num', 0), item['file_path'])
+        else: # full_file
+            header = self.tr("--- Содержимое файла: {0} ---\n").format(item['file_path'])
+        return header + item['content'] + "\n\n"
+
+    def _invalidate_prompt_prefix(self):
+        """Вызывается при любом изменении контекста проекта."""
+        self._prompt_context_version += 1
+
+    def _build_context_string(self, remaining_budget_tokens: int, prefix: Dict[str, Any]) -> Tuple[str, float]:
+        """
+        Собирает строку контекста проекта, используя либо поиск релевантных фрагментов
+        (см. _find_relevant_chunk_keys), либо полный контекст.
+        Возвращает строку и ее оценку в токенах без калибровки (см. TokenEstimator).
+        """
+        if not self._project_context or not self.get_chat_history(): return "", 0.0
 
-        relevant_items = []
+        last_user_message = self.get_chat_history()[-1]["parts"][0]
+        all_chunks = prefix["all_chunks"]
 
-        # --- Шаг 2: Выбираем чанки ---
-        if self._rag_enabled and self._semantic_search_enabled and all_chunks:
-            self.apiIntermediateStep.emit(self.tr("Выполняется семантический поиск релевантных фрагментов..."))
+        # --- Шаг 1: Выбираем чанки ---
+        relevant_block: Optional[PromptTextBlock] = None
+        if self._fragment_search_enabled() and all_chunks:
             top_n = 10 # Количество самых релевантных чанков для включения
 
             try:
-                # Получаем эмбеддинг для запроса пользователя
-                query_embedding_result = genai.embed_content(
-                    model='models/text-embedding-004',
-                    content=last_user_message,
-                    task_type="RETRIEVAL_QUERY"
-                )
-                query_embedding = np.array(query_embedding_result['embedding'])
-
-                # Рассчитываем косинусное сходство
-                chunk_embeddings = np.array([chunk['embedding'] for chunk in all_chunks])
-                similarities = np.dot(chunk_embeddings, query_embedding) / (np.linalg.norm(chunk_embeddings, axis=1) * np.linalg.norm(query_embedding))
-
-                # Получаем индексы топ-N самых похожих чанков
-                top_indices = np.argsort(similarities)[-top_n:][::-1]
-
-                relevant_chunks = [all_chunks[i] for i in top_indices]
-                relevant_items.extend(relevant_chunks)
-                self.apiIntermediateStep.emit(self.tr("Найдено {0} релевантных фрагментов кода.").format(len(relevant_chunks)))
+                found_chunks = (self._project_context.get_chunk(key) for key in self._find_relevant_chunk_keys(last_user_message, top_n))
+                relevant_chunks = [chunk for chunk in found_chunks if chunk is not None]
+                if relevant_chunks:
+                    self._ensure_context_loaded(relevant_chunks)
+                    relevant_block = PromptTextBlock([self._format_context_item(item) for item in relevant_chunks])
+                    self.apiIntermediateStep.emit(self.tr("Найдено {0} релевантных фрагментов кода.").format(len(relevant_chunks)))
+                else:
+                    # Ни одно слово вопроса не встретилось в контексте - добавляем все чанки
+                    self.apiIntermediateStep.emit(self.tr("Подходящих фрагментов не найдено, добавляются все фрагменты кода..."))
+                    relevant_block = self._get_static_context_block(prefix)
 
             except Exception as e:
-                self.apiIntermediateStep.emit(self.tr("Ошибка семантического поиска: {0}").format(e))
-                logger.error(f"Ошибка семантического поиска: {e}", exc_info=True)
+                self.apiIntermediateStep.emit(self.tr("Ошибка поиска релевантных фрагментов: {0}").format(e))
+                logger.error(f"Ошибка поиска релевантных фрагментов ({self._retrieval_mode}): {e}", exc_info=True)
                 # В случае ошибки, откатываемся к использованию всех чанков
-                relevant_items.extend(all_chunks)
+                relevant_block = self._get_static_context_block(prefix)
 
-        elif self._rag_enabled: # RAG включен, но семантический поиск выключен
+        elif self._rag_enabled: # RAG включен, но поиск фрагментов выключен
             self.apiIntermediateStep.emit(self.tr("Добавление всех фрагментов кода в контекст..."))
-            relevant_items.extend(all_chunks)
+            relevant_block = self._get_static_context_block(prefix)
         else: # RAG выключен
-             full_files = [item for item in self._project_context if item['type'] == 'full_file']
-             relevant_items.extend(full_files)
+            relevant_block = self._get_static_context_block(prefix)
 
-        # --- Шаг 3: Собираем финальную строку ---
-        context_parts = []
+        # --- Шаг 2: Собираем финальную строку ---
         char_budget = remaining_budget_tokens * 4 # Грубая оценка
-        current_len = 0
 
-        # Сначала всегда добавляем все саммари
-        if self._rag_enabled:
-            for summary in all_summaries:
-                header = self.tr("--- Обзор файла: {0} ---\n").format(summary['file_path'])
-                text = header + summary['content'] + "\n\n"
-                if current_len + len(text) <= char_budget:
-                    context_parts.append(text); current_len += len(text)
-                else: break
+        # Сначала всегда добавляем все саммари (пока помещаются)
+        summaries_text, summaries_len, summaries_raw = prefix["summaries"].take(char_budget)
 
         # Затем добавляем релевантные чанки/файлы
-        for item in relevant_items:
-            if item['type'] == 'chunk':
-                header = self.tr("--- Фрагмент ({0}) из файла: {1} ---\n").format(item.get('chunk_num', 0), item['file_path'])
-            else: # full_file
-                header = self.tr("--- Содержимое файла: {0} ---\n").format(item['file_path'])
-
-            text = header + item['content'] + "\n\n"
-            if current_len + len(text) <= char_budget:
-                context_parts.append(text); current_len += len(text)
-            else:
-                self.apiIntermediateStep.emit(self.tr("Часть контекста урезана из-за лимита токенов."))
-                break
+        items_text, _, items_raw = relevant_block.take(char_budget - summaries_len)
+        if not relevant_block.fits(char_budget - summaries_len):
+            self.apiIntermediateStep.emit(self.tr("Часть контекста урезана из-за лимита токенов."))
+
+        return summaries_text + items_text, summaries_raw + items_raw
+
+    def _fragment_search_enabled(self) -> bool:
+        """
+        Отбираются ли фрагменты под вопрос. Поиску по ключевым словам нужен только RAG
+        (чанки и их текст); семантическому и гибридному - еще и включенный семантический поиск (эмбеддинги).
+        """
+        if not self._rag_enabled: return False
+        return self._semantic_search_enabled or not retrieval_uses_embeddings(self._retrieval_mode)
+
+    def _find_relevant_chunk_keys(self, query: str, top_n: int) -> List[Tuple[str, int]]:
+        """
+        Ключи (file_path, chunk_num) наиболее релевантных вопросу чанков согласно режиму отбора:
+        семантический (эмбеддинг вопроса через API), по ключевым словам (BM25, без сети)
+        или гибридный (оба списка, объединенные reciprocal rank fusion).
+        """
+        if self._retrieval_mode == "keyword":
+            self.apiIntermediateStep.emit(self.tr("Поиск релевантных фрагментов по ключевым словам..."))
+            return self._keyword_search(query, top_n)
 
-        return "".join(context_parts)
+        self.apiIntermediateStep.emit(self.tr("Выполняется семантический поиск релевантных фрагментов..."))
+        if self._retrieval_mode == "semantic":
+            return self._semantic_search(query, top_n)
+
+        candidates = top_n * HYBRID_CANDIDATES_FACTOR
+        keyword_keys = self._keyword_search(query, candidates)
+        try:
+            semantic_keys = self._semantic_search(query, candidates)
+        except Exception as e:
+            # Без сети гибридный поиск работает как поиск по ключевым словам
+            logger.warning(f"Гибридный поиск: семантическая часть недоступна ({e}), используются только ключевые слова.")
+            return keyword_keys[:top_n]
+        return fuse_rankings([semantic_keys, keyword_keys])[:top_n]
+
+    def _semantic_search(self, query: str, top_n: int) -> List[Tuple[str, int]]:
+        # Получаем эмбеддинг для запроса пользователя
+        query_embedding_result = genai.embed_content(
+            model=EMBEDDING_MODEL,
+            content=query,
+            task_type="RETRIEVAL_QUERY"
+        )
+        query_embedding = np.array(query_embedding_result['embedding'])
+
+        self._ensure_vector_index()
+        if not len(self._vector_index):
+            raise ValueError(self.tr("векторный индекс пуст (нет эмбеддингов чанков)"))
+
+        # Топ-N по косинусному сходству через векторный индекс
+        search_started = time.perf_counter()
+        keys = [key for key, _ in self._vector_index.search(query_embedding, top_n)]
+        search_mode = "IVF" if self._vector_index.uses_ann() else "точный"
+        logger.info(f"Семантический поиск ({search_mode}) по {len(self._vector_index)} векторам: {(time.perf_counter() - search_started) * 1000:.1f} мс.")
+        return keys
+
+    def _keyword_search(self, query: str, top_n: int) -> List[Tuple[str, int]]:
+        """
+        Поиск чанков BM25 по словам вопроса. Основной индекс - context_fts в файле сессии;
+        элементы, которых в файле еще нет (или все элементы несохраненной сессии),
+        ищутся во временном индексе в памяти, удаленные из контекста файлы отбрасываются.
+        Результаты двух индексов объединяются по местам в списках (fuse_rankings).
+        """
+        match_query = build_match_query(query)
+        if not match_query: return []
+        started = time.perf_counter()
+
+        source = self._session_changes.context_source()
+        file_hits = db_manager.search_context_fts(source, match_query, top_n * 2) if source else None
+        if file_hits is None:
+            source = None # Индекса в файле нет - ищем по всему контексту в памяти
+        overlay = self._get_keyword_overlay(source)
+        keys = [key for key, _ in overlay.search(match_query, top_n)]
+        if file_hits:
+            # Оценки BM25 двух индексов не сравнимы (у каждого своя статистика документов),
+            # поэтому списки объединяются по местам (reciprocal rank fusion), а не по оценкам
+            removed_files = self._session_changes.removed_files()
+            file_keys = [key for key, _ in file_hits if key[0] not in removed_files and key not in overlay]
+            keys = fuse_rankings([keys, file_keys]) if keys else file_keys
+
+        logger.info(
+            f"Поиск по ключевым словам ({'файл сессии + ' if source else ''}{len(overlay)} элементов в памяти): "
+            f"{(time.perf_counter() - started) * 1000:.1f} мс."
+        )
+        return [(file_path, chunk_num) for file_path, _, chunk_num in keys[:top_n]]
+
+    def _get_keyword_overlay(self, source: Optional[str]) -> KeywordIndex:
+        """
+        Индекс в памяти для элементов вне файла source (или для всего контекста, если source=None).
+        Он пополняется в _on_context_data_ready и содержит все элементы, добавленные после очистки
+        или загрузки контекста, - этого достаточно, когда есть файл. Целиком индекс строится только
+        без индекса в файле для контекста, загруженного из сессии (редкий случай, один раз).
+        """
+        if source is None and not self._keyword_overlay_covers_all:
+            if self._lazy_context_source:
+                logger.warning("Поиск по ключевым словам без индекса в файле: недогруженные фрагменты ленивой сессии не учитываются.")
+            started = time.perf_counter()
+            self._reset_keyword_overlay(self._project_context)
+            logger.info(f"Индекс ключевых слов в памяти: {len(self._keyword_overlay)} элементов за {(time.perf_counter() - started) * 1000:.1f} мс.")
+        return self._keyword_overlay
+
+    def _reset_keyword_overlay(self, items: Optional[Iterable[Dict[str, Any]]] = None):
+        """
+        Начинает индекс в памяти заново: с элементами items (весь текущий контекст) или пустым.
+        Пустой индекс покрывает весь контекст, только если и сам контекст пуст.
+        """
+        self._keyword_overlay.close()
+        self._keyword_overlay = KeywordIndex(items or ())
+        self._keyword_overlay_covers_all = items is not None or not len(self._project_context)
 
     @Slot(str)
     def _on_api_response_received(self, response_text: str):
-        self.add_model_response(response_text)
+        # Сначала сообщаем о завершении ответа, чтобы View убрал потоковый черновик до перерисовки истории
         self.apiResponseReceived.emit(response_text)
+        self.add_model_response(response_text)
+
+    @Slot(float)
+    def _on_first_token_received(self, seconds: float):
+        self.statusMessage.emit(self.tr("Получение ответа... Первый фрагмент через {0:.2f} с.").format(seconds), 0)
+
+    @Slot(int)
+    def _on_prompt_tokens_counted(self, actual_tokens: int):
+        """Точный подсчет от API: калибруем локальную оценку и показываем точное значение."""
+        self._token_estimator.calibrate(self._current_prompt_raw_tokens, actual_tokens)
+        self._current_prompt_tokens = actual_tokens
+        self.tokenCountUpdated.emit(self._current_prompt_tokens, CONTEXT_WINDOW_LIMIT)
 
     @Slot(str)
     def _handle_final_api_error(self, error_message: str): self.apiErrorOccurred.emit(error_message)
@@ -874,7 +1249,12 @@ class ChatModel(QObject):
         self.projectDataChanged.emit()
 
     def _clear_project_context(self):
-        self._project_context = []
+        self._project_context.clear()
+        self._reset_keyword_overlay()
+        self._lazy_context_source = None
+        self._deferred_vector_source = None
+        self._session_changes.context_cleared()
+        self._invalidate_prompt_prefix()
         self._file_summaries_for_display = {}
         self.fileSummariesChanged.emit({})
         self._mark_dirty()
@@ -882,49 +1262,107 @@ class ChatModel(QObject):
     # --- Управление историей чата ---
     def add_user_message(self, text: str):
         self._chat_history.append({"role": "user", "parts": [text], "excluded": False})
-        self._mark_dirty(); self.historyChanged.emit(self.get_chat_history())
+        self._journal_appended_message(); self.historyChanged.emit(self.get_chat_history())
 
     def add_model_response(self, text: str):
         self._chat_history.append({"role": "model", "parts": [text or ""], "excluded": False})
-        self._mark_dirty(); self.historyChanged.emit(self.get_chat_history())
+        self._journal_appended_message(); self.historyChanged.emit(self.get_chat_history())
 
     def add_system_message(self, text: str):
         """Добавляет системное сообщение в историю чата."""
         self._chat_history.append({"role": "system", "parts": [text], "excluded": False})
-        self._mark_dirty(); self.historyChanged.emit(self.get_chat_history())
+        self._journal_appended_message(); self.historyChanged.emit(self.get_chat_history())
 
     def toggle_api_exclusion(self, index: int):
         if 0 <= index < len(self._chat_history):
             self._chat_history[index]["excluded"] = not self._chat_history[index].get("excluded", False)
-            self._mark_dirty(); self.historyChanged.emit(self.get_chat_history())
+            self._session_changes.message_changed(index)
+            self._journal_exclusion_changes([index]); self.historyChanged.emit(self.get_chat_history())
 
     def toggle_all_messages_exclusion(self):
         if not self._chat_history: return
         target_exclusion_state = any(not msg.get("excluded", False) for msg in self._chat_history)
         for msg in self._chat_history:
             msg["excluded"] = target_exclusion_state
-        self._mark_dirty()
+        self._session_changes.all_messages_changed()
+        self._journal_exclusion_changes(range(len(self._chat_history)))
         self.historyChanged.emit(self.get_chat_history())
 
+    def _journal_appended_message(self):
+        index = len(self._chat_history) - 1
+        message = self._chat_history[index]
+        self._append_to_message_journal([{
+            "op": "append", "order_index": index, "role": message["role"],
+            "content": message["parts"][0], "excluded": message.get("excluded", False)
+        }])
+
+    def _journal_exclusion_changes(self, indices):
+        self._append_to_message_journal([
+            {"op": "exclude", "order_index": index, "excluded": self._chat_history[index].get("excluded", False)}
+            for index in indices
+        ])
+
+    def _append_to_message_journal(self, records: List[Dict[str, Any]]):
+        """
+        Изменение истории чата сразу дописывается в журнал файла сессии (в потоке записи):
+        при сбое приложения оно восстановится при следующей загрузке, а сохранение сессии
+        не перезаписывает историю. Если файла нет или он будет перезаписан целиком,
+        изменение ждет обычного сохранения.
+        """
+        filepath = self._current_session_filepath
+        if not records or not self._session_changes.can_journal_messages(filepath):
+            self._mark_dirty()
+            return
+        self._session_changes.messages_journaled(len(self._chat_history), [record["order_index"] for record in records])
+        self._session_writer.mark_journal_pending()
+        self._messageJournalRequested.emit(filepath, records, self._session_generation)
+
+    @Slot(str, bool, int)
+    def _on_message_journal_finished(self, filepath: str, success: bool, generation: int):
+        if success or generation != self._session_generation: return
+        # Неизвестно, какие изменения истории попали в файл: следующее сохранение перезапишет его целиком
+        logger.warning(f"Журнал истории чата не записан в '{filepath}', сессия будет сохранена целиком.")
+        self._session_changes.require_full_save()
+        self._mark_dirty()
+
     # --- Управление Сессиями ---
     def new_session(self):
+        self._finish_session_writes()
+        self._session_generation += 1
+        self._pending_save_path = None
         self._project_type, self._repo_url, self._local_path, self._repo_branch = None, None, None, None
         self._repo_object, self._available_branches = None, []
         self._chat_history = []
-        self._project_context = []
+        self._project_context.clear()
+        self._reset_keyword_overlay()
+        self._lazy_context_source = None
+        self._deferred_vector_source = None
+        self._invalidate_prompt_prefix()
         self._file_summaries_for_display = {}
-        self._current_session_filepath = None
+        self._set_session_filepath(None)
         self._extensions = tuple()
         self._model_name = "gemini-1.5-flash-latest"
         self._max_output_tokens = 65536
         self._instructions = ""
         self._rag_enabled = True
         self._semantic_search_enabled = False
+        self._ann_enabled = False
+        self._ann_nprobe = DEFAULT_ANN_NPROBE
+        self._embedding_storage = db_manager.DEFAULT_EMBEDDING_STORAGE
+        self._retrieval_mode = DEFAULT_RETRIEVAL_MODE
+        self._vector_index.configure_ann(self._ann_enabled, self._ann_nprobe)
+        self._session_changes.reset(None)
         self._is_dirty = False
 
         self.sessionLoaded.emit()
         self.statusMessage.emit(self.tr("Новая сессия создана."), 3000)
 
+    def _set_session_filepath(self, filepath: Optional[str]):
+        """Меняет текущий файл сессии; соединение с прежним файлом закрывается."""
+        if self._current_session_filepath and self._current_session_filepath != filepath:
+            db_manager.close_session(self._current_session_filepath)
+        self._current_session_filepath = filepath
+
     def get_current_session_filepath(self) -> Optional[str]:
         """Возвращает путь к текущему файлу сессии, если он есть."""
         return self._current_session_filepath
@@ -933,6 +1371,7 @@ class ChatModel(QObject):
         try:
             logger.debug(f"--- НАЧАЛО ЗАГРУЗКИ СЕССИИ: {os.path.basename(filepath)} ---")
             
+            self._finish_session_writes() # Файл мог как раз записываться
             logger.debug("Шаг 1: Вызов db_manager.load_session_data...")
             loaded_data = db_manager.load_session_data(filepath)
             if not loaded_data:
@@ -950,6 +1389,17 @@ class ChatModel(QObject):
             self._local_path = meta.get("local_path")
             self._rag_enabled = bool(meta.get("rag_enabled", True))
             self._semantic_search_enabled = bool(meta.get("semantic_search_enabled", False))
+            self._ann_enabled = bool(meta.get("ann_enabled") or False)
+            try:
+                self._ann_nprobe = max(1, min(int(meta.get("ann_nprobe")), MAX_ANN_NPROBE))
+            except (ValueError, TypeError):
+                self._ann_nprobe = DEFAULT_ANN_NPROBE
+            self._embedding_storage = meta.get("embedding_storage") or db_manager.DEFAULT_EMBEDDING_STORAGE
+            if self._embedding_storage not in db_manager.EMBEDDING_STORAGE_FORMATS:
+                self._embedding_storage = db_manager.DEFAULT_EMBEDDING_STORAGE
+            self._retrieval_mode = meta.get("retrieval_mode") or DEFAULT_RETRIEVAL_MODE
+            if self._retrieval_mode not in RETRIEVAL_MODES:
+                self._retrieval_mode = DEFAULT_RETRIEVAL_MODE
             self._model_name = meta.get("model_name", "gemini-1.5-flash-latest")
             
             try:
@@ -964,19 +1414,32 @@ class ChatModel(QObject):
             logger.debug("Шаг 2 УСПЕХ: Метаданные обработаны.")
             
             logger.debug("Шаг 3: Обработка истории и контекста.")
+            self._session_generation += 1
+            self._pending_save_path = None
             self._chat_history = msgs
-            self._project_context = context
+            self._lazy_context_source = filepath if meta.get('lazy_context') else None
+            # Векторный индекс ленивой сессии собирается при первой необходимости (см. _ensure_vector_index)
+            self._deferred_vector_source = self._lazy_context_source
+            self._project_context.load(context, self._restore_vector_index(filepath, context))
+            self._reset_keyword_overlay() # Загруженные элементы ищутся по индексу в файле
+            self._invalidate_prompt_prefix()
             
             logger.debug("Шаг 3.1: Создание словаря саммари для отображения...")
             self._file_summaries_for_display = {
-                item.get('file_path'): item.get('content') 
-                for item in self._project_context 
-                if item.get('type') == 'summary' and item.get('file_path')
+                item.get('file_path'): item.get('content')
+                for item in self._project_context.of_type('summary')
+                if item.get('file_path')
             }
             logger.debug("Шаг 3.1 УСПЕХ: Словарь саммари создан.")
             
-            self._current_session_filepath = filepath
+            self._set_session_filepath(filepath)
             self._is_dirty = False
+            # Смигрированный файл старого формата (в т.ч. с эмбеддингами np.save) при первом сохранении перезаписывается целиком
+            synced_path = None if meta.get('migrated_from_old_format') or meta.get('legacy_embeddings') else filepath
+            # Контекст смигрированного старого формата в context_data еще не записан
+            context_file = None if meta.get('migrated_from_old_format') else filepath
+            self._session_changes.reset(synced_path, len(self._chat_history), self._vector_index.version(), context_file)
+            self._update_catalog_entry(filepath)
             logger.debug("Шаг 3 УСПЕХ: История, контекст и путь к сессии установлены.")
 
             logger.debug("Шаг 4: Обработка данных проекта (GitHub).")
@@ -1001,25 +1464,206 @@ class ChatModel(QObject):
             error_message = self.tr("Произошла критическая ошибка при обработке данных сессии. См. лог-файл для деталей.")
             self.sessionError.emit(error_message)
 
-    def save_session(self, filepath: Optional[str] = None) -> Tuple[bool, Optional[str]]:
+    def save_session(self, filepath: Optional[str] = None, autosave: bool = False) -> Tuple[bool, Optional[str]]:
+        """
+        Ставит сессию в очередь на запись в фоновом потоке (см. SessionWriter).
+        Если запись уже идет, запросы объединяются: после ее окончания записывается один снимок
+        со всеми изменениями. Возвращает (True, путь), если запись запланирована.
+        Ход и окончание записи сообщаются через sessionStateChanged (см. is_saving()).
+        """
         save_path = filepath or self._current_session_filepath
         if not save_path: return False, None
 
-        metadata = {
+        if self._session_writer.is_busy():
+            self._pending_save_path = save_path
+            self._pending_save_is_autosave = autosave
+            return True, save_path
+        self._start_session_write(save_path, autosave)
+        return True, save_path
+
+    def _build_session_metadata(self) -> Dict[str, Any]:
+        return {
             "project_type": self._project_type, "repo_url": self._repo_url,
             "repo_branch": self._repo_branch, "local_path": self._local_path,
             "rag_enabled": self._rag_enabled, "model_name": self._model_name,
             "max_output_tokens": self._max_output_tokens,
             "extensions": " ".join(self._extensions), "instructions": self._instructions,
-            "semantic_search_enabled": self._semantic_search_enabled
+            "semantic_search_enabled": self._semantic_search_enabled,
+            "ann_enabled": self._ann_enabled, "ann_nprobe": self._ann_nprobe,
+            "embedding_storage": self._embedding_storage,
+            "retrieval_mode": self._retrieval_mode
         }
 
-        if db_manager.save_session_data(save_path, metadata, self._chat_history, self._project_context):
-            self._current_session_filepath = save_path; self._is_dirty = False
-            self.sessionStateChanged.emit(save_path, False)
-            self.statusMessage.emit(self.tr("Сессия сохранена."), 5000); return True, save_path
+    def _build_catalog_info(self) -> Dict[str, Any]:
+        """Метаданные и счетчики сессии для каталога сессий (см. WorkspaceCatalog)."""
+        return {
+            "project_type": self._project_type,
+            "project_source": self._repo_url if self._project_type == 'github' else self._local_path,
+            "repo_branch": self._repo_branch, "model_name": self._model_name,
+            "message_count": len(self._chat_history),
+            "file_count": len(self._project_context.file_paths()),
+            "chunk_count": len(self._project_context.of_type('chunk')),
+        }
+
+    def _update_catalog_entry(self, filepath: str):
+        """Заносит открытую сессию в каталог, если ее там нет или запись устарела (файл из другой копии приложения и т.п.)."""
+        if not self._workspace_catalog: return
+        info = self._build_catalog_info()
+        if not self._workspace_catalog.needs_update(filepath, info): return
+        self._catalogUpdateRequested.emit({
+            "filepath": filepath, "full": True, "catalog_info": info,
+            "messages": list(self._chat_history),
+            "context": self._project_context.of_type('summary') + self._project_context.of_type('structure'),
+        })
+
+    def search_sessions(self, query: str, limit: int = 50) -> List[Dict[str, Any]]:
+        """Полнотекстовый поиск по всем сессиям из каталога, не открывая их файлы."""
+        if not self._workspace_catalog: return []
+        return self._workspace_catalog.search(query, limit)
+
+    def get_catalog_sessions(self, filepaths: List[str]) -> Dict[str, Dict[str, Any]]:
+        """Записи каталога (проект, модель, счетчики, время сохранения) для указанных файлов сессий."""
+        if not self._workspace_catalog: return {}
+        return self._workspace_catalog.get_sessions(filepaths)
+
+    def _take_save_snapshot(self, save_path: str) -> Dict[str, Any]:
+        """
+        Снимок состояния для SessionWriter: только то, что нужно записать, в виде копий списков.
+        Сообщения копируются поштучно: флаг "excluded" меняется на месте (toggle_api_exclusion),
+        пока поток записи читает снимок; элементы контекста после создания не меняются. Учет изменений сразу сбрасывается -
+        все, что изменится во время записи, попадет в следующий снимок.
+        """
+        changes = self._session_changes
+        full = changes.needs_full_save(save_path) or changes.needs_context_rewrite()
+        if full:
+            self._ensure_vector_index()
+            self._materialize_lazy_context()
+        # Кластеры IVF перезаписываются при полной записи и после их переобучения
+        update_index = full or changes.vector_index_changed(self._vector_index.version())
+        snapshot_context = list(self._project_context) if full else changes.context_upserts()
+        snapshot = {
+            "filepath": save_path,
+            "generation": self._session_generation,
+            "full": full,
+            "metadata": self._build_session_metadata(),
+            "messages": [dict(message) for message in self._chat_history],
+            "message_indices": [] if full else changes.message_indices_to_save(len(self._chat_history)),
+            "context": snapshot_context,
+            "removed_files": set() if full else changes.removed_files(),
+            "update_vector_index": update_index,
+            "vector_index_state": self._vector_index.export_state() if update_index else None,
+            # Эмбеддинги пишутся вместе с чанками: при записи изменений - только для новых и измененных чанков
+            "chunk_vectors": self._vector_index.export_vectors(
+                None if full else [chunk_key(item) for item in snapshot_context if item.get('type') == 'chunk']
+            ),
+            "catalog_info": self._build_catalog_info(),
+        }
+        changes.reset(save_path, len(self._chat_history), self._vector_index.version())
+        return snapshot
+
+    def _start_session_write(self, save_path: str, autosave: bool):
+        snapshot = self._take_save_snapshot(save_path)
+        self._set_session_filepath(save_path)
+        self._is_dirty = False
+        self._saving_is_autosave = autosave
+        self._session_writer.mark_busy()
+        self.sessionStateChanged.emit(save_path, False) # is_saving() == True
+        if not autosave:
+            self.statusMessage.emit(self.tr("Сохранение сессии..."), 0)
+        self._sessionWriteRequested.emit(snapshot)
+
+    @Slot(str, bool, int)
+    def _on_session_write_finished(self, filepath: str, success: bool, generation: int):
+        if generation != self._session_generation:
+            # Сессию успели сменить: результат относится к уже закрытой сессии
+            if not success:
+                self.sessionError.emit(self.tr("Не удалось сохранить сессию: {0}").format(filepath))
+            return
+
+        if success:
+            message = self.tr("Сессия автоматически сохранена.") if self._saving_is_autosave else self.tr("Сессия сохранена.")
+            self.statusMessage.emit(message, 5000)
+        else:
+            # Неизвестно, что успело записаться: следующее сохранение перезапишет файл целиком
+            self._session_changes.require_full_save(file_unreliable=True)
+            self._is_dirty = True
+            self.sessionError.emit(self.tr("Не удалось сохранить сессию: {0}").format(filepath))
+        self._start_pending_write(filepath)
+
+    def _start_pending_write(self, filepath: str):
+        """После фоновой операции с файлом запускает отложенное сохранение или сообщает о конце записи."""
+        if self._pending_save_path:
+            pending_path, self._pending_save_path = self._pending_save_path, None
+            self._start_session_write(pending_path, self._pending_save_is_autosave)
         else:
-            self.sessionError.emit(self.tr("Не удалось сохранить сессию: {0}").format(save_path)); return False, None
+            self.sessionStateChanged.emit(filepath, self._is_dirty)
+
+    def compact_session(self) -> bool:
+        """
+        Сжимает файл текущей сессии в фоновом потоке (см. db_manager.compact_session):
+        повторяющиеся чанки хранятся один раз, освободившееся место возвращается системе.
+        Несохраненные изменения не затрагиваются. Возвращает True, если сжатие запущено.
+        """
+        filepath = self._current_session_filepath
+        if not filepath or not os.path.exists(filepath):
+            self.statusMessage.emit(self.tr("Сначала сохраните сессию в файл."), 5000)
+            return False
+        if self._session_writer.is_busy():
+            self.statusMessage.emit(self.tr("Дождитесь окончания сохранения сессии."), 3000)
+            return False
+        self._session_writer.mark_busy()
+        self.sessionStateChanged.emit(filepath, self._is_dirty) # is_saving() == True
+        self.statusMessage.emit(self.tr("Сжатие файла сессии..."), 0)
+        self._sessionCompactRequested.emit(filepath, self._session_generation)
+        return True
+
+    @Slot(str, object, int)
+    def _on_session_compact_finished(self, filepath: str, report: Optional[Dict[str, int]], generation: int):
+        if report is None:
+            self.sessionError.emit(self.tr("Не удалось сжать файл сессии: {0}").format(filepath))
+        elif generation == self._session_generation:
+            self.statusMessage.emit(
+                self.tr("Файл сессии сжат: освобождено {0:.1f} МБ ({1:.1f} -> {2:.1f} МБ), повторяющихся фрагментов: {3}.").format(
+                    report["bytes_reclaimed"] / (1024 * 1024), report["bytes_before"] / (1024 * 1024),
+                    report["bytes_after"] / (1024 * 1024), report["duplicate_chunks"]
+                ),
+                10000
+            )
+        if generation == self._session_generation:
+            self._start_pending_write(filepath)
+
+    def _on_autosave_timer(self):
+        if (self._autosave_enabled and self._is_dirty and self._current_session_filepath
+                and not self._session_writer.is_busy()):
+            self.save_session(autosave=True)
+
+    def is_saving(self) -> bool:
+        return self._session_writer.is_busy()
+
+    def get_autosave_enabled(self) -> bool: return self._autosave_enabled
+    def set_autosave_enabled(self, enabled: bool):
+        """Автосохранение - настройка приложения, а не сессии."""
+        self._autosave_enabled = bool(enabled)
+
+    def _finish_session_writes(self):
+        """Дожидается текущей фоновой записи и дозаписи журнала (перед сменой сессии или выходом)."""
+        if self._session_writer.is_busy() or self._session_writer.has_pending_journal():
+            logger.info("Ожидание окончания фоновой записи сессии...")
+            self._session_writer.wait_idle()
+
+    def shutdown(self):
+        """Завершает фоновую запись: дописывает отложенное сохранение и останавливает поток записи."""
+        self._autosave_timer.stop()
+        self._finish_session_writes()
+        self._session_writer_thread.quit()
+        self._session_writer_thread.wait()
+        if self._pending_save_path:
+            # Поток уже остановлен - последнюю запись выполняем здесь же
+            pending_path, self._pending_save_path = self._pending_save_path, None
+            self._session_writer.mark_busy()
+            self._session_writer.write(self._take_save_snapshot(pending_path))
+        if self._workspace_catalog:
+            self._workspace_catalog.close()
 
     # --- Остальные геттеры/сеттеры ---
     def get_project_type(self) -> Optional[str]: return self._project_type
@@ -1044,13 +1688,21 @@ class ChatModel(QObject):
     def get_instructions(self) -> str: return self._instructions
     def set_instructions(self, text: str):
         if text != self._instructions: self._instructions = text; self._mark_dirty()
+    def get_analysis_concurrency(self) -> int: return self._analysis_concurrency
+    def set_analysis_concurrency(self, value: int):
+        """Число файлов, анализируемых параллельно. Не влияет на состояние сессии."""
+        self._analysis_concurrency = max(1, min(int(value), MAX_ANALYSIS_CONCURRENCY))
+    def get_analysis_processes(self) -> int: return self._analysis_processes
+    def set_analysis_processes(self, value: int):
+        """Число процессов для разбора кода, чанков и документов (0 - без пула процессов). Не влияет на состояние сессии."""
+        self._analysis_processes = max(0, min(int(value), MAX_ANALYSIS_PROCESSES))
     def get_rag_enabled(self) -> bool: return self._rag_enabled
     def set_rag_enabled(self, enabled: bool):
         if enabled != self._rag_enabled: self._rag_enabled = enabled; self._mark_dirty()
     def get_chat_history(self) -> List[Dict[str, Any]]: return self._chat_history[:]
-    def get_project_context(self) -> List[Dict[str, Any]]:
-        """Возвращает текущий контекст проекта (список саммари и чанков)."""
-        return self._project_context[:]
+    def has_project_context(self) -> bool:
+        """Есть ли контекст проекта (саммари, чанки или файлы целиком)."""
+        return bool(self._project_context)
     def _mark_dirty(self):
         if not self._is_dirty: self._is_dirty = True; self.sessionStateChanged.emit(self._current_session_filepath, True)
     def is_dirty(self) -> bool: return self._is_dirty
@@ -1087,15 +1739,13 @@ class ChatModel(QObject):
         
         if not self._project_context: return None
 
-        file_items = [
-            item for item in self._project_context
-            if item.get('file_path') == file_path and item.get('type') in ('full_file', 'chunk')
-        ]
+        file_items = self._project_context.file_items(file_path, ('full_file', 'chunk'))
 
         if not file_items:
             logger.warning(f"Резервный метод не удался: контент для файла '{file_path}' в контексте не найден.")
             return None
 
+        self._ensure_context_loaded(file_items)
         if file_items[0].get('type') == 'full_file':
             return file_items[0].get('content', '')
 
@@ -1116,6 +1766,34 @@ class ChatModel(QObject):
             self._semantic_search_enabled = enabled
             self._mark_dirty()
 
+    def get_retrieval_mode(self) -> str: return self._retrieval_mode
+    def set_retrieval_mode(self, mode: str):
+        if mode in RETRIEVAL_MODES and mode != self._retrieval_mode:
+            self._retrieval_mode = mode
+            self._mark_dirty()
+
+    def get_ann_enabled(self) -> bool: return self._ann_enabled
+    def set_ann_enabled(self, enabled: bool):
+        if enabled != self._ann_enabled:
+            self._ann_enabled = enabled
+            self._vector_index.configure_ann(self._ann_enabled, self._ann_nprobe)
+            self._mark_dirty()
+
+    def get_embedding_storage(self) -> str: return self._embedding_storage
+    def set_embedding_storage(self, storage: str):
+        if storage in db_manager.EMBEDDING_STORAGE_FORMATS and storage != self._embedding_storage:
+            self._embedding_storage = storage
+            self._session_changes.require_full_save() # Эмбеддинги перекодируются в новый формат
+            self._mark_dirty()
+
+    def get_ann_nprobe(self) -> int: return self._ann_nprobe
+    def set_ann_nprobe(self, value: int):
+        value = max(1, min(int(value), MAX_ANN_NPROBE))
+        if value != self._ann_nprobe:
+            self._ann_nprobe = value
+            self._vector_index.configure_ann(self._ann_enabled, self._ann_nprobe)
+            self._mark_dirty()
+
     def save_generated_file(self, file_path: str, content: str) -> Tuple[bool, str]:
         """Saves content to a specified file path."""
         try:
@@ -1151,7 +1829,6 @@ class ChatModel(QObject):
 
     def _export_to_markdown(self) -> str:
         """Экспортирует чат в формат Markdown."""
-        from markdown import markdown as md_render
         lines = []
         for msg in self._chat_history:
             role = msg.get("role")
@@ -1173,7 +1850,7 @@ class ChatModel(QObject):
 
     def _export_to_html(self) -> str:
         """Экспортирует чат в формат HTML, используя стили приложения."""
-        from markdown import markdown as md_render
+        from markdown_renderer import render_markdown
         
         # Получаем CSS стили из шаблона чата для консистентности
         # Это грязный, но эффективный способ без дублирования кода
@@ -1210,7 +1887,7 @@ class ChatModel(QObject):
             if role == 'user':
                 content_html = f'<pre>{html.escape(content)}</pre>'
             elif role == 'model':
-                content_html = md_render(content, extensions=["fenced_code", "codehilite", "nl2br", "tables"])
+                content_html = render_markdown(content) # Общий кэш с окном чата
             elif role == 'system':
                 content_html = f'<i>{html.escape(content)}</i>'
             
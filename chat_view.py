@@ -3,7 +3,8 @@
 import os
 import json
 import logging
-from PySide6.QtCore import QObject, Slot, Signal, QUrl, QFileInfo
+from typing import Callable, Dict, Any, List, Optional, Tuple
+from PySide6.QtCore import QObject, Slot, Signal, QUrl, QFileInfo, QTimer
 from PySide6.QtWidgets import QApplication
 from PySide6.QtWebEngineWidgets import QWebEngineView
 from PySide6.QtWebChannel import QWebChannel
@@ -11,6 +12,9 @@ from PySide6.QtWebEngineCore import QWebEnginePage, QWebEngineFindTextResult
 
 logger = logging.getLogger(__name__)
 
+# Интервал, с которым фрагменты потокового ответа передаются в страницу (одним вызовом JS за кадр)
+STREAM_FLUSH_INTERVAL_MS = 50
+
 class PyBridge(QObject):
     """
     Класс-мостик между Python и JavaScript в QWebEngineView.
@@ -70,6 +74,16 @@ class ChatView(QWebEngineView):
         self.py_bridge.saveFileRequested.connect(self._view_model.saveGeneratedFileRequested)
         self.py_bridge.showDiffRequested.connect(self._view_model.showDiffRequested)
         
+        # Что сейчас отображено в DOM: (роль, текст, исключено, окончательный HTML) для каждого сообщения истории
+        self._rendered_messages: List[Tuple[str, str, bool, bool]] = []
+
+        # Буфер фрагментов потокового ответа, накопленных с последнего кадра
+        self._pending_stream_chunks = []
+        self._stream_flush_timer = QTimer(self)
+        self._stream_flush_timer.setSingleShot(True)
+        self._stream_flush_timer.setInterval(STREAM_FLUSH_INTERVAL_MS)
+        self._stream_flush_timer.timeout.connect(self._flush_stream_chunks)
+
         self._connect_viewmodel_signals()
         self.pageLoaded.connect(self._view_model.setChatViewReady)
         self.loadFinished.connect(self._on_load_finished)
@@ -85,12 +99,14 @@ class ChatView(QWebEngineView):
         logger.debug("ChatView: Подключение сигналов от ViewModel.")
         self._view_model.performSearch.connect(self._on_perform_search)
         self._view_model.clearSearchHighlight.connect(self._on_clear_search)
+        self._view_model.responseChunkReceived.connect(self.append_stream_chunk)
         self.searchResultReady.connect(self._view_model.setSearchResultStatus)
         self.page().findTextFinished.connect(self._on_find_text_finished)
 
     @Slot(bool)
     def _on_load_finished(self, ok):
         """Слот, вызываемый по завершении загрузки страницы."""
+        self._rendered_messages = [] # Новая страница - пустой DOM
         if ok:
             logger.info("ChatView: Страница HTML успешно загружена.")
             self.pageLoaded.emit()
@@ -134,17 +150,68 @@ class ChatView(QWebEngineView):
     def clear_chat(self):
         """Очищает содержимое чата (вызывает JS функцию)."""
         logger.debug("ChatView: Очистка чата (вызов JS).")
+        # Несброшенные фрагменты уже учтены в тексте, который покажет show_streaming_text()
+        self._pending_stream_chunks = []
+        self._stream_flush_timer.stop()
+        self._rendered_messages = []
         self._run_js("clearChatContent();")
 
-    def add_message(self, role: str, html_content: str, message_index: int, is_excluded: bool, is_last: bool = True):
+    def clear_transient_elements(self):
+        """Убирает промежуточные шаги, лоадер, ошибки и черновик потокового ответа, не трогая историю."""
+        self._pending_stream_chunks = []
+        self._stream_flush_timer.stop()
+        self._run_js("clearTransientElements();")
+
+    def update_messages(self, history: List[Dict[str, Any]], render_html: Callable[[Dict[str, Any]], str],
+                        is_html_final: Optional[Callable[[Dict[str, Any]], bool]] = None) -> bool:
         """
-        Добавляет отрендеренное HTML сообщение в чат.
-        Передает в JS объект с переведенными строками.
+        Приводит отображаемую историю к history, меняя только затронутые сообщения:
+        сообщения с другим статусом исключения перерисовываются на месте, начиная с первого
+        измененного сообщения хвост заменяется, новые дописываются. render_html вызывается
+        только для перерисовываемых сообщений. is_html_final(msg) сообщает, даст ли render_html
+        окончательный HTML или временную заглушку; заглушки заменяются, когда HTML готов.
+        Возвращает True, если были добавлены сообщения.
         """
-        logger.debug(f"ChatView: Добавление сообщения (роль: {role}, индекс: {message_index}, исключено: {is_excluded})")
-        
-        # Готовим словарь с переведенными текстами для JS
-        texts = {
+        new_messages = [
+            (msg.get("role"), msg.get("parts", [""])[0], bool(msg.get("excluded", False)),
+             is_html_final(msg) if is_html_final else True)
+            for msg in history
+        ]
+        old_messages = self._rendered_messages
+
+        # Общее начало (совпадают роль и текст; строки истории - те же объекты, сравнение дешевое)
+        common, patched = 0, []
+        limit = min(len(old_messages), len(new_messages))
+        while common < limit and old_messages[common][:2] == new_messages[common][:2]:
+            if old_messages[common][2:] != new_messages[common][2:]:
+                patched.append(common)
+            common += 1
+
+        texts_json = json.dumps(self._message_texts())
+        js_calls = []
+        if common < len(old_messages):
+            js_calls.append(f"truncateMessages({common});")
+        for index in patched:
+            js_calls.append(self._message_js("replaceMessage", history[index], render_html, index, texts_json))
+        for index in range(common, len(new_messages)):
+            js_calls.append(self._message_js("appendMessage", history[index], render_html, index, texts_json))
+
+        if js_calls:
+            logger.debug(f"ChatView: Обновление чата: сохранено {common - len(patched)}, перерисовано {len(patched)}, "
+                         f"удалено {len(old_messages) - common}, добавлено {len(new_messages) - common}.")
+            self._run_js("\n".join(js_calls))
+        self._rendered_messages = new_messages
+        return len(new_messages) > common
+
+    def _message_js(self, js_function: str, msg: Dict[str, Any], render_html: Callable[[Dict[str, Any]], str],
+                    index: int, texts_json: str) -> str:
+        role = msg.get("role")
+        js_is_excluded = 'true' if msg.get("excluded", False) else 'false'
+        return f'{js_function}({json.dumps(role)}, {json.dumps(render_html(msg))}, {index}, {js_is_excluded}, {texts_json});'
+
+    def _message_texts(self) -> Dict[str, str]:
+        """Переведенные строки для JS-функций построения сообщений."""
+        return {
             "user_prefix": self.tr("Вы:"),
             "model_prefix": self.tr("ИИ:"),
             "exclude_tooltip": self.tr("Исключить из контекста API"),
@@ -156,6 +223,36 @@ class ChatView(QWebEngineView):
             "save_button_text": self.tr("Сохранить как..."),
             "diff_button_text": self.tr("Показать изменения"),
         }
+
+    @Slot(str)
+    def append_stream_chunk(self, chunk: str):
+        """Дописывает фрагмент в генерируемое сообщение. Фрагменты копятся и уходят в страницу раз в кадр."""
+        self._pending_stream_chunks.append(chunk)
+        if not self._stream_flush_timer.isActive():
+            self._stream_flush_timer.start()
+
+    def show_streaming_text(self, text: str):
+        """Восстанавливает генерируемое сообщение целиком (после полной перерисовки чата)."""
+        self._pending_stream_chunks = [text]
+        self._flush_stream_chunks()
+
+    @Slot()
+    def _flush_stream_chunks(self):
+        if not self._pending_stream_chunks: return
+        text = "".join(self._pending_stream_chunks)
+        self._pending_stream_chunks = []
+        js_texts = json.dumps({"model_prefix": self.tr("ИИ:")})
+        self._run_js(f"appendStreamChunk({json.dumps(text)}, {js_texts});")
+
+    def add_message(self, role: str, html_content: str, message_index: int, is_excluded: bool, is_last: bool = True):
+        """
+        Добавляет отрендеренное HTML сообщение в чат.
+        Передает в JS объект с переведенными строками.
+        """
+        logger.debug(f"ChatView: Добавление сообщения (роль: {role}, индекс: {message_index}, исключено: {is_excluded})")
+        
+        # Готовим словарь с переведенными текстами для JS
+        texts = self._message_texts()
         
         js_safe_html = json.dumps(html_content)
         js_is_excluded = 'true' if is_excluded else 'false'
@@ -14,6 +14,7 @@ from PySide6.QtWidgets import QApplication
 from chat_model import ChatModel, CONTEXT_WINDOW_LIMIT
 import db_manager
 from network_checker import NetworkStatusChecker
+from markdown_renderer import MarkdownPrerenderWorker, MARKDOWN_PRERENDER_MIN_MESSAGES
 
 logger = logging.getLogger(__name__)
 
@@ -61,6 +62,12 @@ class ChatViewModel(QObject):
     maxTokensChanged = Signal()
     ragEnabledChanged = Signal(bool)
     semanticSearchEnabledChanged = Signal(bool)
+    annSearchChanged = Signal()
+    embeddingStorageChanged = Signal()
+    retrievalModeChanged = Signal()
+    analysisConcurrencyChanged = Signal()
+    analysisProcessesChanged = Signal()
+    autosaveEnabledChanged = Signal()
     instructionsTextChanged = Signal()
     checkedExtensionsChanged = Signal(set, str)
 
@@ -71,6 +78,7 @@ class ChatViewModel(QObject):
     isDirtyChanged = Signal()
     isChatViewReadyChanged = Signal()
     chatUpdateRequired = Signal()
+    responseChunkReceived = Signal(str) # Фрагмент генерируемого ответа для дописывания в чат
 
     # Статус-бар
     statusMessageChanged = Signal(str, int)
@@ -118,6 +126,7 @@ class ChatViewModel(QObject):
         self._is_analysis_running: bool = False
         self._last_api_error: Optional[str] = None
         self._last_api_intermediate_step: Optional[str] = None
+        self._streaming_response_parts: List[str] = [] # Уже полученные фрагменты генерируемого ответа
 
         self._settings_visible: bool = False
         self._instructions_visible: bool = True
@@ -126,6 +135,11 @@ class ChatViewModel(QObject):
         # Для отложенной загрузки сессии при запуске
         self._pending_session_load_path: Optional[str] = None
 
+        # Фоновый рендеринг markdown загруженной сессии
+        self._markdown_prerender_enabled: bool = True
+        self._markdown_prerender_worker: Optional[MarkdownPrerenderWorker] = None
+        self._markdown_prerender_threads: List[QThread] = [] # Включая отмененные, пока они не завершились
+
         self._connect_model_signals()
         self._on_session_loaded() # Первичная инициализация
 
@@ -161,6 +175,7 @@ class ChatViewModel(QObject):
         # API запросы
         self._model.apiRequestStarted.connect(self._on_api_request_started)
         self._model.apiResponseReceived.connect(self._on_api_response_received)
+        self._model.apiResponseChunkReceived.connect(self._on_api_response_chunk_received)
         self._model.apiIntermediateStep.connect(self._on_api_intermediate_step)
         self._model.apiErrorOccurred.connect(self._on_api_error_occurred)
         self._model.apiRequestFinished.connect(self._on_api_request_finished)
@@ -213,6 +228,20 @@ class ChatViewModel(QObject):
     def ragEnabled(self) -> bool: return self._model.get_rag_enabled()
     @Property(bool, notify=semanticSearchEnabledChanged)
     def semanticSearchEnabled(self) -> bool: return self._model.get_semantic_search_enabled()
+    @Property(bool, notify=annSearchChanged)
+    def annEnabled(self) -> bool: return self._model.get_ann_enabled()
+    @Property(int, notify=annSearchChanged)
+    def annNprobe(self) -> int: return self._model.get_ann_nprobe()
+    @Property(str, notify=embeddingStorageChanged)
+    def embeddingStorage(self) -> str: return self._model.get_embedding_storage()
+    @Property(str, notify=retrievalModeChanged)
+    def retrievalMode(self) -> str: return self._model.get_retrieval_mode()
+    @Property(int, notify=analysisConcurrencyChanged)
+    def analysisConcurrency(self) -> int: return self._model.get_analysis_concurrency()
+    @Property(int, notify=analysisProcessesChanged)
+    def analysisProcesses(self) -> int: return self._model.get_analysis_processes()
+    @Property(bool, notify=autosaveEnabledChanged)
+    def autosaveEnabled(self) -> bool: return self._model.get_autosave_enabled()
 
     # --- Общие свойства ---
     @Property(bool, notify=isDirtyChanged)
@@ -225,7 +254,8 @@ class ChatViewModel(QObject):
                         if session_path
                         else self.tr("Новая сессия"))
         dirty_indicator = "*" if self._model.is_dirty() else ""
-        return f"{base_title} - {session_name}{dirty_indicator}"
+        saving_indicator = self.tr(" (сохранение...)") if self._model.is_saving() else ""
+        return f"{base_title} - {session_name}{dirty_indicator}{saving_indicator}"
 
     # --- Свойства состояния кнопок ---
     @Property(bool, notify=canSendChanged)
@@ -267,7 +297,7 @@ class ChatViewModel(QObject):
         """
         return (
             self._model.is_git_repo() and
-            bool(self._model.get_project_context()) and # Обновлять можно только существующий контекст
+            self._model.has_project_context() and # Обновлять можно только существующий контекст
             not self._is_analysis_running and
             not self._is_request_running
         )
@@ -296,6 +326,19 @@ class ChatViewModel(QObject):
                 self._last_api_error,
                 self._last_api_intermediate_step)
 
+    def getStreamingResponseText(self) -> str:
+        """Часть ответа, полученная к текущему моменту (пусто, если ответ не генерируется)."""
+        return "".join(self._streaming_response_parts)
+
+    # --- Методы для каталога сессий ---
+    def searchSessions(self, query: str) -> List[Dict[str, Any]]:
+        """Сессии, в сообщениях, саммари или структуре файлов которых встречается запрос."""
+        return self._model.search_sessions(query)
+
+    def getSessionsInfo(self, filepaths: List[str]) -> Dict[str, Dict[str, Any]]:
+        """Сведения каталога о файлах сессий (для подсказок в списке недавних проектов)."""
+        return self._model.get_catalog_sessions(filepaths)
+
     # --- Слоты для команд от View ---
 
     @Slot(str, str)
@@ -395,6 +438,45 @@ class ChatViewModel(QObject):
     def updateRagEnabled(self, enabled: bool): self._model.set_rag_enabled(enabled)
     @Slot(bool)
     def updateSemanticSearchEnabled(self, enabled: bool): self._model.set_semantic_search_enabled(enabled)
+    @Slot(bool)
+    def updateAnnEnabled(self, enabled: bool):
+        if enabled != self._model.get_ann_enabled():
+            self._model.set_ann_enabled(enabled)
+            self.annSearchChanged.emit()
+    @Slot(int)
+    def updateAnnNprobe(self, value: int):
+        if value != self._model.get_ann_nprobe():
+            self._model.set_ann_nprobe(value)
+            self.annSearchChanged.emit()
+    @Slot(str)
+    def updateEmbeddingStorage(self, storage: str):
+        if storage != self._model.get_embedding_storage():
+            self._model.set_embedding_storage(storage)
+            self.embeddingStorageChanged.emit()
+    @Slot(str)
+    def updateRetrievalMode(self, mode: str):
+        if mode and mode != self._model.get_retrieval_mode():
+            self._model.set_retrieval_mode(mode)
+            self.retrievalModeChanged.emit()
+    @Slot(int)
+    def updateAnalysisConcurrency(self, value: int):
+        if value != self._model.get_analysis_concurrency():
+            self._model.set_analysis_concurrency(value)
+            self.analysisConcurrencyChanged.emit()
+    @Slot(int)
+    def updateAnalysisProcesses(self, value: int):
+        if value != self._model.get_analysis_processes():
+            self._model.set_analysis_processes(value)
+            self.analysisProcessesChanged.emit()
+    @Slot(bool)
+    def updateAutosaveEnabled(self, enabled: bool):
+        if enabled != self._model.get_autosave_enabled():
+            self._model.set_autosave_enabled(enabled)
+            self.autosaveEnabledChanged.emit()
+
+    def shutdown(self):
+        """Вызывается при закрытии окна: дописывает сессию и останавливает фоновые потоки модели."""
+        self._model.shutdown()
     @Slot(set, str)
     def updateExtensionsFromUi(self, checked_common_set: Set[str], custom_text: str):
         custom_set = {f".{part.lstrip('.')}" for part in re.split(r"[\s,]+", custom_text.strip()) if part.strip() and part != '.'}
@@ -422,6 +504,9 @@ class ChatViewModel(QObject):
             self.saveSessionAs()
             return False
 
+    @Slot()
+    def compactSession(self): self._model.compact_session()
+
     @Slot()
     def saveSessionAs(self):
         default_name = self.tr("Сессия_{0}{1}").format(datetime.datetime.now().strftime('%Y%m%d_%H%M%S'), db_manager.SESSION_EXTENSION)
@@ -571,6 +656,7 @@ class ChatViewModel(QObject):
         self._is_request_running = True
         self._last_api_error = None
         self._last_api_intermediate_step = None
+        self._streaming_response_parts = []
         self._update_all_button_states()
         self.chatUpdateRequired.emit()
         self.apiRequestStarted.emit()
@@ -580,9 +666,18 @@ class ChatViewModel(QObject):
         self._last_api_intermediate_step = message
         self.chatUpdateRequired.emit()
 
+    @Slot(str)
+    def _on_api_response_chunk_received(self, chunk: str):
+        if not self._streaming_response_parts:
+            # Первый фрагмент: промежуточные шаги подготовки больше не актуальны
+            self._last_api_intermediate_step = None
+        self._streaming_response_parts.append(chunk)
+        self.responseChunkReceived.emit(chunk)
+
     @Slot(str)
     def _on_api_response_received(self, text: str):
         self._last_api_intermediate_step = None
+        self._streaming_response_parts = []
 
     @Slot(str)
     def _on_api_error_occurred(self, error_message: str):
@@ -592,6 +687,7 @@ class ChatViewModel(QObject):
     @Slot()
     def _on_api_request_finished(self):
         self._is_request_running = False
+        self._streaming_response_parts = []
         self._update_all_button_states()
         self.chatUpdateRequired.emit()
 
@@ -609,6 +705,7 @@ class ChatViewModel(QObject):
     @Slot()
     def _on_session_loaded(self):
         logger.info("--- ViewModel: Загрузка/обновление состояния из Модели ---")
+        self._start_markdown_prerender()
         self.projectTypeChanged.emit(self.projectType)
         self.repoUrlChanged.emit(self.repoUrl)
         self.localPathChanged.emit(self.localPath)
@@ -619,6 +716,9 @@ class ChatViewModel(QObject):
         self.instructionsTextChanged.emit()
         self.ragEnabledChanged.emit(self.ragEnabled)
         self.semanticSearchEnabledChanged.emit(self.semanticSearchEnabled)
+        self.annSearchChanged.emit()
+        self.embeddingStorageChanged.emit()
+        self.retrievalModeChanged.emit()
         self.availableModelsChanged.emit(self._model.get_available_models())
         self._parse_and_emit_extensions()
         self._update_all_button_states()
@@ -628,6 +728,55 @@ class ChatViewModel(QObject):
         self.isDirtyChanged.emit()
         self.toggleAllButtonPropsChanged.emit()
 
+    # --- Фоновый рендеринг markdown ---
+    def isMarkdownPrerenderActive(self) -> bool:
+        """True, пока ответы загруженной сессии рендерятся в фоне (View может показывать заглушки)."""
+        return self._markdown_prerender_worker is not None
+
+    def _start_markdown_prerender(self):
+        self._stop_markdown_prerender()
+        if not self._markdown_prerender_enabled: return
+        texts = [msg.get("parts", [""])[0] or "" for msg in self._model.get_chat_history() if msg.get("role") == "model"]
+        if len(texts) < MARKDOWN_PRERENDER_MIN_MESSAGES: return
+
+        logger.info(f"Запуск фонового рендеринга markdown для {len(texts)} сообщений.")
+        thread = QThread()
+        worker = MarkdownPrerenderWorker(texts)
+        worker.moveToThread(thread)
+        thread.started.connect(worker.run)
+        worker.progress.connect(self._on_markdown_prerender_progress)
+        worker.finished.connect(self._on_markdown_prerender_finished)
+        worker.finished.connect(thread.quit)
+        thread.finished.connect(worker.deleteLater)
+        thread.finished.connect(self._on_markdown_prerender_thread_finished)
+        self._markdown_prerender_worker = worker
+        self._markdown_prerender_threads.append(thread)
+        thread.start()
+
+    def _stop_markdown_prerender(self):
+        if self._markdown_prerender_worker:
+            self._markdown_prerender_worker.cancel()
+        self._markdown_prerender_worker = None
+
+    @Slot(int, int)
+    def _on_markdown_prerender_progress(self, done: int, total: int):
+        if self.sender() is not self._markdown_prerender_worker: return
+        # Заглушки уже отрендеренных сообщений заменяются точечно (см. ChatView.update_messages)
+        self.chatUpdateRequired.emit()
+
+    @Slot()
+    def _on_markdown_prerender_finished(self):
+        if self.sender() is not self._markdown_prerender_worker: return # Завершился отмененный воркер
+        self._markdown_prerender_worker = None
+        self.chatUpdateRequired.emit()
+
+    @Slot()
+    def _on_markdown_prerender_thread_finished(self):
+        thread = self.sender()
+        if thread in self._markdown_prerender_threads:
+            self._markdown_prerender_threads.remove(thread)
+            thread.deleteLater()
+
     @Slot(str)
     def _on_session_error(self, error_message: str):
         self.showMessageDialog.emit("crit", self.tr("Ошибка сессии"), error_message)
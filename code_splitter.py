@@ -3,71 +3,96 @@
 import os
 import sys
 import logging
+from collections import deque
 from typing import List, Dict, Tuple, Optional
 
 # Импортируем tree-sitter и его компоненты
 from tree_sitter import Language, Parser
-from ast_parser import LANGUAGE_MAP as AST_LANGUAGE_MAP
+from ast_parser import LANGUAGE_MAP as AST_LANGUAGE_MAP, ParsedSource, QueryCache
+from token_estimator import TokenEstimator
 
 logger = logging.getLogger(__name__)
 
+# Версия алгоритмов разбиения. Входит в ключ кэша анализа (analysis_cache.py):
+# увеличьте ее при любом изменении, влияющем на получаемые чанки.
+SPLITTER_VERSION = 5
+
+# Бюджет чанка кода в токенах (оценка TokenEstimator.raw_estimate). Около 1000-1600 символов
+# кода; небольшие соседние функции объединяются в один чанк до этого бюджета.
+DEFAULT_CHUNK_TOKENS = 400
+
 # --- Класс 1: Рекурсивный сплиттер для текста (наш fallback) ---
-# Этот класс остается без изменений.
+
+# Фрагмент текста как смещения [start, end) в исходной строке
+Span = Tuple[int, int]
+
 
 class RecursiveCharacterSplitter:
     """
     Простой рекурсивный сплиттер текста. Используется как fallback для
     файлов, не являющихся кодом, или для языков, не поддерживаемых TreeSitter.
+
+    Работает со смещениями в исходной строке, а не с копиями текста, поэтому время
+    разбиения линейно по длине текста (важно для больших PDF). Текст режется на части
+    по самому крупному разделителю, слишком длинные части - по следующему, и так до
+    отдельных символов; затем соседние части собираются в чанки до chunk_size символов.
+    Каждый следующий чанк начинается с хвоста предыдущего длиной до chunk_overlap символов.
     """
     def __init__(self, chunk_size: int = 1000, chunk_overlap: int = 150):
         self.chunk_size = chunk_size
-        self.chunk_overlap = chunk_overlap
+        self.chunk_overlap = min(chunk_overlap, chunk_size - 1)
         self._separators = ["\n\n", "\n", " ", ""] # Универсальные разделители для текста
-        self._length_function = len
 
     def split_text(self, text: str) -> List[str]:
         """Основной метод для вызова разбиения текста."""
-        final_chunks = []
-        # Начинаем с самого общего разделителя
-        separator = self._separators[0]
-        blocks = text.split(separator)
-        
-        # Рекурсивно обрабатываем блоки
-        self._split_blocks(blocks, separator, final_chunks)
-        return final_chunks
-
-    def _split_blocks(self, blocks: List[str], separator: str, final_chunks: List[str]):
-        """Рекурсивно разбивает блоки, пока они не станут меньше chunk_size."""
-        current_chunk = ""
-        for block in blocks:
-            if not block:
-                continue
+        return [text[start:end] for start, end in self.split_spans(text)]
 
-            if self._length_function(block) > self.chunk_size:
-                next_separator_index = self._separators.index(separator) + 1
-                if next_separator_index < len(self._separators):
-                    next_separator = self._separators[next_separator_index]
-                    smaller_blocks = block.split(next_separator)
-                    self._split_blocks(smaller_blocks, next_separator, final_chunks)
-                else: 
-                    if current_chunk:
-                        final_chunks.append(current_chunk)
-                    final_chunks.extend(self._force_split(block))
-                    current_chunk = ""
-            elif self._length_function(current_chunk + separator + block) <= self.chunk_size:
-                current_chunk += separator + block
-            else:
-                if current_chunk:
-                    final_chunks.append(current_chunk)
-                current_chunk = block
-        
-        if current_chunk:
-            final_chunks.append(current_chunk)
+    def split_spans(self, text: str) -> List[Span]:
+        """Чанки как смещения (start, end) в text; text[start:end] - текст чанка."""
+        pieces: List[Span] = []
+        self._split_span(text, 0, len(text), 0, pieces)
+        return self._merge_pieces(pieces)
 
-    def _force_split(self, text: str) -> List[str]:
-        """Принудительно режет текст на части."""
-        step = self.chunk_size - self.chunk_overlap
-        return [text[i:i + self.chunk_size] for i in range(0, len(text), step)]
+    def _split_span(self, text: str, start: int, end: int, level: int, pieces: List[Span]):
+        """Разбивает text[start:end] разделителем уровня level; части длиннее chunk_size - следующим уровнем."""
+        separator = self._separators[level]
+        if not separator:
+            # Разделителей не осталось: режем по символам частями, из которых соберется перекрытие
+            step = max(1, min(self.chunk_overlap, self.chunk_size - self.chunk_overlap)) if self.chunk_overlap else self.chunk_size
+            for piece_start in range(start, end, step):
+                self._add_piece(text, piece_start, min(piece_start + step, end), level, pieces)
+            return
+        piece_start = start
+        while piece_start < end:
+            piece_end = text.find(separator, piece_start, end)
+            if piece_end == -1:
+                piece_end = end
+            self._add_piece(text, piece_start, piece_end, level, pieces)
+            piece_start = piece_end + len(separator)
+
+    def _add_piece(self, text: str, start: int, end: int, level: int, pieces: List[Span]):
+        while start < end and text[start].isspace(): start += 1
+        while end > start and text[end - 1].isspace(): end -= 1
+        if start == end: return
+        if end - start > self.chunk_size:
+            self._split_span(text, start, end, level + 1, pieces)
+        else:
+            pieces.append((start, end))
+
+    def _merge_pieces(self, pieces: List[Span]) -> List[Span]:
+        """Собирает соседние части в чанки до chunk_size символов с перекрытием до chunk_overlap."""
+        chunks: List[Span] = []
+        window: deque = deque() # Части текущего чанка
+        for start, end in pieces:
+            if window and end - window[0][0] > self.chunk_size:
+                chunks.append((window[0][0], window[-1][1]))
+                # Следующий чанк начинается с хвоста текущего, если он помещается в перекрытие
+                while window and (window[-1][1] - window[0][0] > self.chunk_overlap or end - window[0][0] > self.chunk_size):
+                    window.popleft()
+            window.append((start, end))
+        if window:
+            chunks.append((window[0][0], window[-1][1]))
+        return chunks
 
 
 # --- Класс 2: "Умный" сплиттер кода на основе Tree-sitter ---
@@ -76,6 +101,11 @@ class TreeSitterSplitter:
     """
     Разделяет код на осмысленные чанки (функции, классы), используя
     синтаксические деревья, построенные с помощью Tree-sitter.
+
+    Размер чанка задается в токенах (chunk_tokens), а не в символах, поэтому чанки
+    на разных языках и в минифицированных файлах одинаково загружают запросы эмбеддингов
+    и бюджет промпта. Соседние небольшие узлы объединяются до бюджета, узел больше
+    бюджета делится по вложенным узлам, а если их нет - текстовым сплиттером.
     """
     
     # --- НАЧАЛО ФИНАЛЬНЫХ ИЗМЕНЕНИЙ (Удаление проблемных языков) ---
@@ -110,15 +140,17 @@ class TreeSitterSplitter:
 
     # --- КОНЕЦ ФИНАЛЬНЫХ ИЗМЕНЕНИЙ ---
 
-    def __init__(self, compiled_library_path: str):
+    def __init__(self, compiled_library_path: str, chunk_tokens: int = DEFAULT_CHUNK_TOKENS):
         if not os.path.exists(compiled_library_path):
             raise FileNotFoundError(f"Скомпилированная библиотека tree-sitter не найдена по пути: {compiled_library_path}")
             
         self.library_path = compiled_library_path
         self.parser = Parser()
         self.languages: Dict[str, Language] = {}
+        self.queries = QueryCache()
         self._load_languages()
 
+        self.chunk_tokens = max(1, int(chunk_tokens))
         # Экземпляр fallback-сплиттера, который всегда доступен
         self.fallback_splitter = RecursiveCharacterSplitter(chunk_size=1000, chunk_overlap=150)
 
@@ -138,21 +170,26 @@ class TreeSitterSplitter:
         """Проверяет, поддерживается ли (успешно ли загружен) данный язык."""
         return lang_name in self.languages
 
-    def split_text(self, code: str, language: str) -> List[str]:
+    def parse(self, code: str, language: str) -> Optional[ParsedSource]:
+        """Готовит общий разбор файла (см. ParsedSource) или возвращает None для неподдерживаемого языка."""
+        lang_obj = self.languages.get(language)
+        return ParsedSource(code, language, self.parser, lang_obj) if lang_obj else None
+
+    def split_text(self, code: str, language: str, parsed: Optional[ParsedSource] = None) -> List[str]:
         """
         Основной метод для разделения кода.
+        parsed - уже подготовленный разбор этого же кода (см. ParsedSource), чтобы не разбирать его повторно.
         """
         # Если язык не поддерживается или не удалось загрузить грамматику, используем fallback
         if not self.is_language_supported(language):
             logger.debug(f"Язык '{language}' не поддерживается Tree-sitter, используется fallback (рекурсивный сплиттер).")
-            return self.fallback_splitter.split_text(code)
+            return self._split_by_tokens(code)
+
+        if parsed is None or parsed.language != language:
+            parsed = self.parse(code, language)
 
-        lang_obj = self.languages[language]
-        self.parser.set_language(lang_obj)
-        
         try:
-            tree = self.parser.parse(bytes(code, "utf8"))
-            root_node = tree.root_node
+            root_node = parsed.tree.root_node
         except Exception as e:
             logger.error(f"Ошибка парсинга кода на языке '{language}': {e}. Возвращается единый чанк.")
             return [code] # Возвращаем как есть в случае ошибки парсинга
@@ -160,48 +197,121 @@ class TreeSitterSplitter:
         target_node_types = self.SPLIT_NODES_MAP.get(language)
         if not target_node_types:
             logger.debug(f"Для языка '{language}' не определены узлы-разделители в SPLIT_NODES_MAP, используется fallback.")
-            return self.fallback_splitter.split_text(code)
+            return self._split_by_tokens(code)
 
-        split_nodes = self._find_split_nodes(root_node, target_node_types)
+        split_nodes = self._select_split_nodes(root_node, language, target_node_types)
         
         # Если Tree-sitter не нашел структурных узлов, возвращаем весь код или используем fallback
         if not split_nodes:
             logger.debug(f"Tree-sitter не нашел структурных узлов для '{language}', используется fallback.")
-            return self.fallback_splitter.split_text(code)
-            
-        chunks = []
-        last_end = 0
-        
-        split_nodes.sort(key=lambda node: node.start_byte)
+            return self._split_by_tokens(code)
+
+        spans: List[Optional[Tuple[int, int]]] = []
+        self._collect_spans(parsed, split_nodes, 0, len(parsed.source_bytes), language, target_node_types, spans)
+        return self._pack_spans(parsed, spans)
 
-        for node in split_nodes:
+    def _estimate_tokens(self, text: str) -> float:
+        return TokenEstimator.raw_estimate(text)
+
+    def _collect_spans(self, parsed: ParsedSource, nodes: List, start: int, end: int, language: str,
+                       target_types: Tuple[str, ...], spans: List[Optional[Tuple[int, int]]]):
+        """
+        Делит байты [start, end) на части: сами узлы и код между ними, в порядке следования.
+        Узел больше бюджета (например, большой класс) делится по вложенным узлам-разделителям;
+        его части отделяются от соседних границами (None), чтобы, например, заголовок класса
+        попал в один чанк с его методами, а не с предыдущей функцией.
+        """
+        last_end = start
+        for node in nodes:
+            # Смещения узлов - байтовые, поэтому текст между узлами берется из байтового буфера
             if node.start_byte > last_end:
-                intermediate_code = code[last_end:node.start_byte].strip()
-                if intermediate_code:
-                    chunks.append(intermediate_code)
-            
-            node_code = node.text.decode('utf-8', errors='ignore').strip()
-            if node_code:
-                chunks.append(node_code)
-            
+                spans.append((last_end, node.start_byte))
+            if self._estimate_tokens(parsed.text(node.start_byte, node.end_byte)) > self.chunk_tokens:
+                inner_nodes = self._select_split_nodes(node, language, target_types)
+                if inner_nodes:
+                    spans.append(None)
+                    self._collect_spans(parsed, inner_nodes, node.start_byte, node.end_byte, language, target_types, spans)
+                    spans.append(None)
+                    last_end = node.end_byte
+                    continue
+            spans.append((node.start_byte, node.end_byte))
             last_end = node.end_byte
-            
-        if len(code) > last_end:
-            remaining_code = code[last_end:].strip()
-            if remaining_code:
-                chunks.append(remaining_code)
-
-        # Финальная проверка: если чанк все еще слишком большой, режем его рекурсивно
-        final_chunks = []
-        for chunk in chunks:
-            # Проверяем не по self.chunk_size, а по свойству fallback_splitter.chunk_size
-            if len(chunk) > self.fallback_splitter.chunk_size * 1.2: # Даем небольшой запас
-                logger.debug(f"Чанк (тип: {language}) все еще слишком большой ({len(chunk)} символов), применяется дополнительное разбиение.")
-                final_chunks.extend(self.fallback_splitter.split_text(chunk))
+        if end > last_end:
+            spans.append((last_end, end))
+
+    def _pack_spans(self, parsed: ParsedSource, spans: List[Optional[Tuple[int, int]]]) -> List[str]:
+        """
+        Собирает чанки из частей: соседние части объединяются (но не через границу None),
+        пока их сумма укладывается в бюджет токенов; часть больше бюджета режется текстовым сплиттером.
+        """
+        chunks: List[str] = []
+        group_start, group_end, group_tokens = None, None, 0.0
+
+        def flush():
+            nonlocal group_start, group_end, group_tokens
+            if group_start is not None:
+                chunk = parsed.text(group_start, group_end).strip()
+                if chunk: chunks.append(chunk)
+            group_start, group_end, group_tokens = None, None, 0.0
+
+        for span in spans:
+            if span is None:
+                flush()
+                continue
+            start, end = span
+            text = parsed.text(start, end)
+            if not text.strip(): continue
+            tokens = self._estimate_tokens(text)
+            if tokens > self.chunk_tokens:
+                flush()
+                logger.debug(f"Фрагмент кода (~{int(tokens)} токенов) больше бюджета чанка, применяется дополнительное разбиение.")
+                chunks.extend(self._split_by_tokens(text.strip(), tokens))
+            elif group_start is not None and group_tokens + tokens <= self.chunk_tokens:
+                group_end, group_tokens = end, group_tokens + tokens
             else:
-                final_chunks.append(chunk)
+                flush()
+                group_start, group_end, group_tokens = start, end, tokens
+        flush()
+        return chunks
+
+    def _split_by_tokens(self, text: str, tokens: Optional[float] = None) -> List[str]:
+        """
+        Текстовый сплиттер с размером чанка, пересчитанным из бюджета токенов по плотности
+        этого текста (символов на токен), чтобы плотный код не давал чанки больше бюджета.
+        """
+        tokens = self._estimate_tokens(text) if tokens is None else tokens
+        if tokens <= self.chunk_tokens:
+            return [text.strip()] if text.strip() else []
+        chars_per_token = len(text) / tokens
+        chunk_size = max(1, int(self.chunk_tokens * chars_per_token))
+        overlap = int(chunk_size * self.fallback_splitter.chunk_overlap / self.fallback_splitter.chunk_size)
+        return RecursiveCharacterSplitter(chunk_size=chunk_size, chunk_overlap=overlap).split_text(text)
+
+    def _select_split_nodes(self, root_node, language: str, target_types: Tuple[str, ...]) -> List:
+        """
+        Узлы-разделители верхнего уровня внутри root_node (сам он не входит) в порядке следования.
+        Ищутся скомпилированным запросом Tree-sitter (см. QueryCache); вложенные в уже найденный
+        узел отбрасываются.
+        Если запрос не компилируется, используется рекурсивный обход _find_split_nodes.
+        """
+        query_source = " ".join(f"({node_type}) @split" for node_type in target_types)
+        query = self.queries.get(language, self.languages[language], query_source)
+        if query is None:
+            return sorted(self._find_split_nodes(root_node, target_types), key=lambda node: node.start_byte)
 
-        return final_chunks
+        root_span = (root_node.start_byte, root_node.end_byte)
+        nodes = sorted(
+            (node for node, _ in query.captures(root_node)
+             if node.type != root_node.type or (node.start_byte, node.end_byte) != root_span),
+            key=lambda node: (node.start_byte, -node.end_byte)
+        )
+        split_nodes = []
+        last_end = -1
+        for node in nodes:
+            if node.start_byte >= last_end:
+                split_nodes.append(node)
+                last_end = node.end_byte
+        return split_nodes
 
     def _find_split_nodes(self, node, target_types: Tuple[str, ...], depth=0) -> List:
         found_nodes = []
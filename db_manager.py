@@ -5,15 +5,32 @@ import os
 import datetime
 import json
 import logging
-from typing import Optional, Dict, List, Tuple, Any
+import threading
+from contextlib import contextmanager
+from typing import Optional, Dict, List, Set, Tuple, Any, Iterator
 from io import BytesIO
 import numpy as np
 
+from keyword_index import KEYWORD_INDEXED_TYPES, FTS_TOKENIZE, bm25_rank_expression
+from analysis_cache import content_hash
+
 logger = logging.getLogger(__name__)
 
 # НОВОЕ РАСШИРЕНИЕ ФАЙЛА СЕССИИ
 SESSION_EXTENSION = ".cpai"
 
+# Форматы хранения эмбеддингов в context_data: сырые буферы фиксированной размерности.
+# int8 квантуется симметрично с множителем на строку (embedding_scale).
+EMBEDDING_STORAGE_FORMATS = ("float32", "float16", "int8")
+DEFAULT_EMBEDDING_STORAGE = "float32"
+
+# Сессии с таким числом чанков открываются лениво: текст и эмбеддинги чанков не читаются при загрузке
+LAZY_LOAD_MIN_CHUNKS = 20000
+# Размер пачки при потоковом чтении эмбеддингов и текста чанков
+CONTEXT_READ_BATCH = 5000
+# Журнал истории чата переносится в messages, когда в нем накапливается столько записей
+MESSAGE_JOURNAL_CHECKPOINT_RECORDS = 256
+
 # --- ОБНОВЛЕННАЯ СХЕМА БАЗЫ ДАННЫХ ---
 DATABASE_SCHEMA = """
 CREATE TABLE IF NOT EXISTS metadata (
@@ -29,6 +46,10 @@ CREATE TABLE IF NOT EXISTS metadata (
     max_output_tokens INTEGER,
     extensions TEXT,
     instructions TEXT,
+    ann_enabled BOOLEAN,   -- приближенный (IVF) семантический поиск
+    ann_nprobe INTEGER,    -- число просматриваемых кластеров IVF на запрос
+    embedding_storage TEXT, -- формат хранения эмбеддингов (EMBEDDING_STORAGE_FORMATS)
+    retrieval_mode TEXT,   -- отбор фрагментов: 'semantic', 'keyword' или 'hybrid' (keyword_index.RETRIEVAL_MODES)
     -- --- Временные метки ---
     created_at TIMESTAMP,
     last_saved_at TIMESTAMP
@@ -36,7 +57,7 @@ CREATE TABLE IF NOT EXISTS metadata (
 
 CREATE TABLE IF NOT EXISTS messages (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
-    role TEXT NOT NULL CHECK(role IN ('user', 'model')),
+    role TEXT NOT NULL CHECK(role IN ('user', 'model', 'system')),
     content TEXT NOT NULL,
     timestamp TIMESTAMP NOT NULL,
     order_index INTEGER NOT NULL,
@@ -51,13 +72,123 @@ CREATE TABLE IF NOT EXISTS context_data (
     chunk_num INTEGER, -- Порядковый номер чанка (для type='chunk')
     content TEXT NOT NULL,
     embedding BLOB, -- Векторное представление чанка (для type='chunk' и семантического поиска)
+    embedding_dtype TEXT, -- формат embedding: 'float32', 'float16', 'int8' или NULL (старый формат np.save)
+    embedding_scale REAL, -- множитель деквантования для 'int8'
+    content_hash TEXT, -- ссылка на chunk_store; тогда content пуст, а embedding = NULL
     UNIQUE(file_path, type, chunk_num)
 );
 
+-- Хранилище текста и эмбеддингов чанков с адресацией по содержимому (sha256 текста):
+-- одинаковые чанки (вендоренный и сгенерированный код, шапки лицензий) хранятся один раз
+CREATE TABLE IF NOT EXISTS chunk_store (
+    hash TEXT PRIMARY KEY,
+    content TEXT NOT NULL,
+    embedding BLOB,
+    embedding_dtype TEXT,
+    embedding_scale REAL
+);
+
+-- Кластеры IVF векторного индекса семантического поиска (строка есть, только если кластеры обучались).
+-- Сами эмбеддинги хранятся один раз, вместе с чанками (chunk_store), и при загрузке собираются в индекс заново
+CREATE TABLE IF NOT EXISTS vector_index (
+    id INTEGER PRIMARY KEY DEFAULT 1,
+    dim INTEGER NOT NULL,
+    count INTEGER NOT NULL,
+    keys TEXT NOT NULL,    -- JSON-список пар [file_path, chunk_num] в порядке ann_assignments
+    vectors BLOB NOT NULL, -- не используется (пустой); до схемы 5 - копия матрицы эмбеддингов count x dim, float32
+    ann_nlist INTEGER,         -- число кластеров IVF (NULL, если кластеры не обучались)
+    ann_trained_count INTEGER, -- размер индекса на момент обучения кластеров
+    ann_centroids BLOB,        -- матрица ann_nlist x dim, float32
+    ann_assignments BLOB       -- номер кластера каждой строки, int32
+);
+
+-- Журнал изменений истории чата между сохранениями: каждое новое сообщение и смена флага
+-- исключения дописываются сюда сразу, а при сохранении переносятся в messages (см. append_message_journal)
+CREATE TABLE IF NOT EXISTS message_journal (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    op TEXT NOT NULL CHECK(op IN ('append', 'exclude')), -- новое сообщение или смена excluded_from_api
+    order_index INTEGER NOT NULL,
+    role TEXT,             -- для op = 'append'
+    content TEXT,          -- для op = 'append'
+    excluded_from_api BOOLEAN NOT NULL DEFAULT 0,
+    timestamp TIMESTAMP NOT NULL
+);
+
 CREATE INDEX IF NOT EXISTS idx_messages_order ON messages (order_index);
+-- Ключ построчных обновлений при сохранении изменений (save_session_delta)
+CREATE UNIQUE INDEX IF NOT EXISTS idx_messages_order_unique ON messages (order_index);
 CREATE INDEX IF NOT EXISTS idx_context_filepath ON context_data (file_path);
 """
 
+# Объекты, зависящие от колонок из ADDED_COLUMNS: создаются после _add_missing_columns().
+# context_resolved - строки context_data с текстом и эмбеддингом, взятыми из chunk_store
+# для чанков, которые на него ссылаются. Все чтения контекста идут через это представление.
+CONTEXT_STORE_SCHEMA = """
+CREATE INDEX IF NOT EXISTS idx_context_hash ON context_data (content_hash);
+
+CREATE VIEW IF NOT EXISTS context_resolved AS
+SELECT d.id AS id, d.file_path AS file_path, d.type AS type, d.chunk_num AS chunk_num,
+       d.content_hash AS content_hash,
+       CASE WHEN s.hash IS NULL THEN d.content ELSE s.content END AS content,
+       CASE WHEN s.hash IS NULL THEN d.embedding ELSE s.embedding END AS embedding,
+       CASE WHEN s.hash IS NULL THEN d.embedding_dtype ELSE s.embedding_dtype END AS embedding_dtype,
+       CASE WHEN s.hash IS NULL THEN d.embedding_scale ELSE s.embedding_scale END AS embedding_scale
+FROM context_data AS d LEFT JOIN chunk_store AS s ON s.hash = d.content_hash;
+"""
+
+# Полнотекстовый индекс (FTS5) по чанкам и саммари для поиска по ключевым словам.
+# Индекс хранит только токены (external content): текст читается из context_resolved,
+# а триггеры обновляют индекс в той же транзакции, что и строки context_data.
+# Текст удаляемой строки берется из chunk_store, поэтому осиротевшие записи хранилища
+# удаляются только после изменения context_data (см. _delete_unreferenced_chunks).
+# Создается отдельно от DATABASE_SCHEMA: SQLite может быть собран без FTS5.
+_FTS_TYPES_SQL = ", ".join(f"'{t}'" for t in KEYWORD_INDEXED_TYPES)
+_OLD_RESOLVED_CONTENT_SQL = "COALESCE((SELECT content FROM chunk_store WHERE hash = old.content_hash), old.content)"
+_NEW_RESOLVED_CONTENT_SQL = "COALESCE((SELECT content FROM chunk_store WHERE hash = new.content_hash), new.content)"
+CONTEXT_FTS_SCHEMA = f"""
+CREATE VIRTUAL TABLE IF NOT EXISTS context_fts USING fts5(
+    file_path, content, type,
+    content='context_resolved', content_rowid='id', tokenize='{FTS_TOKENIZE}'
+);
+
+CREATE TRIGGER IF NOT EXISTS context_fts_insert AFTER INSERT ON context_data
+WHEN new.type IN ({_FTS_TYPES_SQL}) BEGIN
+    INSERT INTO context_fts (rowid, file_path, content, type)
+        SELECT id, file_path, content, type FROM context_resolved WHERE id = new.id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS context_fts_delete AFTER DELETE ON context_data
+WHEN old.type IN ({_FTS_TYPES_SQL}) BEGIN
+    INSERT INTO context_fts (context_fts, rowid, file_path, content, type)
+        VALUES ('delete', old.id, old.file_path, {_OLD_RESOLVED_CONTENT_SQL}, old.type);
+END;
+
+-- Перенос текста в chunk_store (тот же текст, другая колонка) индекс не трогает
+CREATE TRIGGER IF NOT EXISTS context_fts_update AFTER UPDATE OF file_path, type, content, content_hash ON context_data
+WHEN old.file_path IS NOT new.file_path OR old.type IS NOT new.type
+     OR {_OLD_RESOLVED_CONTENT_SQL} IS NOT {_NEW_RESOLVED_CONTENT_SQL} BEGIN
+    INSERT INTO context_fts (context_fts, rowid, file_path, content, type)
+        SELECT 'delete', old.id, old.file_path, {_OLD_RESOLVED_CONTENT_SQL}, old.type WHERE old.type IN ({_FTS_TYPES_SQL});
+    INSERT INTO context_fts (rowid, file_path, content, type)
+        SELECT id, file_path, content, type FROM context_resolved WHERE id = new.id AND type IN ({_FTS_TYPES_SQL});
+END;
+"""
+
+
+# Версия схемы, хранимая в PRAGMA user_version файла сессии. Увеличивается при каждом изменении
+# DATABASE_SCHEMA или ADDED_COLUMNS; схема файла с меньшей версией обновляется один раз при открытии.
+SCHEMA_VERSION = 5
+
+# Колонки, добавленные в существующие таблицы после их появления.
+# CREATE TABLE IF NOT EXISTS их не добавит, поэтому _migrate_schema догоняет схему через ALTER TABLE.
+ADDED_COLUMNS = {
+    "metadata": [("ann_enabled", "BOOLEAN"), ("ann_nprobe", "INTEGER"), ("embedding_storage", "TEXT"),
+                 ("retrieval_mode", "TEXT")],
+    "context_data": [("embedding_dtype", "TEXT"), ("embedding_scale", "REAL"), ("content_hash", "TEXT")],
+    "vector_index": [("ann_nlist", "INTEGER"), ("ann_trained_count", "INTEGER"),
+                     ("ann_centroids", "BLOB"), ("ann_assignments", "BLOB")],
+}
+
 
 def dict_factory(cursor, row):
     """Фабрика для преобразования строк sqlite в словари."""
@@ -65,38 +196,275 @@ def dict_factory(cursor, row):
     return {key: value for key, value in zip(fields, row)}
 
 
-def _get_connection(filepath: str) -> Optional[sqlite3.Connection]:
-    """Устанавливает соединение с БД сессии и настраивает его."""
+# Размер страницы для новых файлов: крупные BLOB (эмбеддинги, векторный индекс) занимают меньше страниц переполнения
+SESSION_PAGE_SIZE = 16384
+# Настройки соединения с файлом сессии
+SESSION_PRAGMAS = (
+    "PRAGMA journal_mode = WAL;",
+    "PRAGMA synchronous = NORMAL;",    # В режиме WAL сохраняет целостность, fsync только на контрольных точках
+    "PRAGMA cache_size = -65536;",     # 64 МБ кэша страниц
+    "PRAGMA temp_store = MEMORY;",
+    "PRAGMA mmap_size = 268435456;",   # Чтение через отображение в память (до 256 МБ)
+    "PRAGMA foreign_keys = ON;",
+)
+
+# Полная перезапись идет во временный файл рядом с сессией, который затем атомарно заменяет ее
+SAVE_TEMP_SUFFIX = ".saving"
+
+# Открытые соединения: по одному на файл сессии, живут до close_session().
+# Соединением пользуются поток интерфейса и поток записи (session_writer), поэтому у каждого своя блокировка.
+_connections: Dict[str, sqlite3.Connection] = {}
+_connection_locks: Dict[str, threading.RLock] = {}
+_registry_lock = threading.Lock()
+
+
+def _connection_key(filepath: str) -> str:
+    return os.path.normcase(os.path.abspath(filepath))
+
+
+def _open_connection(filepath: str) -> sqlite3.Connection:
+    """Открывает файл сессии, настраивает соединение и при необходимости обновляет схему."""
+    is_new_file = not os.path.exists(filepath) or os.path.getsize(filepath) == 0
+    conn = sqlite3.connect(filepath, timeout=10, check_same_thread=False)
     try:
-        conn = sqlite3.connect(filepath, timeout=10)
         conn.row_factory = dict_factory
-        conn.execute("PRAGMA foreign_keys = ON;")
+        if is_new_file:
+            conn.execute(f"PRAGMA page_size = {SESSION_PAGE_SIZE};") # Только до создания таблиц
+        for pragma in SESSION_PRAGMAS:
+            conn.execute(pragma)
+        _migrate_schema(conn)
         return conn
+    except sqlite3.Error:
+        conn.close()
+        raise
+
+
+def _get_connection(filepath: str) -> Optional[sqlite3.Connection]:
+    """Возвращает долгоживущее соединение с БД сессии (открывает его при первом обращении)."""
+    key = _connection_key(filepath)
+    with _registry_lock:
+        conn = _connections.get(key)
+        if conn is not None:
+            return conn
+        try:
+            conn = _open_connection(filepath)
+        except sqlite3.Error as e:
+            logger.error(f"Не удалось установить соединение с базой данных '{filepath}': {e}")
+            return None
+        _connections[key] = conn
+        _connection_locks.setdefault(key, threading.RLock())
+    logger.debug(f"Открыто соединение с файлом сессии: {filepath}")
+    return conn
+
+
+@contextmanager
+def _session_connection(filepath: str) -> Iterator[Optional[sqlite3.Connection]]:
+    """Соединение с файлом сессии, захваченное текущим потоком на время блока (None при ошибке)."""
+    conn = _get_connection(filepath)
+    if conn is None:
+        yield None
+        return
+    with _connection_locks[_connection_key(filepath)]:
+        with conn:
+            yield conn
+
+
+def close_session(filepath: Optional[str]):
+    """Закрывает соединение с файлом сессии (SQLite при этом переносит журнал WAL в основной файл)."""
+    if not filepath: return
+    key = _connection_key(filepath)
+    with _registry_lock:
+        conn = _connections.get(key)
+        lock = _connection_locks.get(key)
+    if conn is None: return
+    with lock: # Дожидаемся, пока соединением перестанет пользоваться другой поток
+        with _registry_lock:
+            _connections.pop(key, None)
+        try:
+            conn.close()
+            logger.debug(f"Закрыто соединение с файлом сессии: {filepath}")
+        except sqlite3.Error as e:
+            logger.warning(f"Ошибка при закрытии файла сессии '{filepath}': {e}")
+
+
+def _remove_session_files(filepath: str):
+    """Удаляет файл БД вместе с его журналами WAL/SHM (если они есть)."""
+    for path in (filepath, filepath + "-wal", filepath + "-shm"):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def close_all_sessions():
+    with _registry_lock:
+        keys = list(_connections)
+    for key in keys:
+        close_session(key)
+
+
+def _checkpoint(conn: sqlite3.Connection):
+    """Переносит журнал WAL в основной файл, чтобы сохраненный .cpai был самодостаточным."""
+    try:
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE);")
     except sqlite3.Error as e:
-        logger.error(f"Не удалось установить соединение с базой данных '{filepath}': {e}")
-        return None
+        logger.warning(f"Не удалось выполнить контрольную точку WAL: {e}")
+
+
+def _migrate_schema(conn: sqlite3.Connection):
+    """Создает таблицы и догоняет схему, только если версия схемы файла меньше SCHEMA_VERSION."""
+    version = conn.execute("PRAGMA user_version;").fetchone()["user_version"]
+    if version >= SCHEMA_VERSION:
+        if version > SCHEMA_VERSION:
+            logger.warning(f"Файл сессии создан более новой версией приложения (схема {version}, ожидается {SCHEMA_VERSION}).")
+        return
+    conn.executescript(DATABASE_SCHEMA)
+    _allow_system_messages(conn)
+    _add_missing_columns(conn)
+    conn.executescript(CONTEXT_STORE_SCHEMA)
+    _create_context_fts(conn)
+    if version < 5:
+        _drop_vector_index_copy(conn)
+    conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION};")
+    conn.commit()
+    logger.info(f"Схема файла сессии обновлена: версия {version} -> {SCHEMA_VERSION}")
+
+
+def _allow_system_messages(conn: sqlite3.Connection):
+    """
+    В файлах до схемы 4 таблица messages допускала только роли 'user' и 'model', и сессия
+    с системными сообщениями (например, об обновлении контекста из Git) не сохранялась.
+    Ограничение CHECK не меняется через ALTER TABLE, поэтому таблица пересоздается.
+    """
+    row = conn.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'messages';").fetchone()
+    if not row or "'system'" in row['sql']: return
+    conn.executescript("""
+        BEGIN;
+        CREATE TABLE messages_new (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            role TEXT NOT NULL CHECK(role IN ('user', 'model', 'system')),
+            content TEXT NOT NULL,
+            timestamp TIMESTAMP NOT NULL,
+            order_index INTEGER NOT NULL,
+            excluded_from_api BOOLEAN NOT NULL DEFAULT 0
+        );
+        INSERT INTO messages_new (id, role, content, timestamp, order_index, excluded_from_api)
+            SELECT id, role, content, timestamp, order_index, excluded_from_api FROM messages;
+        DROP TABLE messages;
+        ALTER TABLE messages_new RENAME TO messages;
+        CREATE INDEX IF NOT EXISTS idx_messages_order ON messages (order_index);
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_messages_order_unique ON messages (order_index);
+        COMMIT;
+    """)
+    logger.info("Схема сессии обновлена: messages допускает системные сообщения")
+
+
+def _drop_vector_index_copy(conn: sqlite3.Connection):
+    """
+    До схемы 5 в vector_index хранилась вторая, float32-копия всех эмбеддингов чанков.
+    Индекс теперь собирается из эмбеддингов chunk_store, а из vector_index остаются только кластеры IVF.
+    Место освобождается при сжатии файла (compact_session).
+    """
+    conn.execute("DELETE FROM vector_index WHERE ann_centroids IS NULL;")
+    conn.execute("UPDATE vector_index SET vectors = X'';")
+    conn.commit()
+
+
+def _add_missing_columns(conn: sqlite3.Connection):
+    """Добавляет в таблицы сессии колонки из ADDED_COLUMNS, которых еще нет в файле."""
+    for table, columns in ADDED_COLUMNS.items():
+        existing = {col['name'] for col in conn.execute(f"PRAGMA table_info({table});").fetchall()}
+        for name, column_type in columns:
+            if name not in existing:
+                conn.execute(f"ALTER TABLE {table} ADD COLUMN {name} {column_type};")
+                logger.info(f"Схема сессии обновлена: {table}.{name}")
+
+
+def _create_context_fts(conn: sqlite3.Connection):
+    """Создает полнотекстовый индекс context_fts и индексирует уже сохраненный контекст."""
+    if _has_context_fts(conn):
+        fts_sql = conn.execute("SELECT sql FROM sqlite_master WHERE name = 'context_fts';").fetchone()["sql"]
+        if "context_resolved" in fts_sql: return
+        # Индекс схемы 2 читал текст прямо из context_data - пересоздаем его поверх context_resolved
+        conn.executescript(
+            "DROP TRIGGER IF EXISTS context_fts_insert; DROP TRIGGER IF EXISTS context_fts_delete;"
+            "DROP TRIGGER IF EXISTS context_fts_update; DROP TABLE context_fts;"
+        )
+    try:
+        conn.executescript(CONTEXT_FTS_SCHEMA)
+        # Файл прежней версии: индексируем строки, записанные до появления триггеров
+        conn.execute("INSERT INTO context_fts (context_fts) VALUES ('rebuild');")
+        logger.info("Схема сессии обновлена: полнотекстовый индекс context_fts")
+    except sqlite3.OperationalError as e:
+        logger.warning(f"Полнотекстовый индекс недоступен (SQLite без FTS5?): {e}. Поиск по ключевым словам будет идти в памяти.")
+
+
+def _has_context_fts(conn: sqlite3.Connection) -> bool:
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'context_fts';").fetchone() is not None
+
+
+def encode_embedding(vector: np.ndarray, storage: str) -> Tuple[bytes, str, Optional[float]]:
+    """Сериализует эмбеддинг в сырой буфер формата storage. Возвращает (blob, формат, множитель)."""
+    vector = np.asarray(vector, dtype=np.float32).ravel()
+    if storage == "int8":
+        max_abs = float(np.max(np.abs(vector))) if vector.size else 0.0
+        scale = max_abs / 127.0 if max_abs > 0 else 1.0
+        return np.round(vector / scale).astype(np.int8).tobytes(), "int8", scale
+    if storage == "float16":
+        return vector.astype(np.float16).tobytes(), "float16", None
+    return vector.tobytes(), "float32", None
+
+
+def _decode_embeddings(rows: List[Dict[str, Any]]) -> bool:
+    """
+    Заменяет в строках context_data BLOB эмбеддинга на float32-вектор.
+    Строки нового формата декодируются группами одним np.frombuffer по склеенным буферам
+    (векторы - строки общей матрицы), строки старого формата (np.save) - по одной.
+    Возвращает True, если встретились эмбеддинги старого формата.
+    """
+    groups: Dict[Tuple[str, int], List[Dict[str, Any]]] = {}
+    has_legacy = False
+    for row in rows:
+        blob, dtype = row.get('embedding'), row.pop('embedding_dtype', None)
+        if blob is None:
+            row['embedding'] = None
+        elif dtype in EMBEDDING_STORAGE_FORMATS:
+            groups.setdefault((dtype, len(blob)), []).append(row)
+        else:
+            has_legacy = True
+            try: row['embedding'] = np.load(BytesIO(blob), allow_pickle=True).astype(np.float32).ravel()
+            except Exception: row['embedding'] = None
+
+    for (dtype, _), group in groups.items():
+        matrix = np.frombuffer(b"".join(row['embedding'] for row in group), dtype=dtype).reshape(len(group), -1)
+        if dtype == "int8":
+            scales = np.array([row.get('embedding_scale') or 1.0 for row in group], dtype=np.float32)
+            matrix = matrix.astype(np.float32) * scales[:, None]
+        else:
+            matrix = matrix.astype(np.float32)
+        for row, vector in zip(group, matrix):
+            row['embedding'] = vector
+    for row in rows:
+        row.pop('embedding_scale', None)
+    return has_legacy
 
 
 def init_session_db(filepath: str) -> bool:
     """
     Создает или обновляет файл БД сессии и инициализирует таблицы.
+    Схема проверяется при открытии соединения, поэтому для уже открытой сессии вызов почти бесплатен.
     Возвращает True в случае успеха, False при ошибке.
     """
     if not filepath.endswith(SESSION_EXTENSION):
         logger.error(f"Ошибка: Файл должен иметь расширение {SESSION_EXTENSION}, а не '{filepath}'")
         return False
     try:
+        if _connection_key(filepath) in _connections: return True
         logger.info(f"Инициализация/проверка БД сессии: {filepath}")
         dir_name = os.path.dirname(filepath)
         if dir_name:
             os.makedirs(dir_name, exist_ok=True)
 
-        with _get_connection(filepath) as conn:
-            if conn:
-                conn.executescript(DATABASE_SCHEMA)
-                # Логика миграции здесь больше не нужна, т.к. мы создаем новую структуру
-            else:
-                return False
+        if not _get_connection(filepath):
+            return False
         logger.debug(f"БД сессии успешно инициализирована/проверена.")
         return True
     except sqlite3.Error as e:
@@ -109,10 +477,16 @@ def init_session_db(filepath: str) -> bool:
 
 def load_session_data(
     filepath: str,
+    lazy: Optional[bool] = None
 ) -> Optional[Tuple[Dict[str, Any], List[Dict[str, Any]], List[Dict[str, Any]]]]:
     """
     Загружает метаданные, сообщения и контекст из файла сессии.
     Автоматически определяет старый формат и выполняет миграцию.
+
+    В ленивом режиме (lazy=True, а при None - для сессий от LAZY_LOAD_MIN_CHUNKS чанков)
+    у чанков загружаются только ключи: content и embedding равны None, 'row_id' - id строки
+    для load_context_contents() и load_chunk_embeddings(). Хранилище чанков (chunk_store) при этом не читается.
+    Такие метаданные помечаются флагом 'lazy_context'.
     """
     if not os.path.exists(filepath):
         logger.error(f"Файл сессии не найден: {filepath}")
@@ -124,7 +498,7 @@ def load_session_data(
 
     try:
         logger.info(f"Загрузка данных сессии из: {filepath}")
-        with _get_connection(filepath) as conn:
+        with _session_connection(filepath) as conn:
             if not conn: return None
 
             # --- Проверяем, какой формат у сессии (новый или старый) ---
@@ -144,27 +518,37 @@ def load_session_data(
                     {"role": row["role"], "parts": [row["content"]], "excluded": bool(row.get("excluded_from_api", False))}
                     for row in messages_cursor.fetchall()
                 ]
+                replayed = _replay_message_journal(conn, messages_list)
+                if replayed:
+                    logger.info(f"Из журнала истории чата восстановлено записей: {replayed}.")
                 
-                # Загружаем контекст
+                if lazy is None:
+                    chunk_count = conn.execute("SELECT COUNT(*) AS n FROM context_data WHERE type = 'chunk'").fetchone()['n']
+                    lazy = chunk_count >= LAZY_LOAD_MIN_CHUNKS
+                if lazy:
+                    context_data_list = _load_lazy_context(conn, metadata)
+                    logger.info(f"Сессия загружена в ленивом режиме: элементов контекста {len(context_data_list)}, текст чанков читается по требованию.")
+                    return metadata, messages_list, context_data_list
+
+                # Загружаем контекст (текст и эмбеддинги чанков - из хранилища chunk_store)
                 context_data_list = []
-                table_info_cursor = conn.execute("PRAGMA table_info(context_data);")
-                existing_columns = {col['name'] for col in table_info_cursor.fetchall()}
-                columns_to_select = ['file_path', 'type', 'chunk_num', 'content']
-                if 'embedding' in existing_columns:
-                    columns_to_select.append('embedding')
-                select_query = f"SELECT {', '.join(columns_to_select)} FROM context_data ORDER BY file_path, chunk_num ASC"
-                context_cursor = conn.execute(select_query)
+                context_cursor = conn.execute(
+                    """
+                    SELECT file_path, type, chunk_num, content, embedding, embedding_dtype, embedding_scale, content_hash
+                    FROM context_resolved ORDER BY file_path, chunk_num ASC
+                    """
+                )
                 for row in context_cursor.fetchall():
                     item = dict(row)
                     if item.get('type') == 'structure' and isinstance(item.get('content'), str):
                         try: item['content'] = json.loads(item['content'])
                         except json.JSONDecodeError: continue
-                    if 'embedding' in item and item['embedding'] is not None:
-                        try: item['embedding'] = np.load(BytesIO(item['embedding']), allow_pickle=True)
-                        except Exception: item['embedding'] = None
-                    else:
-                        item['embedding'] = None
                     context_data_list.append(item)
+                if _decode_embeddings(context_data_list):
+                    # Файл перезапишется в новом формате при следующем сохранении
+                    logger.info("Эмбеддинги сессии хранятся в старом формате (np.save) и будут сконвертированы при сохранении.")
+                    metadata['legacy_embeddings'] = True
+                _share_duplicate_chunks(context_data_list)
 
                 logger.info(f"Сессия нового формата успешно загружена.")
                 return metadata, messages_list, context_data_list
@@ -214,110 +598,560 @@ def load_session_data(
         return None
 
 
+def _share_duplicate_chunks(context_data_list: List[Dict[str, Any]]):
+    """Чанки с одинаковым содержимым (один content_hash) делят в памяти один текст и один вектор."""
+    first_by_hash: Dict[str, Dict[str, Any]] = {}
+    for item in context_data_list:
+        content_hash = item.pop('content_hash', None)
+        if content_hash is None: continue
+        first = first_by_hash.setdefault(content_hash, item)
+        if first is not item:
+            item['content'] = first['content']
+            item['embedding'] = first['embedding']
+
+
+def _load_lazy_context(conn: sqlite3.Connection, metadata: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """
+    Контекст без текста и эмбеддингов чанков (см. load_session_data(lazy=True)).
+    Столбцы chunk_store не запрашиваются: их чтение проходит по страницам переполнения с текстом
+    чанков и стоит почти столько же, сколько полная загрузка.
+    """
+    cursor = conn.execute(
+        """
+        SELECT id, file_path, type, chunk_num,
+               CASE WHEN type = 'chunk' THEN NULL ELSE content END AS content
+        FROM context_resolved ORDER BY file_path, chunk_num ASC
+        """
+    )
+    context_data_list = []
+    for row in cursor:
+        item = {'file_path': row['file_path'], 'type': row['type'], 'chunk_num': row['chunk_num'],
+                'content': row['content'], 'embedding': None}
+        if item['type'] == 'chunk':
+            item['row_id'] = row['id']
+        elif item['type'] == 'structure' and isinstance(item['content'], str):
+            try: item['content'] = json.loads(item['content'])
+            except json.JSONDecodeError: continue
+        context_data_list.append(item)
+    metadata['lazy_context'] = True
+    return context_data_list
+
+
+def load_context_contents(filepath: str, row_ids: List[int]) -> Dict[int, str]:
+    """Текст элементов контекста по id строк (для сессий, загруженных лениво)."""
+    contents: Dict[int, str] = {}
+    try:
+        with _session_connection(filepath) as conn:
+            if not conn: return contents
+            for start in range(0, len(row_ids), CONTEXT_READ_BATCH):
+                batch = row_ids[start:start + CONTEXT_READ_BATCH]
+                placeholders = ", ".join("?" * len(batch))
+                for row in conn.execute(f"SELECT id, content FROM context_resolved WHERE id IN ({placeholders})", batch):
+                    contents[row['id']] = row['content']
+    except sqlite3.Error as e:
+        logger.error(f"Не удалось прочитать текст контекста из {filepath}: {e}")
+    return contents
+
+
+def load_chunk_embeddings(filepath: str, row_ids: List[int]) -> Tuple[Dict[int, np.ndarray], bool]:
+    """
+    Эмбеддинги чанков по id строк (для сессий, загруженных лениво), пачками по CONTEXT_READ_BATCH строк.
+    Возвращает float32-векторы по id (строки без эмбеддинга пропускаются) и признак старого формата (np.save).
+    """
+    vectors: Dict[int, np.ndarray] = {}
+    has_legacy = False
+    try:
+        with _session_connection(filepath) as conn:
+            if not conn: return vectors, has_legacy
+            for start in range(0, len(row_ids), CONTEXT_READ_BATCH):
+                batch = row_ids[start:start + CONTEXT_READ_BATCH]
+                placeholders = ", ".join("?" * len(batch))
+                rows = conn.execute(
+                    f"""
+                    SELECT id, embedding, embedding_dtype, embedding_scale
+                    FROM context_resolved WHERE id IN ({placeholders}) AND embedding IS NOT NULL
+                    """,
+                    batch
+                ).fetchall()
+                has_legacy = _decode_embeddings(rows) or has_legacy
+                vectors.update((row['id'], row['embedding']) for row in rows if row['embedding'] is not None)
+    except sqlite3.Error as e:
+        logger.error(f"Не удалось прочитать эмбеддинги из {filepath}: {e}")
+    return vectors, has_legacy
+
+
+def load_vector_index_state(filepath: str) -> Optional[Dict[str, Any]]:
+    """
+    Загружает сохраненные кластеры IVF векторного индекса (см. VectorIndex.restore_state).
+    Возвращает None, если кластеры не обучались или не сохранялись.
+    """
+    try:
+        with _session_connection(filepath) as conn:
+            if not conn: return None
+            return conn.execute(
+                """
+                SELECT dim, count, keys, ann_nlist, ann_trained_count, ann_centroids, ann_assignments
+                FROM vector_index WHERE id = 1 AND ann_centroids IS NOT NULL AND ann_assignments IS NOT NULL
+                """
+            ).fetchone()
+    except sqlite3.Error as e:
+        logger.warning(f"Не удалось загрузить векторный индекс из {filepath}: {e}")
+        return None
+
+
+def search_context_fts(filepath: str, match_query: str, limit: int) -> Optional[List[Tuple[Tuple[str, str, int], float]]]:
+    """
+    Поиск BM25 по индексу context_fts файла сессии (запрос - keyword_index.build_match_query()).
+    Возвращает до limit пар ((file_path, type, chunk_num), оценка - чем больше, тем релевантнее)
+    или None, если в файле нет полнотекстового индекса.
+    """
+    try:
+        with _session_connection(filepath) as conn:
+            if not conn or not _has_context_fts(conn): return None
+            rows = conn.execute(
+                """
+                SELECT d.file_path, d.type, d.chunk_num, f.score
+                FROM (
+                    SELECT rowid, rank AS score FROM context_fts
+                    WHERE context_fts MATCH ? AND rank MATCH ? ORDER BY rank LIMIT ?
+                ) AS f
+                JOIN context_data AS d ON d.id = f.rowid
+                ORDER BY f.score
+                """,
+                (match_query, bm25_rank_expression(), limit)
+            ).fetchall()
+    except sqlite3.Error as e:
+        logger.warning(f"Ошибка полнотекстового поиска в {filepath}: {e}")
+        return None
+    return [((row['file_path'], row['type'], row['chunk_num'] or 0), -row['score']) for row in rows]
+
+
+def _save_metadata(cursor: sqlite3.Cursor, metadata_dict: Dict[str, Any]):
+    cursor.execute(
+        """
+        INSERT OR REPLACE INTO metadata (
+            id, project_type, repo_url, repo_branch, local_path, rag_enabled,
+            model_name, max_output_tokens, extensions, instructions,
+            ann_enabled, ann_nprobe, embedding_storage, retrieval_mode, created_at, last_saved_at
+        )
+        VALUES (
+            1, :project_type, :repo_url, :repo_branch, :local_path, :rag_enabled,
+            :model_name, :max_output_tokens, :extensions, :instructions,
+            :ann_enabled, :ann_nprobe, :embedding_storage, :retrieval_mode, :created_at, :last_saved_at
+        )
+        """,
+        metadata_dict,
+    )
+
+
+def _message_row(msg: Dict[str, Any], index: int, timestamp: datetime.datetime) -> Tuple:
+    return (
+        msg.get("role"),
+        (msg.get("parts", [""])[0] if msg.get("parts") else ""),
+        timestamp,
+        index,
+        1 if msg.get("excluded", False) else 0,
+    )
+
+
+def _journal_row(record: Dict[str, Any], timestamp: datetime.datetime) -> Tuple:
+    return (
+        record["op"],
+        record["order_index"],
+        record.get("role"),
+        record.get("content"),
+        1 if record.get("excluded", False) else 0,
+        timestamp,
+    )
+
+
+def append_message_journal(filepath: str, records: List[Dict[str, Any]]) -> bool:
+    """
+    Дописывает изменения истории чата в журнал message_journal файла сессии: одна короткая
+    транзакция, время не зависит от длины истории. Записи:
+    {'op': 'append', 'order_index', 'role', 'content', 'excluded'} - новое сообщение,
+    {'op': 'exclude', 'order_index', 'excluded'} - смена флага исключения из запросов к API.
+    Накопив MESSAGE_JOURNAL_CHECKPOINT_RECORDS записей, журнал переносится в messages;
+    при загрузке сессии еще не перенесенные записи применяются к истории (см. load_session_data).
+    """
+    if not records: return True
+    if not os.path.exists(filepath):
+        logger.warning(f"Журнал истории чата не записан: файл сессии '{filepath}' не найден.")
+        return False
+    try:
+        with _session_connection(filepath) as conn:
+            if not conn: return False
+            cursor = conn.cursor()
+            cursor.execute("BEGIN TRANSACTION;")
+            try:
+                current_time = datetime.datetime.now()
+                cursor.executemany(
+                    """
+                    INSERT INTO message_journal (op, order_index, role, content, excluded_from_api, timestamp)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                    """,
+                    [_journal_row(record, current_time) for record in records]
+                )
+                pending = cursor.execute("SELECT COUNT(*) AS n FROM message_journal;").fetchone()['n']
+                conn.commit()
+            except Exception as e:
+                logger.error(f"Ошибка записи журнала истории чата, откат: {e}", exc_info=True)
+                conn.rollback()
+                return False
+
+            if pending >= MESSAGE_JOURNAL_CHECKPOINT_RECORDS:
+                # Отдельной транзакцией: записи журнала уже сохранены, даже если перенос не удастся
+                cursor.execute("BEGIN TRANSACTION;")
+                try:
+                    folded = _fold_message_journal(cursor)
+                    conn.commit()
+                    logger.info(f"Журнал истории чата перенесен в messages: {folded} записей.")
+                except sqlite3.Error as e:
+                    logger.warning(f"Не удалось перенести журнал истории чата в messages: {e}")
+                    conn.rollback()
+        return True
+    except sqlite3.Error as e:
+        logger.error(f"Ошибка SQLite при записи журнала истории чата {filepath}: {e}")
+        return False
+
+
+def _fold_message_journal(cursor: sqlite3.Cursor) -> int:
+    """Применяет записи журнала к таблице messages (в порядке записи) и очищает журнал."""
+    rows = cursor.execute(
+        "SELECT op, order_index, role, content, excluded_from_api, timestamp FROM message_journal ORDER BY seq;"
+    ).fetchall()
+    for row in rows:
+        if row['op'] == 'append':
+            cursor.execute(
+                """
+                INSERT INTO messages (role, content, timestamp, order_index, excluded_from_api) VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT(order_index) DO UPDATE SET
+                    role = excluded.role, content = excluded.content, excluded_from_api = excluded.excluded_from_api
+                """,
+                (row['role'], row['content'] or "", row['timestamp'], row['order_index'], row['excluded_from_api'])
+            )
+        else:
+            cursor.execute(
+                "UPDATE messages SET excluded_from_api = ? WHERE order_index = ?;",
+                (row['excluded_from_api'], row['order_index'])
+            )
+    cursor.execute("DELETE FROM message_journal;")
+    return len(rows)
+
+
+def _replay_message_journal(conn: sqlite3.Connection, messages_list: List[Dict[str, Any]]) -> int:
+    """Применяет к загруженной истории записи журнала, еще не перенесенные в messages (восстановление после сбоя)."""
+    rows = conn.execute(
+        "SELECT op, order_index, role, content, excluded_from_api FROM message_journal ORDER BY seq;"
+    ).fetchall()
+    for row in rows:
+        index = row['order_index']
+        if row['op'] == 'append':
+            message = {"role": row['role'], "parts": [row['content'] or ""], "excluded": bool(row['excluded_from_api'])}
+            if index < len(messages_list):
+                messages_list[index] = message
+                continue
+            if index > len(messages_list):
+                logger.warning(f"Журнал истории чата: пропущены сообщения перед номером {index}.")
+            messages_list.append(message)
+        elif 0 <= index < len(messages_list):
+            messages_list[index]["excluded"] = bool(row['excluded_from_api'])
+    return len(rows)
+
+
+def _context_row(item: Dict[str, Any], embedding_storage: str, vectors: Optional[Dict[Tuple[str, int], np.ndarray]] = None) -> Tuple:
+    """Строка context_data для элемента контекста (эмбеддинг и структура сериализуются)."""
+    chunk_num_val = item.get("chunk_num")
+    if chunk_num_val is None or not isinstance(chunk_num_val, int):
+        chunk_num_val = 0
+
+    embedding_blob, embedding_dtype, embedding_scale = None, None, None
+    embedding = item.get('embedding')
+    if not isinstance(embedding, np.ndarray) and vectors and item.get('type') == 'chunk':
+        embedding = vectors.get((item.get("file_path"), chunk_num_val))
+    # Сериализация эмбеддинга, если он есть
+    if isinstance(embedding, np.ndarray):
+        try:
+            embedding_blob, embedding_dtype, embedding_scale = encode_embedding(embedding, embedding_storage)
+        except Exception as e:
+            logger.warning(f"Не удалось сериализовать эмбеддинг для '{item.get('file_path')}': {e}. Эмбеддинг не будет сохранен.")
+
+    # Сериализация 'content' в JSON для типа 'structure'
+    content_to_save = item.get("content")
+    if item.get('type') == 'structure' and isinstance(content_to_save, dict):
+        content_to_save = json.dumps(content_to_save, ensure_ascii=False)
+
+    return item.get("file_path"), item.get("type"), chunk_num_val, content_to_save, embedding_blob, embedding_dtype, embedding_scale
+
+
+def _context_rows(items: List[Dict[str, Any]], embedding_storage: str,
+                  chunk_vectors: Optional[Dict[Tuple[str, int], np.ndarray]] = None) -> Tuple[List[Tuple], List[Tuple]]:
+    """
+    Строки для записи контекста: (строки chunk_store, строки context_data).
+    Текст и эмбеддинг чанка записываются в chunk_store под sha256 текста, а строка
+    context_data только ссылается на них; остальные элементы хранятся в context_data целиком.
+    Одинаковые чанки делят одну запись chunk_store, а с ней и один эмбеддинг.
+    В памяти эмбеддинги хранятся только в векторном индексе (см. project_context.ProjectContextStore),
+    поэтому эмбеддинги чанков без ключа 'embedding' берутся из chunk_vectors (VectorIndex.export_vectors()).
+    """
+    store_rows, context_rows = [], []
+    for item in items:
+        file_path, item_type, chunk_num, content, blob, dtype, scale = _context_row(item, embedding_storage, chunk_vectors)
+        if item_type == 'chunk' and isinstance(content, str):
+            chunk_hash = content_hash(content)
+            store_rows.append((chunk_hash, content, blob, dtype, scale))
+            context_rows.append((file_path, item_type, chunk_num, "", None, None, None, chunk_hash))
+        else:
+            context_rows.append((file_path, item_type, chunk_num, content, blob, dtype, scale, None))
+    return store_rows, context_rows
+
+
+def _save_chunk_store(cursor: sqlite3.Cursor, store_rows: List[Tuple]):
+    """Добавляет содержимое чанков в chunk_store; уже сохраненный текст повторно не пишется."""
+    if not store_rows: return
+    cursor.executemany(
+        """
+        INSERT INTO chunk_store (hash, content, embedding, embedding_dtype, embedding_scale) VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT(hash) DO UPDATE SET
+            embedding = excluded.embedding, embedding_dtype = excluded.embedding_dtype, embedding_scale = excluded.embedding_scale
+        WHERE chunk_store.embedding IS NULL AND excluded.embedding IS NOT NULL
+        """,
+        store_rows
+    )
+
+
+def _delete_unreferenced_chunks(cursor: sqlite3.Cursor, candidate_hashes: Optional[Set[str]] = None) -> int:
+    """
+    Удаляет из chunk_store содержимое, на которое больше не ссылается ни одна строка context_data.
+    candidate_hashes - проверить только эти записи (те, на которые ссылались измененные строки);
+    None - проверить все хранилище (полный проход по таблице, см. compact_session).
+    """
+    if candidate_hashes is None:
+        cursor.execute("DELETE FROM chunk_store WHERE NOT EXISTS (SELECT 1 FROM context_data WHERE content_hash = chunk_store.hash);")
+        return cursor.rowcount
+    removed = 0
+    for chunk_hash in candidate_hashes:
+        cursor.execute(
+            "DELETE FROM chunk_store WHERE hash = ? AND NOT EXISTS (SELECT 1 FROM context_data WHERE content_hash = ?);",
+            (chunk_hash, chunk_hash)
+        )
+        removed += cursor.rowcount
+    return removed
+
+
+def _referenced_chunk_hashes(cursor: sqlite3.Cursor, removed_files: Set[str], context_rows: List[Tuple]) -> Set[str]:
+    """Хэши chunk_store, на которые ссылаются строки, удаляемые или перезаписываемые при сохранении изменений."""
+    hashes: Set[str] = set()
+    for path in removed_files:
+        cursor.execute("SELECT content_hash FROM context_data WHERE file_path = ? AND content_hash IS NOT NULL;", (path,))
+        hashes.update(row['content_hash'] for row in cursor.fetchall())
+    for file_path, item_type, chunk_num, *_ in context_rows:
+        if item_type != 'chunk': continue
+        row = cursor.execute(
+            "SELECT content_hash FROM context_data WHERE file_path = ? AND type = ? AND chunk_num = ?;",
+            (file_path, item_type, chunk_num)
+        ).fetchone()
+        if row and row['content_hash']: hashes.add(row['content_hash'])
+    return hashes
+
+
+def _save_vector_index(cursor: sqlite3.Cursor, vector_index_state: Optional[Dict[str, Any]]):
+    """Перезаписывает кластеры IVF (VectorIndex.export_state()); None - кластеров нет."""
+    cursor.execute("DELETE FROM vector_index;")
+    if vector_index_state:
+        cursor.execute(
+            """
+            INSERT INTO vector_index (
+                id, dim, count, keys, vectors,
+                ann_nlist, ann_trained_count, ann_centroids, ann_assignments
+            )
+            VALUES (
+                1, :dim, :count, :keys, X'',
+                :ann_nlist, :ann_trained_count, :ann_centroids, :ann_assignments
+            )
+            """,
+            vector_index_state
+        )
+
+
+def _prepare_metadata(metadata_dict: Dict[str, Any]):
+    if metadata_dict.get("embedding_storage") not in EMBEDDING_STORAGE_FORMATS:
+        metadata_dict["embedding_storage"] = DEFAULT_EMBEDDING_STORAGE
+    metadata_dict.setdefault("retrieval_mode", None)
+    current_time = datetime.datetime.now()
+    metadata_dict["last_saved_at"] = current_time
+    if not metadata_dict.get("created_at"):
+        metadata_dict["created_at"] = current_time
+    return current_time
+
+
 def save_session_data(
     filepath: str,
     metadata_dict: Dict[str, Any],
     messages_list: List[Dict[str, Any]],
-    context_data_list: List[Dict[str, Any]]
+    context_data_list: List[Dict[str, Any]],
+    vector_index_state: Optional[Dict[str, Any]] = None,
+    chunk_vectors: Optional[Dict[Tuple[str, int], np.ndarray]] = None
 ) -> bool:
     """
     Сохраняет (перезаписывает) все данные сессии в файл.
+    vector_index_state - кластеры IVF векторного индекса (VectorIndex.export_state()), если они обучались;
+    chunk_vectors - эмбеддинги чанков по ключу (file_path, chunk_num) (VectorIndex.export_vectors()).
     """
-    if not init_session_db(filepath):
+    if not filepath.endswith(SESSION_EXTENSION):
+        logger.error(f"Ошибка: Файл должен иметь расширение {SESSION_EXTENSION}, а не '{filepath}'")
         return False
 
+    # Пишем во временный файл и подменяем им сессию: при сбое посреди записи старый файл остается целым
+    temp_path = filepath + SAVE_TEMP_SUFFIX
     try:
         logger.info(f"Сохранение данных сессии в: {filepath}")
-        current_time = datetime.datetime.now()
-        metadata_dict["last_saved_at"] = current_time
-        if not metadata_dict.get("created_at"):
-            metadata_dict["created_at"] = current_time
+        current_time = _prepare_metadata(metadata_dict)
+        dir_name = os.path.dirname(filepath)
+        if dir_name:
+            os.makedirs(dir_name, exist_ok=True)
+        close_session(temp_path)
+        _remove_session_files(temp_path) # Остаток прерванной записи
 
-        with _get_connection(filepath) as conn:
+        with _session_connection(temp_path) as conn:
             if not conn: return False
             cursor = conn.cursor()
             cursor.execute("BEGIN TRANSACTION;")
 
             try:
-                # Сохранение метаданных
-                cursor.execute(
-                    """
-                    INSERT OR REPLACE INTO metadata (
-                        id, project_type, repo_url, repo_branch, local_path, rag_enabled,
-                        model_name, max_output_tokens, extensions, instructions,
-                        created_at, last_saved_at
-                    )
-                    VALUES (
-                        1, :project_type, :repo_url, :repo_branch, :local_path, :rag_enabled,
-                        :model_name, :max_output_tokens, :extensions, :instructions,
-                        :created_at, :last_saved_at
-                    )
-                    """,
-                    metadata_dict,
-                )
+                _save_metadata(cursor, metadata_dict)
 
-                # Сохранение сообщений (без изменений)
                 cursor.execute("DELETE FROM messages;")
-                messages_to_insert = [
-                    (
-                        msg.get("role"),
-                        (msg.get("parts", [""])[0] if msg.get("parts") else ""),
-                        current_time,
-                        index,
-                        1 if msg.get("excluded", False) else 0,
-                    )
-                    for index, msg in enumerate(messages_list)
-                ]
+                messages_to_insert = [_message_row(msg, index, current_time) for index, msg in enumerate(messages_list)]
                 cursor.executemany(
                     "INSERT INTO messages (role, content, timestamp, order_index, excluded_from_api) VALUES (?, ?, ?, ?, ?)",
                     messages_to_insert,
                 )
 
-                # Сохранение контекста
-                # Сохранение контекста
                 cursor.execute("DELETE FROM context_data;")
-                context_to_insert = []
-                for item in context_data_list:
-                    embedding_blob = None
-                    # Сериализация эмбеддинга, если он есть
-                    if 'embedding' in item and isinstance(item.get('embedding'), np.ndarray):
-                        try:
-                            buffer = BytesIO()
-                            np.save(buffer, item['embedding'])
-                            embedding_blob = buffer.getvalue()
-                        except Exception as e:
-                            logger.warning(f"Не удалось сериализовать эмбеддинг для '{item.get('file_path')}': {e}. Эмбеддинг не будет сохранен.")
-
-                    # --- НОВАЯ ЛОГИКА: Сериализация 'content' в JSON для типа 'structure' ---
-                    content_to_save = item.get("content")
-                    if item.get('type') == 'structure' and isinstance(content_to_save, dict):
-                        content_to_save = json.dumps(content_to_save, ensure_ascii=False)
-                    # --- КОНЕЦ НОВОЙ ЛОГИКИ ---
-
-                    chunk_num_val = item.get("chunk_num")
-                    if chunk_num_val is None or not isinstance(chunk_num_val, int):
-                        chunk_num_val = 0
-
-                    context_to_insert.append((
-                        item.get("file_path"),
-                        item.get("type"),
-                        chunk_num_val,
-                        content_to_save,
-                        embedding_blob
-                    ))
-
+                cursor.execute("DELETE FROM chunk_store;")
+                store_rows, context_to_insert = _context_rows(context_data_list, metadata_dict["embedding_storage"], chunk_vectors)
+                _save_chunk_store(cursor, store_rows)
                 if context_to_insert:
                     cursor.executemany(
-                        "INSERT INTO context_data (file_path, type, chunk_num, content, embedding) VALUES (?, ?, ?, ?, ?)",
+                        """
+                        INSERT INTO context_data (file_path, type, chunk_num, content, embedding, embedding_dtype, embedding_scale, content_hash)
+                        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                        """,
                         context_to_insert
                     )
 
+                _save_vector_index(cursor, vector_index_state)
+
                 conn.commit()
-                logger.info(f"Сессия успешно сохранена. Сообщений: {len(messages_to_insert)}, Элементов контекста: {len(context_to_insert)}")
+            except Exception as e:
+                logger.error(f"Ошибка во время транзакции сохранения сессии, откат: {e}", exc_info=True)
+                conn.rollback()
+                return False
+
+        # Закрытие переносит WAL в файл и синхронизирует его с диском; затем атомарная замена
+        close_session(temp_path)
+        close_session(filepath)
+        for journal in (filepath + "-wal", filepath + "-shm"):
+            if os.path.exists(journal): os.remove(journal) # Журнал старого файла не должен примениться к новому
+        os.replace(temp_path, filepath)
+        logger.info(
+            f"Сессия успешно сохранена. Сообщений: {len(messages_to_insert)}, Элементов контекста: {len(context_to_insert)}, "
+            f"уникальных чанков: {len({row[0] for row in store_rows})} из {len(store_rows)}"
+        )
+        return True
+
+    except sqlite3.Error as e:
+        logger.error(f"Ошибка SQLite при сохранении сессии {filepath}: {e}")
+        return False
+    except OSError as e:
+        logger.error(f"Ошибка файловой системы при замене файла сессии {filepath}: {e}")
+        return False
+    except Exception as e:
+        logger.error(f"Неожиданная ошибка при сохранении сессии {filepath}: {e}", exc_info=True)
+        return False
+
+
+def save_session_delta(
+    filepath: str,
+    metadata_dict: Dict[str, Any],
+    messages_list: List[Dict[str, Any]],
+    message_indices: List[int],
+    context_upserts: List[Dict[str, Any]],
+    removed_context_files: Set[str],
+    update_vector_index: bool = False,
+    vector_index_state: Optional[Dict[str, Any]] = None,
+    chunk_vectors: Optional[Dict[Tuple[str, int], np.ndarray]] = None
+) -> bool:
+    """
+    Записывает в уже сохраненную сессию только изменения (см. session_changes.SessionChanges):
+    сообщения с номерами message_indices (после переноса журнала истории чата в messages),
+    удаление контекста файлов removed_context_files и затем новые/измененные элементы context_upserts. Строки обновляются по ключам
+    order_index и (file_path, type, chunk_num). Эмбеддинги пишутся только для чанков из context_upserts
+    (chunk_vectors), а кластеры IVF (vector_index_state) перезаписываются, только если update_vector_index=True.
+    """
+    if not init_session_db(filepath):
+        return False
+
+    try:
+        logger.info(f"Сохранение изменений сессии в: {filepath}")
+        current_time = _prepare_metadata(metadata_dict)
+
+        with _session_connection(filepath) as conn:
+            if not conn: return False
+            cursor = conn.cursor()
+            cursor.execute("BEGIN TRANSACTION;")
+
+            try:
+                _save_metadata(cursor, metadata_dict)
+
+                # Сначала журнал: сообщения, записанные только в него, в снимок могут не входить
+                _fold_message_journal(cursor)
+                # Время сообщения - время его первой записи в файл
+                cursor.executemany(
+                    """
+                    INSERT INTO messages (role, content, timestamp, order_index, excluded_from_api) VALUES (?, ?, ?, ?, ?)
+                    ON CONFLICT(order_index) DO UPDATE SET
+                        role = excluded.role, content = excluded.content, excluded_from_api = excluded.excluded_from_api
+                    """,
+                    [_message_row(messages_list[index], index, current_time) for index in message_indices],
+                )
+                cursor.execute("DELETE FROM messages WHERE order_index >= ?;", (len(messages_list),))
+
+                store_rows, context_rows = _context_rows(context_upserts, metadata_dict["embedding_storage"], chunk_vectors)
+                # Содержимое, на которое ссылались удаляемые и перезаписываемые строки, может остаться без ссылок
+                replaced_hashes = _referenced_chunk_hashes(cursor, removed_context_files, context_rows)
+                if removed_context_files:
+                    cursor.executemany("DELETE FROM context_data WHERE file_path = ?;", [(path,) for path in removed_context_files])
+                if context_upserts:
+                    _save_chunk_store(cursor, store_rows)
+                    cursor.executemany(
+                        """
+                        INSERT INTO context_data (file_path, type, chunk_num, content, embedding, embedding_dtype, embedding_scale, content_hash)
+                        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                        ON CONFLICT(file_path, type, chunk_num) DO UPDATE SET
+                            content = excluded.content, embedding = excluded.embedding,
+                            embedding_dtype = excluded.embedding_dtype, embedding_scale = excluded.embedding_scale,
+                            content_hash = excluded.content_hash
+                        """,
+                        context_rows
+                    )
+                _delete_unreferenced_chunks(cursor, replaced_hashes)
+
+                if update_vector_index:
+                    _save_vector_index(cursor, vector_index_state)
+
+                conn.commit()
+                _checkpoint(conn)
+                logger.info(
+                    f"Изменения сессии сохранены. Сообщений: {len(message_indices)}, "
+                    f"элементов контекста: {len(context_upserts)}, удалено файлов: {len(removed_context_files)}, "
+                    f"кластеры векторного индекса: {'перезаписаны' if update_vector_index else 'без изменений'}"
+                )
                 return True
 
             except Exception as e:
-                logger.error(f"Ошибка во время транзакции сохранения сессии, откат: {e}", exc_info=True)
+                logger.error(f"Ошибка во время транзакции сохранения изменений сессии, откат: {e}", exc_info=True)
                 conn.rollback()
                 return False
 
@@ -326,4 +1160,114 @@ def save_session_data(
         return False
     except Exception as e:
         logger.error(f"Неожиданная ошибка при сохранении сессии {filepath}: {e}", exc_info=True)
-        return False
\ No newline at end of file
+        return False
+
+
+def _prune_vector_index(cursor: sqlite3.Cursor) -> int:
+    """
+    Убирает из сохраненных кластеров IVF назначения чанков, которых больше нет в context_data
+    (строку vector_index записи изменений не трогают, см. save_session_delta). Возвращает число убранных.
+    """
+    state = cursor.execute("SELECT keys, ann_assignments FROM vector_index WHERE id = 1 AND ann_assignments IS NOT NULL;").fetchone()
+    if not state: return 0
+    existing = {
+        (row['file_path'], row['chunk_num'] or 0)
+        for row in cursor.execute("SELECT file_path, chunk_num FROM context_data WHERE type = 'chunk';")
+    }
+    keys = [(path, int(num)) for path, num in json.loads(state['keys'])]
+    assignments = np.frombuffer(state['ann_assignments'], dtype=np.int32)
+    kept = [row for row, key in enumerate(keys) if key in existing]
+    if len(kept) == len(keys): return 0
+    cursor.execute(
+        "UPDATE vector_index SET count = ?, keys = ?, ann_assignments = ? WHERE id = 1;",
+        (len(kept), json.dumps([keys[row] for row in kept], ensure_ascii=False), assignments[kept].tobytes())
+    )
+    return len(keys) - len(kept)
+
+
+def _session_files_size(filepath: str) -> int:
+    """Размер файла сессии вместе с журналом WAL."""
+    return sum(os.path.getsize(path) for path in (filepath, filepath + "-wal") if os.path.exists(path))
+
+
+def compact_session(filepath: str) -> Optional[Dict[str, int]]:
+    """
+    Сжимает файл сессии: переносит текст и эмбеддинги чанков, записанных до появления
+    chunk_store, в хранилище с дедупликацией (эмбеддинг одинаковых чанков хранится один раз),
+    удаляет неиспользуемое содержимое и назначения кластеров IVF удаленных чанков, выполняет VACUUM.
+    id строк context_data не меняются, поэтому лениво открытая сессия остается рабочей.
+    Возвращает отчет или None при ошибке:
+        bytes_before, bytes_after, bytes_reclaimed - размер файла (с журналом WAL) до и после;
+        chunks_moved - перенесено чанков в chunk_store;
+        duplicate_chunks - чанков, чье содержимое хранится в единственном экземпляре у другого чанка;
+        unused_removed - удалено записей chunk_store без ссылок.
+    """
+    if not init_session_db(filepath):
+        return None
+
+    try:
+        logger.info(f"Сжатие файла сессии: {filepath}")
+        with _session_connection(filepath) as conn:
+            if not conn: return None
+            _checkpoint(conn)
+            bytes_before = _session_files_size(filepath)
+            cursor = conn.cursor()
+            cursor.execute("BEGIN TRANSACTION;")
+            try:
+                chunks_moved = 0
+                while True:
+                    rows = conn.execute(
+                        """
+                        SELECT id, content, embedding, embedding_dtype, embedding_scale FROM context_data
+                        WHERE type = 'chunk' AND content_hash IS NULL LIMIT ?
+                        """,
+                        (CONTEXT_READ_BATCH,)
+                    ).fetchall()
+                    if not rows: break
+                    store_rows = [
+                        (content_hash(row['content']), row['content'], row['embedding'], row['embedding_dtype'], row['embedding_scale'])
+                        for row in rows
+                    ]
+                    _save_chunk_store(cursor, store_rows)
+                    cursor.executemany(
+                        """
+                        UPDATE context_data SET content = '', embedding = NULL, embedding_dtype = NULL,
+                            embedding_scale = NULL, content_hash = ?
+                        WHERE id = ?
+                        """,
+                        [(store_row[0], row['id']) for store_row, row in zip(store_rows, rows)]
+                    )
+                    chunks_moved += len(rows)
+                unused_removed = _delete_unreferenced_chunks(cursor)
+                index_keys_removed = _prune_vector_index(cursor)
+                conn.commit()
+            except Exception as e:
+                logger.error(f"Ошибка во время сжатия сессии, откат: {e}", exc_info=True)
+                conn.rollback()
+                return None
+
+            duplicate_chunks = conn.execute(
+                "SELECT COUNT(*) - COUNT(DISTINCT content_hash) AS n FROM context_data WHERE content_hash IS NOT NULL"
+            ).fetchone()['n']
+            conn.execute("VACUUM;") # Вне транзакции: пересобирает файл без свободных страниц
+            _checkpoint(conn)
+
+        bytes_after = _session_files_size(filepath)
+        report = {
+            "bytes_before": bytes_before, "bytes_after": bytes_after,
+            "bytes_reclaimed": max(0, bytes_before - bytes_after),
+            "chunks_moved": chunks_moved, "duplicate_chunks": duplicate_chunks, "unused_removed": unused_removed,
+        }
+        logger.info(
+            f"Сессия сжата: {bytes_before / (1024 * 1024):.1f} -> {bytes_after / (1024 * 1024):.1f} МБ, "
+            f"перенесено чанков {chunks_moved}, повторов {duplicate_chunks}, удалено неиспользуемых записей {unused_removed}, "
+            f"устаревших назначений кластеров IVF {index_keys_removed}"
+        )
+        return report
+
+    except sqlite3.Error as e:
+        logger.error(f"Ошибка SQLite при сжатии сессии {filepath}: {e}")
+        return None
+    except OSError as e:
+        logger.error(f"Ошибка файловой системы при сжатии сессии {filepath}: {e}")
+        return None
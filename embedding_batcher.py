@@ -0,0 +1,172 @@
+# --- Файл: embedding_batcher.py ---
+
+import time
+import logging
+import threading
+from typing import Callable, Dict, List, Optional, Sequence, Tuple, Hashable
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Лимиты одного запроса batchEmbedContents (с запасом относительно документации API)
+EMBEDDING_BATCH_MAX_ITEMS = 100
+EMBEDDING_BATCH_MAX_TOKENS = 20000
+# Грубая оценка длины текста в токенах, достаточная для нарезки запросов
+CHARS_PER_TOKEN_ESTIMATE = 4
+
+# Накопленные чанки, забранные take_pending(): (список чанков, {request_id: число чанков})
+PendingBatch = Tuple[List[Tuple[Hashable, int, str, int]], Dict[Hashable, int]]
+
+
+def estimate_tokens(text: str) -> int:
+    return len(text) // CHARS_PER_TOKEN_ESTIMATE + 1
+
+
+class EmbeddingBatcher:
+    """
+    Собирает чанки из многих файлов в запросы к API эмбеддингов, укладывающиеся в
+    лимиты по числу элементов и токенов, и раскладывает результаты обратно по файлам.
+
+    Неудачный запрос повторяется, разделенный пополам; после такой ошибки размер
+    батча уменьшается и затем постепенно восстанавливается (адаптивный размер).
+    embed_fn принимает список текстов и возвращает список векторов той же длины,
+    поэтому вместо Gemini API можно подставить локальный тестовый сервер.
+
+    add() и take_pending() вызываются из одного потока; embed() можно выполнять
+    в нескольких потоках одновременно (адаптивный размер и статистика общие).
+    """
+
+    def __init__(self,
+                 embed_fn: Callable[[List[str]], Sequence[Sequence[float]]],
+                 max_items: int = EMBEDDING_BATCH_MAX_ITEMS,
+                 max_tokens: int = EMBEDDING_BATCH_MAX_TOKENS,
+                 is_cancelled: Optional[Callable[[], bool]] = None,
+                 fatal_exceptions: Tuple[type, ...] = ()):
+        self._embed_fn = embed_fn
+        self.max_items = max(1, max_items)
+        self.max_tokens = max(1, max_tokens)
+        self._is_cancelled = is_cancelled or (lambda: False)
+        # Ошибки, при которых повтор бессмыслен (например, исчерпана квота): пробрасываются наверх
+        self._fatal_exceptions = fatal_exceptions
+        # Ошибки последнего flush() (по одной на чанк, который так и не удалось обработать)
+        self.last_errors: List[str] = []
+        self._lock = threading.Lock()
+
+        # Текущий (адаптивный) предел числа элементов в запросе
+        self._current_max_items = self.max_items
+        # Ожидающие чанки: (id запроса, позиция чанка в запросе, текст, оценка токенов)
+        self._pending: List[Tuple[Hashable, int, str, int]] = []
+        self._pending_sizes: Dict[Hashable, int] = {}
+        self._pending_tokens = 0
+
+        # Статистика для подбора параметров
+        self.total_chunks = 0
+        self.total_requests = 0
+        self.failed_requests = 0
+        self.total_seconds = 0.0
+
+    # --- Накопление ---
+    def add(self, request_id: Hashable, texts: List[str]):
+        """Добавляет чанки одного файла. Результат будет выдан flush() под тем же request_id."""
+        self._pending_sizes[request_id] = len(texts)
+        for position, text in enumerate(texts):
+            tokens = estimate_tokens(text)
+            self._pending.append((request_id, position, text, tokens))
+            self._pending_tokens += tokens
+
+    def pending_count(self) -> int:
+        return len(self._pending)
+
+    def is_full(self) -> bool:
+        """True, если накоплено достаточно чанков для полного запроса."""
+        return len(self._pending) >= self._current_max_items or self._pending_tokens >= self.max_tokens
+
+    # --- Отправка ---
+    def flush(self) -> Dict[Hashable, List[Optional[np.ndarray]]]:
+        """
+        Отправляет все накопленные чанки и возвращает {request_id: [вектор или None, ...]}.
+        None означает, что эмбеддинг для чанка получить не удалось (или операция отменена).
+        """
+        results, self.last_errors = self.embed(self.take_pending())
+        return results
+
+    def take_pending(self) -> PendingBatch:
+        """Забирает накопленные чанки для embed(); новые add() копятся уже для следующего батча."""
+        batch = (self._pending, self._pending_sizes)
+        self._pending, self._pending_sizes, self._pending_tokens = [], {}, 0
+        return batch
+
+    def embed(self, batch: PendingBatch) -> Tuple[Dict[Hashable, List[Optional[np.ndarray]]], List[str]]:
+        """
+        Отправляет чанки, забранные take_pending(), запросами в пределах лимитов.
+        Возвращает результаты, как flush(), и ошибки (по одной на чанк, который так и не удалось обработать).
+        """
+        pending, sizes = batch
+        results: Dict[Hashable, List[Optional[np.ndarray]]] = {request_id: [None] * size for request_id, size in sizes.items()}
+        errors: List[str] = []
+        if not pending:
+            return results, errors
+
+        started = time.perf_counter()
+        embedded_count = 0
+        start = 0
+        while start < len(pending) and not self._is_cancelled():
+            end = self._next_batch_end(pending, start)
+            batch_items = pending[start:end]
+            vectors = self._embed_with_split([item[2] for item in batch_items], errors)
+            for (request_id, position, _, _), vector in zip(batch_items, vectors):
+                results[request_id][position] = vector
+                if vector is not None: embedded_count += 1
+            start = end
+
+        elapsed = time.perf_counter() - started
+        with self._lock:
+            self.total_chunks += embedded_count
+            self.total_seconds += elapsed
+        rate = embedded_count / elapsed if elapsed > 0 else 0.0
+        logger.info(f"Эмбеддинги: {embedded_count}/{len(pending)} чанков за {elapsed:.2f} с ({rate:.1f} чанков/с), размер батча {self._current_max_items}.")
+        return results, errors
+
+    def _next_batch_end(self, pending: List[Tuple[Hashable, int, str, int]], start: int) -> int:
+        """Находит конец очередного батча в пределах лимитов по элементам и токенам."""
+        end, tokens = start, 0
+        while end < len(pending) and end - start < self._current_max_items:
+            item_tokens = pending[end][3]
+            if end > start and tokens + item_tokens > self.max_tokens:
+                break
+            tokens += item_tokens
+            end += 1
+        return end
+
+    def _embed_with_split(self, texts: List[str], errors: List[str]) -> List[Optional[np.ndarray]]:
+        """Отправляет батч; при ошибке повторяет его двумя половинами."""
+        if self._is_cancelled():
+            return [None] * len(texts)
+        try:
+            with self._lock: self.total_requests += 1
+            vectors = list(self._embed_fn(texts))
+            if len(vectors) != len(texts):
+                raise ValueError(f"ожидалось {len(texts)} эмбеддингов, получено {len(vectors)}")
+            # Успешный запрос: понемногу возвращаем размер батча к максимальному
+            with self._lock:
+                if len(texts) >= self._current_max_items and self._current_max_items < self.max_items:
+                    self._current_max_items = min(self.max_items, self._current_max_items + max(1, self._current_max_items // 4))
+            return [np.array(v) for v in vectors]
+        except self._fatal_exceptions:
+            with self._lock: self.failed_requests += 1
+            raise
+        except Exception as e:
+            with self._lock: self.failed_requests += 1
+            if len(texts) == 1:
+                logger.error(f"Не удалось получить эмбеддинг для чанка: {e}")
+                errors.append(str(e))
+                return [None]
+            half = len(texts) // 2
+            with self._lock: self._current_max_items = max(1, min(self._current_max_items, half))
+            logger.warning(f"Ошибка батча эмбеддингов из {len(texts)} чанков ({e}). Повтор двумя частями по {half}/{len(texts) - half}.")
+            return self._embed_with_split(texts[:half], errors) + self._embed_with_split(texts[half:], errors)
+
+    def throughput(self) -> float:
+        """Средняя пропускная способность в чанках в секунду за все flush()/embed() (время параллельных батчей суммируется)."""
+        return self.total_chunks / self.total_seconds if self.total_seconds > 0 else 0.0
@@ -0,0 +1,144 @@
+# --- Файл: keyword_index.py ---
+
+import re
+import sqlite3
+import logging
+from typing import Optional, Dict, List, Any, Iterable, Sequence, Tuple, Hashable
+
+from session_changes import ContextKey, context_key
+
+logger = logging.getLogger(__name__)
+
+# Режимы отбора фрагментов под вопрос пользователя:
+# semantic - по эмбеддингам (нужен запрос к API), keyword - BM25 по словам (без сети), hybrid - оба списка вместе
+RETRIEVAL_MODES = ("semantic", "keyword", "hybrid")
+DEFAULT_RETRIEVAL_MODE = "semantic"
+
+# Элементы контекста, попадающие в полнотекстовый индекс
+KEYWORD_INDEXED_TYPES = ("chunk", "summary")
+# unicode61 делит идентификаторы по '_' и пунктуации, не различает регистр и диакритику
+FTS_TOKENIZE = "unicode61 remove_diacritics 2"
+# Веса колонок BM25 (file_path, content, type): путь файла важнее текста, колонка type служит только фильтром
+FTS_BM25_WEIGHTS = (2.0, 1.0, 0.0)
+# Не больше стольких слов вопроса попадает в запрос MATCH
+MAX_QUERY_TERMS = 32
+# Слова короче этого не ищутся
+MIN_TERM_LENGTH = 2
+# Константа k метода reciprocal rank fusion (гибридный режим)
+RRF_K = 60
+
+_TERM_PATTERN = re.compile(r"\w+", re.UNICODE)
+
+
+def retrieval_uses_embeddings(mode: str) -> bool:
+    """Нужны ли режиму отбора эмбеддинги чанков (режиму keyword - нет, ему хватает текста)."""
+    return mode != "keyword"
+
+
+def query_terms(text: str) -> List[str]:
+    """Слова вопроса для запроса FTS5: без повторов, в кавычках (синтаксис FTS5 в вопросе не интерпретируется)."""
+    terms: List[str] = []
+    seen = set()
+    for term in _TERM_PATTERN.findall(text.lower()):
+        if len(term) < MIN_TERM_LENGTH or term in seen: continue
+        seen.add(term)
+        terms.append(f'"{term}"')
+        if len(terms) >= MAX_QUERY_TERMS: break
+    return terms
+
+
+def build_match_query(text: str, types: Sequence[str] = ("chunk",)) -> Optional[str]:
+    """
+    Переводит вопрос пользователя в запрос FTS5: любое из слов вопроса (OR, ранжирование BM25)
+    в пути или тексте элемента нужного типа. Возвращает None, если искать нечего.
+    """
+    terms = query_terms(text)
+    if not terms: return None
+    type_filter = " OR ".join(f'"{t}"' for t in types)
+    return f"type : ({type_filter}) AND {{file_path content}} : ({' OR '.join(terms)})"
+
+
+def bm25_rank_expression() -> str:
+    """Выражение для 'rank MATCH ?': BM25 с весами FTS_BM25_WEIGHTS."""
+    return f"bm25({', '.join(str(w) for w in FTS_BM25_WEIGHTS)})"
+
+
+def fuse_rankings(rankings: Iterable[List[Hashable]], k: int = RRF_K) -> List[Hashable]:
+    """
+    Объединяет несколько ранжированных списков ключей методом reciprocal rank fusion:
+    оценки разной природы (косинус и BM25) не сравниваются, учитываются только места в списках.
+    """
+    scores: Dict[Hashable, float] = {}
+    for ranking in rankings:
+        for place, key in enumerate(ranking):
+            scores[key] = scores.get(key, 0.0) + 1.0 / (k + place + 1)
+    return sorted(scores, key=lambda key: scores[key], reverse=True)
+
+
+class KeywordIndex:
+    """
+    Полнотекстовый индекс BM25 (SQLite FTS5 в памяти) по элементам контекста.
+    Дополняет индекс context_fts файла сессии элементами, которых в файле еще нет
+    (новая несохраненная сессия, только что проанализированные файлы).
+    Пополняется инкрементально (add, remove_files) по мере поступления результатов анализа;
+    запросы - в формате build_match_query().
+    """
+
+    def __init__(self, items: Iterable[Dict[str, Any]] = ()):
+        self._conn = sqlite3.connect(":memory:", check_same_thread=False)
+        self._conn.execute(
+            f"CREATE VIRTUAL TABLE keyword_fts USING fts5(file_path, content, type, chunk_num UNINDEXED, tokenize='{FTS_TOKENIZE}');"
+        )
+        self._rowids: Dict[ContextKey, int] = {}
+        self._next_rowid = 1
+        self.add(items)
+
+    def __len__(self) -> int:
+        return len(self._rowids)
+
+    def __contains__(self, key: ContextKey) -> bool:
+        return key in self._rowids
+
+    def add(self, items: Iterable[Dict[str, Any]]):
+        """Добавляет (или заменяет) элементы; элементы неиндексируемых типов и без текста пропускаются."""
+        rows, replaced = [], []
+        for item in items:
+            if item.get('type') not in KEYWORD_INDEXED_TYPES or not isinstance(item.get('content'), str): continue
+            key = context_key(item)
+            if key in self._rowids:
+                replaced.append((self._rowids[key],))
+            self._rowids[key] = self._next_rowid
+            rows.append((self._next_rowid, key[0], item['content'], key[1], key[2]))
+            self._next_rowid += 1
+        if not rows: return
+        self._conn.executemany("INSERT INTO keyword_fts (rowid, file_path, content, type, chunk_num) VALUES (?, ?, ?, ?, ?);", rows)
+        # После вставки: ключ мог повториться и в самом items
+        self._conn.executemany("DELETE FROM keyword_fts WHERE rowid = ?;", replaced)
+        self._conn.commit()
+
+    def remove_files(self, file_paths: Iterable[str]):
+        """Удаляет все элементы указанных файлов."""
+        paths = set(file_paths)
+        removed = [key for key in self._rowids if key[0] in paths]
+        if not removed: return
+        self._conn.executemany("DELETE FROM keyword_fts WHERE rowid = ?;", [(self._rowids.pop(key),) for key in removed])
+        self._conn.commit()
+
+    def search(self, match_query: str, limit: int) -> List[Tuple[ContextKey, float]]:
+        """До limit пар (ключ элемента, оценка BM25 - чем больше, тем релевантнее)."""
+        if not self._rowids: return []
+        try:
+            rows = self._conn.execute(
+                """
+                SELECT file_path, type, chunk_num, rank FROM keyword_fts
+                WHERE keyword_fts MATCH ? AND rank MATCH ? ORDER BY rank LIMIT ?
+                """,
+                (match_query, bm25_rank_expression(), limit)
+            ).fetchall()
+        except sqlite3.Error as e:
+            logger.warning(f"Ошибка полнотекстового поиска в памяти: {e}")
+            return []
+        return [((file_path, item_type, chunk_num), -rank) for file_path, item_type, chunk_num, rank in rows]
+
+    def close(self):
+        self._conn.close()
@@ -8,9 +8,9 @@ APP_ICON_FILENAME = "app_icon.png"
 
 import sys
 import os
+import multiprocessing
 import html
 import json
-import markdown
 import logging
 import logging.handlers
 import datetime
@@ -36,6 +36,10 @@ from chat_view import ChatView
 from chat_viewmodel import ChatViewModel
 from summaries_window import SummariesWindow
 from log_viewer_window import LogViewerWindow
+from summarizer import DEFAULT_ANALYSIS_CONCURRENCY, MAX_ANALYSIS_CONCURRENCY
+from analysis_pool import DEFAULT_ANALYSIS_PROCESSES, MAX_ANALYSIS_PROCESSES
+from vector_index import MAX_ANN_NPROBE
+from markdown_renderer import get_markdown_cache, render_markdown
 import db_manager
 
 try:
@@ -228,11 +232,16 @@ class MainWindow(QMainWindow):
         projects_layout = QVBoxLayout(self.projects_panel)
         projects_layout.setContentsMargins(0, 0, 0, 0)
         projects_label = QLabel(self.tr("<b>Недавние проекты</b>"))
+        self.projects_search_lineedit = QLineEdit()
+        self.projects_search_lineedit.setPlaceholderText(self.tr("Поиск по сессиям..."))
+        self.projects_search_lineedit.setToolTip(self.tr("Поиск по сообщениям и саммари всех сохраненных сессий"))
+        self.projects_search_lineedit.setClearButtonEnabled(True)
         self.projects_list_widget = QListWidget()
         self.projects_list_widget.setToolTip(self.tr("Двойной клик для открытия сессии"))
         self.projects_list_widget.setContextMenuPolicy(Qt.ContextMenuPolicy.CustomContextMenu)
         self.projects_list_widget.customContextMenuRequested.connect(self._show_projects_context_menu)
         projects_layout.addWidget(projects_label)
+        projects_layout.addWidget(self.projects_search_lineedit)
         projects_layout.addWidget(self.projects_list_widget)
         splitter.addWidget(self.projects_panel)
 
@@ -347,12 +356,44 @@ class MainWindow(QMainWindow):
         self.rag_enabled_checkbox = QCheckBox(self.tr("Исп. RAG (чанки)"))
         self.rag_enabled_checkbox.setToolTip(self.tr("Если включено, файлы будут разбиваться на чанки и саммари.\nЕсли выключено, файлы будут использоваться целиком."))
 
-        self.semantic_search_checkbox = QCheckBox(self.tr("Семантический поиск"))
-        self.semantic_search_checkbox.setToolTip(self.tr("Если включено, в контекст будут попадать только\nнаиболее релевантные вопросу фрагменты кода."))
+        self.semantic_search_checkbox = QCheckBox(self.tr("Поиск фрагментов"))
+        self.semantic_search_checkbox.setToolTip(self.tr("Если включено, в контекст будут попадать только\nнаиболее релевантные вопросу фрагменты кода.\nПри анализе для фрагментов запрашиваются эмбеддинги.\nПоиск по ключевым словам работает и без этой настройки."))
+        self.retrieval_mode_combobox = QComboBox()
+        self.retrieval_mode_combobox.addItem(self.tr("Семантический"), "semantic")
+        self.retrieval_mode_combobox.addItem(self.tr("По ключевым словам"), "keyword")
+        self.retrieval_mode_combobox.addItem(self.tr("Гибридный"), "hybrid")
+        self.retrieval_mode_combobox.setToolTip(self.tr("Как отбирать фрагменты:\nсемантический - по смыслу (запрос эмбеддинга к API),\nпо ключевым словам - BM25 по словам вопроса (без сети),\nгибридный - оба способа вместе."))
+
+        self.ann_search_checkbox = QCheckBox(self.tr("Приближенный поиск"))
+        self.ann_search_checkbox.setToolTip(self.tr("Для очень больших проектов: искать только в ближайших\nкластерах фрагментов (IVF) вместо полного перебора."))
+        self.ann_nprobe_spinbox = QSpinBox(); self.ann_nprobe_spinbox.setRange(1, MAX_ANN_NPROBE)
+        self.ann_nprobe_spinbox.setToolTip(self.tr("Сколько кластеров просматривать на запрос.\nБольше - точнее, но медленнее."))
+
+        embedding_storage_label = QLabel(self.tr("Эмбеддинги:"))
+        self.embedding_storage_combobox = QComboBox(); self.embedding_storage_combobox.addItems(db_manager.EMBEDDING_STORAGE_FORMATS)
+        self.embedding_storage_combobox.setToolTip(self.tr("Формат хранения эмбеддингов в файле сессии.\nfloat16 и int8 - меньше файл, чуть ниже точность поиска."))
+
+        concurrency_label = QLabel(self.tr("Потоков анализа:"))
+        self.analysis_concurrency_spinbox = QSpinBox(); self.analysis_concurrency_spinbox.setRange(1, MAX_ANALYSIS_CONCURRENCY)
+        self.analysis_concurrency_spinbox.setToolTip(self.tr("Сколько файлов анализировать одновременно.\n1 - последовательный анализ."))
+        processes_label = QLabel(self.tr("Процессов разбора:"))
+        self.analysis_processes_spinbox = QSpinBox(); self.analysis_processes_spinbox.setRange(0, MAX_ANALYSIS_PROCESSES)
+        self.analysis_processes_spinbox.setToolTip(self.tr("Разбор кода, разбиение на фрагменты и чтение PDF/DOCX\nна нескольких ядрах процессора. 0 - в потоках анализа."))
 
         rag_layout.addWidget(self.rag_enabled_checkbox)
         rag_layout.addSpacing(20)
         rag_layout.addWidget(self.semantic_search_checkbox)
+        rag_layout.addWidget(self.retrieval_mode_combobox)
+        rag_layout.addWidget(self.ann_search_checkbox)
+        rag_layout.addWidget(self.ann_nprobe_spinbox)
+        rag_layout.addSpacing(20)
+        rag_layout.addWidget(embedding_storage_label)
+        rag_layout.addWidget(self.embedding_storage_combobox)
+        rag_layout.addSpacing(20)
+        rag_layout.addWidget(concurrency_label)
+        rag_layout.addWidget(self.analysis_concurrency_spinbox)
+        rag_layout.addWidget(processes_label)
+        rag_layout.addWidget(self.analysis_processes_spinbox)
         rag_layout.addStretch(1)
         settings_inner_layout.addLayout(rag_layout)
 
@@ -441,9 +482,15 @@ class MainWindow(QMainWindow):
             (self.tr("&Открыть сессию..."), QKeySequence.StandardKey.Open, self.view_model.openSession),
             (self.tr("&Сохранить сессию"), QKeySequence.StandardKey.Save, self.view_model.saveSession),
             (self.tr("Сохранить сессию &как..."), QKeySequence.StandardKey.SaveAs, self.view_model.saveSessionAs),
+            (self.tr("Сжать &файл сессии"), None, self.view_model.compactSession),
             None,
         ]
 
+        self.autosave_action = QAction(self.tr("&Автосохранение"), self)
+        self.autosave_action.setCheckable(True)
+        self.autosave_action.setToolTip(self.tr("Периодически сохранять измененную сессию в ее файл в фоне."))
+        self.autosave_action.toggled.connect(self.view_model.updateAutosaveEnabled)
+
             # --- НОВАЯ ЛОГИКА: Добавление подменю экспорта ---
         export_menu = file_menu.addMenu(self.tr("Экспорт диалога"))
         export_markdown_action = QAction(self.tr("в Markdown..."), self)
@@ -472,6 +519,8 @@ class MainWindow(QMainWindow):
                 file_menu.addAction(action)
             else:
                 file_menu.addSeparator()
+        file_menu.addAction(self.autosave_action)
+        file_menu.addSeparator()
         
         self._create_language_menu()
         view_menu = menu_bar.addMenu(self.tr("&Вид"))
@@ -524,6 +573,7 @@ class MainWindow(QMainWindow):
         self.toggle_projects_button.clicked.connect(self._toggle_projects_panel)
         
         self.projects_list_widget.itemDoubleClicked.connect(self._on_recent_project_selected)
+        self.projects_search_lineedit.textChanged.connect(self._load_recent_projects)
 
         self.api_key_save_button.clicked.connect(lambda: self.view_model.saveGeminiApiKey(self.api_key_lineedit.text()))
         self.github_token_save_button.clicked.connect(lambda: self.view_model.saveGithubToken(self.github_token_lineedit.text()))
@@ -539,6 +589,13 @@ class MainWindow(QMainWindow):
         self.max_tokens_spinbox.valueChanged.connect(self.view_model.updateMaxTokens)
         self.rag_enabled_checkbox.stateChanged.connect(lambda state: self.view_model.updateRagEnabled(state == Qt.CheckState.Checked.value))
         self.semantic_search_checkbox.stateChanged.connect(lambda state: self.view_model.updateSemanticSearchEnabled(state == Qt.CheckState.Checked.value))
+        self.ann_search_checkbox.stateChanged.connect(lambda state: self.view_model.updateAnnEnabled(state == Qt.CheckState.Checked.value))
+        self.ann_nprobe_spinbox.valueChanged.connect(self.view_model.updateAnnNprobe)
+        self.embedding_storage_combobox.currentTextChanged.connect(self.view_model.updateEmbeddingStorage)
+        self.retrieval_mode_combobox.currentIndexChanged.connect(lambda index: self.view_model.updateRetrievalMode(self.retrieval_mode_combobox.itemData(index)))
+        self.ann_search_checkbox.toggled.connect(self.ann_nprobe_spinbox.setEnabled)
+        self.analysis_concurrency_spinbox.valueChanged.connect(self.view_model.updateAnalysisConcurrency)
+        self.analysis_processes_spinbox.valueChanged.connect(self.view_model.updateAnalysisProcesses)
         self.instructions_textedit.textChanged.connect(self._on_instructions_changed)
         for checkbox in self.common_ext_checkboxes.values(): checkbox.stateChanged.connect(self._on_extensions_changed)
         self.custom_ext_lineedit.editingFinished.connect(self._on_extensions_changed)
@@ -578,6 +635,11 @@ class MainWindow(QMainWindow):
         self.view_model.instructionsTextChanged.connect(self._update_settings_fields)
         self.view_model.ragEnabledChanged.connect(self._update_settings_fields)
         self.view_model.semanticSearchEnabledChanged.connect(self._update_settings_fields)
+        self.view_model.annSearchChanged.connect(self._update_settings_fields)
+        self.view_model.embeddingStorageChanged.connect(self._update_settings_fields)
+        self.view_model.retrievalModeChanged.connect(self._update_settings_fields)
+        self.view_model.analysisConcurrencyChanged.connect(self._update_settings_fields)
+        self.view_model.analysisProcessesChanged.connect(self._update_settings_fields)
         self.view_model.projectTypeChanged.connect(self._update_project_fields)
         self.view_model.repoUrlChanged.connect(self._update_project_fields)
         self.view_model.localPathChanged.connect(self._update_project_fields)
@@ -712,7 +774,7 @@ class MainWindow(QMainWindow):
         self.cancel_analysis_button.setEnabled(self.view_model.canCancelAnalysis)
         self.update_context_button.setEnabled(self.view_model.canUpdateFromGit)
         has_history = bool(self.view_model.getChatHistoryForView()[0])
-        has_summaries = bool(self.view_model._model._project_context)
+        has_summaries = self.view_model._model.has_project_context()
         self.view_summaries_button.setEnabled(has_summaries)
         self.toggle_all_msg_button.setEnabled(has_history)
 
@@ -765,9 +827,21 @@ class MainWindow(QMainWindow):
         is_rag_enabled = self.view_model.ragEnabled
         self.rag_enabled_checkbox.setChecked(is_rag_enabled)
 
-        # Управляем доступностью и состоянием чекбокса семантического поиска
-        self.semantic_search_checkbox.setEnabled(is_rag_enabled)
+        # Управляем доступностью и состоянием чекбокса семантического поиска.
+        # Режиму "по ключевым словам" эмбеддинги не нужны: ему достаточно RAG, и чекбокс не участвует
+        is_keyword_mode = self.view_model.retrievalMode == "keyword"
+        self.retrieval_mode_combobox.setEnabled(is_rag_enabled)
+        self.retrieval_mode_combobox.setCurrentIndex(max(0, self.retrieval_mode_combobox.findData(self.view_model.retrievalMode)))
+        self.semantic_search_checkbox.setEnabled(is_rag_enabled and not is_keyword_mode)
         self.semantic_search_checkbox.setChecked(is_rag_enabled and self.view_model.semanticSearchEnabled)
+        is_semantic_enabled = is_rag_enabled and self.view_model.semanticSearchEnabled and not is_keyword_mode
+        self.ann_search_checkbox.setEnabled(is_semantic_enabled)
+        self.ann_search_checkbox.setChecked(self.view_model.annEnabled)
+        self.ann_nprobe_spinbox.setEnabled(is_semantic_enabled and self.view_model.annEnabled)
+        self.ann_nprobe_spinbox.setValue(self.view_model.annNprobe)
+        self.embedding_storage_combobox.setCurrentText(self.view_model.embeddingStorage)
+        self.analysis_concurrency_spinbox.setValue(self.view_model.analysisConcurrency)
+        self.analysis_processes_spinbox.setValue(self.view_model.analysisProcesses)
 
         if self.instructions_textedit.toPlainText() != self.view_model.instructionsText:
             self.instructions_textedit.setPlainText(self.view_model.instructionsText)
@@ -783,37 +857,48 @@ class MainWindow(QMainWindow):
     def _render_chat_view(self):
         if not self.view_model.isChatViewReady: return
         history, last_error, intermediate_step = self.view_model.getChatHistoryForView()
-        
-        self.dialog_textedit.clear_chat()
-        md_ext = ["fenced_code", "codehilite", "nl2br", "tables"]
-
-        for index, msg in enumerate(history):
-            role = msg.get("role")
-            content = msg.get("parts", [""])[0]
-            is_excluded = msg.get("excluded", False)
-            
-            html_out = ""
-            if role == "model":
-                html_out = markdown.markdown(content, extensions=md_ext)
-            elif role == "user":
-                html_out = f"<pre>{html.escape(content)}</pre>"
-            elif role == "system":
-                # Для системных сообщений просто экранируем HTML и оборачиваем в теги
-                html_out = f"<i>{html.escape(content)}</i>"
-            
-            # Добавляем разделитель для всех, кроме системных
-            if role != "system":
-                html_out += "<hr>"
-
-            self.dialog_textedit.add_message(role, html_out, index, is_excluded, is_last=False)
-            self._update_toggle_all_button()
-
-        # Обработка промежуточных шагов, лоадера и ошибок остается без изменений
+
+        # Историю обновляем точечно: неизмененные сообщения остаются в DOM без повторного рендеринга
+        self.dialog_textedit.clear_transient_elements()
+        messages_added = self.dialog_textedit.update_messages(history, self._render_message_html, self._is_message_html_final)
+        self._update_toggle_all_button()
+
+        # Промежуточные шаги, лоадер, ошибки и черновик ответа пересоздаются при каждом обновлении
+        is_busy = self.view_model.canCancelRequest or self.view_model.canCancelAnalysis
         if intermediate_step: self.dialog_textedit.add_message("system", f"<i>{html.escape(intermediate_step)}</i>", -1, False, is_last=False)
-        if self.view_model.canCancelRequest or self.view_model.canCancelAnalysis: self.dialog_textedit.show_loader()
+        if is_busy: self.dialog_textedit.show_loader()
+        streaming_text = self.view_model.getStreamingResponseText()
+        if streaming_text: self.dialog_textedit.show_streaming_text(streaming_text)
         if last_error: self.dialog_textedit.add_error_message(last_error)
-        
-        self.dialog_textedit.scroll_to_bottom()
+
+        if messages_added or intermediate_step or is_busy or last_error:
+            self.dialog_textedit.scroll_to_bottom()
+
+    def _render_message_html(self, msg: Dict) -> str:
+        role = msg.get("role")
+        content = msg.get("parts", [""])[0]
+
+        html_out = ""
+        if role == "model":
+            if self._is_message_html_final(msg):
+                html_out = render_markdown(content)
+            else:
+                # Пока ответ рендерится в фоне, показываем его как текст, чтобы не блокировать интерфейс
+                html_out = f"<pre>{html.escape(content)}</pre>"
+        elif role == "user":
+            html_out = f"<pre>{html.escape(content)}</pre>"
+        elif role == "system":
+            # Для системных сообщений просто экранируем HTML и оборачиваем в теги
+            html_out = f"<i>{html.escape(content)}</i>"
+
+        # Добавляем разделитель для всех, кроме системных
+        if role != "system":
+            html_out += "<hr>"
+        return html_out
+
+    def _is_message_html_final(self, msg: Dict) -> bool:
+        if msg.get("role") != "model" or not self.view_model.isMarkdownPrerenderActive(): return True
+        return get_markdown_cache().contains(msg.get("parts", [""])[0])
     @Slot(str, int)
     def _update_status_bar(self, message, timeout): self._status_clear_timer.stop(); self.statusBar().showMessage(message, 0); \
         (self._status_clear_timer.start(timeout) if timeout > 0 else None)
@@ -837,6 +922,15 @@ class MainWindow(QMainWindow):
             if splitter_state:
                 self.main_splitter.restoreState(splitter_state)
 
+        # Параллельность анализа - настройка приложения, а не сессии
+        concurrency = self.settings.value("analysis/concurrency", DEFAULT_ANALYSIS_CONCURRENCY, type=int)
+        self.view_model.updateAnalysisConcurrency(concurrency)
+        processes = self.settings.value("analysis/processes", DEFAULT_ANALYSIS_PROCESSES, type=int)
+        self.view_model.updateAnalysisProcesses(processes)
+        autosave = self.settings.value("session/autosave", True, type=bool)
+        self.autosave_action.setChecked(autosave)
+        self.view_model.updateAutosaveEnabled(autosave)
+
         self._load_recent_projects()
 
     @Slot(str, str, str)
@@ -852,20 +946,53 @@ class MainWindow(QMainWindow):
         self.settings.setValue("window/size", self.size())
         self.settings.setValue("window/pos", self.pos())
         self.settings.setValue("window/projectsPanelCollapsed", not self.projects_panel.isVisible())
+        self.settings.setValue("analysis/concurrency", self.view_model.analysisConcurrency)
+        self.settings.setValue("analysis/processes", self.view_model.analysisProcesses)
+        self.settings.setValue("session/autosave", self.view_model.autosaveEnabled)
 
         # Сохраняем состояние сплиттера только если панель видима
         if self.projects_panel.isVisible():
             self.settings.setValue("window/splitterState", self.main_splitter.saveState())
         
+    @Slot()
     def _load_recent_projects(self):
+        """Заполняет список недавними проектами или, если задан поиск, найденными сессиями."""
         self.projects_list_widget.clear()
-        paths = self.settings.value("recentProjects/list", [], type=list)
+        query = self.projects_search_lineedit.text().strip()
+        if query:
+            self._show_session_search_results(query)
+            return
+        paths = [path for path in self.settings.value("recentProjects/list", [], type=list) if os.path.exists(path)]
+        catalog_info = self.view_model.getSessionsInfo(paths)
         for path in paths:
-            if os.path.exists(path):
-                item = QListWidgetItem(os.path.basename(path).replace(db_manager.SESSION_EXTENSION, ""))
-                item.setData(Qt.ItemDataRole.UserRole, path)
-                item.setToolTip(path)
-                self.projects_list_widget.addItem(item)
+            item = QListWidgetItem(os.path.basename(path).replace(db_manager.SESSION_EXTENSION, ""))
+            item.setData(Qt.ItemDataRole.UserRole, path)
+            item.setToolTip(self._session_tooltip(path, catalog_info.get(path)))
+            self.projects_list_widget.addItem(item)
+
+    def _show_session_search_results(self, query: str):
+        for result in self.view_model.searchSessions(query):
+            path = result["path"]
+            if not os.path.exists(path): continue
+            item = QListWidgetItem(f"{result['title']} ({result['match_count']})")
+            item.setData(Qt.ItemDataRole.UserRole, path)
+            item.setToolTip(self._session_tooltip(path, result) + "\n\n" + result["snippet"])
+            self.projects_list_widget.addItem(item)
+
+    def _session_tooltip(self, path: str, info: Optional[Dict]) -> str:
+        """Подсказка для сессии в списке проектов: путь и сведения из каталога сессий."""
+        if not info: return path
+        lines = [path]
+        if info.get("project_source"):
+            lines.append(self.tr("Проект: {0}").format(info["project_source"]))
+        if info.get("model_name"):
+            lines.append(self.tr("Модель: {0}").format(info["model_name"]))
+        lines.append(self.tr("Сообщений: {0}, файлов: {1}, чанков: {2}").format(
+            info.get("message_count", 0), info.get("file_count", 0), info.get("chunk_count", 0)))
+        if info.get("saved_at"):
+            saved_at = datetime.datetime.fromtimestamp(info["saved_at"]).strftime("%Y-%m-%d %H:%M")
+            lines.append(self.tr("Сохранено: {0}").format(saved_at))
+        return "\n".join(lines)
                 
     @Slot(str)
     def _add_to_recent_projects(self, filepath: str):
@@ -943,6 +1070,8 @@ class MainWindow(QMainWindow):
             event.ignore()
             return
         self._save_settings()
+        self.view_model.shutdown() # Дожидается фоновой записи сессии
+        db_manager.close_all_sessions()
         if self._log_viewer_window: self._log_viewer_window.close()
         event.accept()
 
@@ -1145,4 +1274,5 @@ def main():
     sys.exit(app.exec())
 
 if __name__ == "__main__":
+    multiprocessing.freeze_support() # Процессы пула анализа в собранном приложении
     main()
\ No newline at end of file
@@ -0,0 +1,120 @@
+# --- Файл: markdown_renderer.py ---
+
+import hashlib
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional, List, Tuple
+
+import markdown
+from PySide6.QtCore import QObject, Signal, Slot
+
+logger = logging.getLogger(__name__)
+
+# Расширения markdown для ответов модели (чат и экспорт в HTML)
+MARKDOWN_EXTENSIONS: Tuple[str, ...] = ("fenced_code", "codehilite", "nl2br", "tables")
+# Сколько отрендеренных сообщений держать в памяти
+MARKDOWN_CACHE_MAX_ENTRIES = 2000
+# Фоновый предрендеринг запускается для сессий не короче этого числа сообщений модели
+MARKDOWN_PRERENDER_MIN_MESSAGES = 20
+# Как часто (в сообщениях) фоновый рендеринг сообщает о прогрессе
+MARKDOWN_PRERENDER_PROGRESS_STEP = 25
+
+
+class MarkdownRenderCache:
+    """
+    Ограниченный LRU-кэш HTML, полученного из markdown (с подсветкой кода Pygments).
+    Ключ - хэш текста и набор расширений. Потокобезопасен: наполняется и из фонового потока.
+    """
+
+    def __init__(self, max_entries: int = MARKDOWN_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[Tuple[str, Tuple[str, ...]], str]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(text: str, extensions: Tuple[str, ...]) -> Tuple[str, Tuple[str, ...]]:
+        return hashlib.sha1(text.encode("utf-8", errors="ignore")).hexdigest(), tuple(extensions)
+
+    def contains(self, text: str, extensions: Tuple[str, ...] = MARKDOWN_EXTENSIONS) -> bool:
+        key = self.make_key(text, extensions)
+        with self._lock:
+            return key in self._entries
+
+    def render(self, text: str, extensions: Tuple[str, ...] = MARKDOWN_EXTENSIONS) -> str:
+        key = self.make_key(text, extensions)
+        with self._lock:
+            cached = self._entries.get(key)
+            if cached is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return cached
+            self.misses += 1
+
+        # Рендерим вне блокировки: это самая долгая часть, и ее не нужно сериализовать
+        rendered = markdown.markdown(text, extensions=list(extensions))
+        with self._lock:
+            self._entries[key] = rendered
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return rendered
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+_shared_cache: Optional[MarkdownRenderCache] = None
+
+
+def get_markdown_cache() -> MarkdownRenderCache:
+    """Общий кэш для окна чата и экспорта."""
+    global _shared_cache
+    if _shared_cache is None:
+        _shared_cache = MarkdownRenderCache()
+    return _shared_cache
+
+
+def render_markdown(text: str, extensions: Tuple[str, ...] = MARKDOWN_EXTENSIONS) -> str:
+    return get_markdown_cache().render(text, extensions)
+
+
+class MarkdownPrerenderWorker(QObject):
+    """
+    Фоновый рендеринг ответов модели только что загруженной сессии в общий кэш,
+    чтобы окно чата не подсвечивало сотни блоков кода в потоке интерфейса.
+    Начинает с последних сообщений - они видны первыми.
+    """
+    progress = Signal(int, int) # готово, всего
+    finished = Signal()
+
+    def __init__(self, texts: List[str], extensions: Tuple[str, ...] = MARKDOWN_EXTENSIONS):
+        super().__init__()
+        self._texts = texts
+        self._extensions = extensions
+        self._is_cancelled = False
+
+    def cancel(self):
+        self._is_cancelled = True
+
+    @Slot()
+    def run(self):
+        cache = get_markdown_cache()
+        started = time.perf_counter()
+        total = len(self._texts)
+        done = 0
+        for text in reversed(self._texts):
+            if self._is_cancelled: break
+            try:
+                cache.render(text, self._extensions)
+            except Exception as e:
+                logger.warning(f"Фоновый рендеринг markdown: ошибка ({e}), сообщение будет отрендерено при показе.")
+            done += 1
+            if done % MARKDOWN_PRERENDER_PROGRESS_STEP == 0:
+                self.progress.emit(done, total)
+        logger.info(f"Фоновый рендеринг markdown: {done}/{total} сообщений за {time.perf_counter() - started:.2f} с.")
+        self.finished.emit()
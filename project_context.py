@@ -0,0 +1,123 @@
+# --- Файл: project_context.py ---
+
+import logging
+from typing import Optional, Dict, List, Any, Iterable, Iterator, Sequence
+
+from vector_index import VectorIndex, VectorKey
+
+logger = logging.getLogger(__name__)
+
+# Порядок типов внутри файла при обходе всего контекста (как их выдает SummarizerWorker)
+CONTEXT_TYPES = ("summary", "structure", "chunk", "full_file")
+
+
+def chunk_key(item: Dict[str, Any]) -> VectorKey:
+    chunk_num = item.get('chunk_num')
+    return item.get('file_path'), chunk_num if isinstance(chunk_num, int) else 0
+
+
+class ProjectContextStore:
+    """
+    Контекст проекта (саммари, структура, чанки, файлы целиком), разложенный по файлам и типам.
+    Выборка элементов одного типа или одного файла не требует прохода по всему контексту,
+    а замена элементов файла (переанализ после изменений в Git) стоит столько, сколько
+    элементов у этого файла.
+
+    Эмбеддинги чанков хранятся только в матрице векторного индекса (vector_index):
+    при добавлении они переносятся туда, а ключ 'embedding' из элемента удаляется.
+    Для записи в файл сессии векторы берутся из индекса (см. VectorIndex.export_vectors).
+    """
+
+    def __init__(self):
+        self.vector_index = VectorIndex()
+        self.clear()
+
+    def clear(self):
+        self.vector_index.clear()
+        self._files: Dict[str, Dict[str, List[Dict[str, Any]]]] = {} # file_path -> тип -> элементы
+        self._chunks: Dict[VectorKey, Dict[str, Any]] = {}
+        self._type_views: Dict[str, List[Dict[str, Any]]] = {} # Кэш of_type(), сбрасывается при изменениях
+        self._count = 0
+
+    def __len__(self) -> int:
+        return self._count
+
+    def __bool__(self) -> bool:
+        return self._count > 0
+
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
+        for groups in self._files.values():
+            for item_type in CONTEXT_TYPES:
+                yield from groups.get(item_type, ())
+            for item_type, items in groups.items():
+                if item_type not in CONTEXT_TYPES: yield from items
+
+    # --- Изменение ---
+    def add(self, items: Iterable[Dict[str, Any]]):
+        """Добавляет элементы; эмбеддинги чанков переносятся в векторный индекс."""
+        items = list(items)
+        chunks = [item for item in items if item.get('type') == 'chunk' and item.get('embedding') is not None]
+        if chunks:
+            try:
+                self.vector_index.add([chunk_key(item) for item in chunks], [item['embedding'] for item in chunks])
+            except ValueError as e:
+                logger.error(f"Не удалось добавить эмбеддинги в векторный индекс: {e}")
+        self._insert(items)
+
+    def load(self, items: Iterable[Dict[str, Any]], vector_index: VectorIndex):
+        """Заменяет весь контекст загруженным из сессии; vector_index уже содержит эмбеддинги чанков."""
+        self.clear()
+        self.vector_index = vector_index
+        self._insert(items)
+
+    def remove_files(self, file_paths: Iterable[str]):
+        """Удаляет все элементы указанных файлов и их векторы."""
+        removed_keys = []
+        for path in file_paths:
+            groups = self._files.pop(path, None)
+            if groups is None: continue
+            for item_type, items in groups.items():
+                self._count -= len(items)
+                self._type_views.pop(item_type, None)
+            for item in groups.get('chunk', ()):
+                key = chunk_key(item)
+                self._chunks.pop(key, None)
+                removed_keys.append(key)
+        self.vector_index.remove_keys(removed_keys)
+
+    def replace_file(self, file_path: str, items: Iterable[Dict[str, Any]]):
+        self.remove_files([file_path])
+        self.add(items)
+
+    def _insert(self, items: Iterable[Dict[str, Any]]):
+        for item in items:
+            item.pop('embedding', None)
+            item_type = item.get('type')
+            self._files.setdefault(item.get('file_path'), {}).setdefault(item_type, []).append(item)
+            if item_type == 'chunk':
+                self._chunks[chunk_key(item)] = item
+            self._type_views.pop(item_type, None)
+            self._count += 1
+
+    # --- Выборка ---
+    def of_type(self, item_type: str) -> List[Dict[str, Any]]:
+        """Элементы одного типа в порядке файлов (список кэшируется до следующего изменения, не изменять)."""
+        view = self._type_views.get(item_type)
+        if view is None:
+            view = [item for groups in self._files.values() for item in groups.get(item_type, ())]
+            self._type_views[item_type] = view
+        return view
+
+    def file_items(self, file_path: str, types: Optional[Sequence[str]] = None) -> List[Dict[str, Any]]:
+        groups = self._files.get(file_path)
+        if not groups: return []
+        return [item for item_type in (types or groups.keys()) for item in groups.get(item_type, ())]
+
+    def file_paths(self) -> List[str]:
+        return list(self._files)
+
+    def get_chunk(self, key: VectorKey) -> Optional[Dict[str, Any]]:
+        return self._chunks.get(key)
+
+    def has_embedding(self, item: Dict[str, Any]) -> bool:
+        return item.get('type') == 'chunk' and chunk_key(item) in self.vector_index
@@ -0,0 +1,81 @@
+# --- Файл: prompt_cache.py ---
+
+import bisect
+import logging
+from itertools import accumulate
+from typing import Optional, Dict, List, Any, Hashable, Tuple
+
+from token_estimator import TokenEstimator
+
+logger = logging.getLogger(__name__)
+
+
+class PromptTextBlock:
+    """
+    Заранее отформатированные фрагменты контекста (саммари, чанки, файлы) с накопленными
+    длинами и оценками токенов. Позволяет взять максимальный префикс, укладывающийся
+    в бюджет, бинарным поиском - без повторного форматирования и подсчета.
+    """
+
+    def __init__(self, texts: List[str]):
+        self.texts = texts
+        self._char_ends = list(accumulate(len(t) for t in texts))
+        self._raw_ends = list(accumulate(TokenEstimator.raw_estimate(t) for t in texts))
+        self._joined: Optional[str] = None
+
+    def __len__(self) -> int:
+        return len(self.texts)
+
+    def total_chars(self) -> int:
+        return self._char_ends[-1] if self._char_ends else 0
+
+    def take(self, char_budget: int) -> Tuple[str, int, float]:
+        """Возвращает (текст, число символов, оценка токенов) для наибольшего префикса в пределах бюджета."""
+        count = bisect.bisect_right(self._char_ends, char_budget)
+        if count == 0: return "", 0, 0.0
+        if count == len(self.texts):
+            if self._joined is None: self._joined = "".join(self.texts)
+            text = self._joined
+        else:
+            text = "".join(self.texts[:count])
+        return text, self._char_ends[count - 1], self._raw_ends[count - 1]
+
+    def fits(self, char_budget: int) -> bool:
+        return self.total_chars() <= char_budget
+
+
+class PromptPrefixCache:
+    """
+    Кэш неизменной между ходами диалога части промпта (инструкции с картой проекта,
+    блок саммари, статический контекст). Запись сопоставляется с ключом версии:
+    если ключ изменился (контекст, инструкции, настройки), префикс собирается заново.
+    """
+
+    def __init__(self):
+        self._key: Optional[Hashable] = None
+        self._value: Optional[Dict[str, Any]] = None
+        self._build_seconds = 0.0
+        self.hits = 0
+        self.misses = 0
+        self.seconds_saved = 0.0
+
+    def get(self, key: Hashable) -> Optional[Dict[str, Any]]:
+        if self._value is not None and self._key == key:
+            self.hits += 1
+            self.seconds_saved += self._build_seconds
+            return self._value
+        self.misses += 1
+        return None
+
+    def put(self, key: Hashable, value: Dict[str, Any], build_seconds: float):
+        self._key, self._value, self._build_seconds = key, value, build_seconds
+
+    def invalidate(self):
+        self._key, self._value = None, None
+
+    def last_build_seconds(self) -> float:
+        return self._build_seconds
+
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
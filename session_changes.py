@@ -0,0 +1,117 @@
+# --- Файл: session_changes.py ---
+
+import logging
+from typing import Optional, Dict, List, Any, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Ключ строки context_data: (file_path, type, chunk_num), как в UNIQUE-ограничении таблицы
+ContextKey = Tuple[str, str, int]
+
+
+def context_key(item: Dict[str, Any]) -> ContextKey:
+    chunk_num = item.get("chunk_num")
+    return item.get("file_path"), item.get("type"), chunk_num if isinstance(chunk_num, int) else 0
+
+
+class SessionChanges:
+    """
+    Изменения сессии относительно ее файла .cpai с момента последней загрузки или сохранения.
+    По ним db_manager.save_session_delta записывает только новые, измененные и удаленные
+    строки, поэтому время сохранения зависит от объема изменений, а не от размера сессии.
+    Если точный набор изменений неизвестен (новый файл, сброс контекста), требуется полная запись.
+    """
+
+    def __init__(self):
+        self.reset(None)
+
+    def reset(self, filepath: Optional[str], message_count: int = 0, vector_index_version: Optional[int] = None,
+              context_file: Optional[str] = None):
+        """
+        Фиксирует, что содержимое памяти совпадает с файлом filepath (None - файла нет).
+        context_file - файл, чей context_data совпадает с контекстом в памяти, даже если сам файл
+        при следующем сохранении будет перезаписан целиком (по умолчанию filepath).
+        """
+        self._filepath = filepath
+        self._context_file = context_file or filepath
+        self._saved_message_count = message_count
+        self._changed_messages: Set[int] = set()
+        self._context_upserts: Dict[ContextKey, Dict[str, Any]] = {}
+        self._removed_files: Set[str] = set()
+        self._context_rewrite = False
+        self._vector_index_version = vector_index_version
+
+    # --- Регистрация изменений ---
+    def require_full_save(self, file_unreliable: bool = False):
+        """
+        Следующее сохранение перезапишет файл целиком (например, сменился формат эмбеддингов).
+        file_unreliable - содержимое файла неизвестно (например, после ошибки записи).
+        """
+        self._filepath = None
+        if file_unreliable:
+            self._context_file = None
+
+    def message_changed(self, index: int):
+        """Сообщение, уже записанное в файл, изменилось (например, флаг исключения из API)."""
+        if index < self._saved_message_count:
+            self._changed_messages.add(index)
+
+    def all_messages_changed(self):
+        self._changed_messages.update(range(self._saved_message_count))
+
+    def messages_journaled(self, message_count: int, indices: List[int]):
+        """
+        Новые сообщения (до message_count) и изменения сообщений indices уже дописаны
+        в журнал истории чата файла (db_manager.append_message_journal) и повторно не записываются.
+        """
+        self._saved_message_count = max(self._saved_message_count, message_count)
+        self._changed_messages.difference_update(indices)
+
+    def can_journal_messages(self, filepath: Optional[str]) -> bool:
+        """Можно ли дописывать изменения истории в журнал файла filepath (файл совпадает с памятью)."""
+        return filepath is not None and filepath == self._filepath
+
+    def context_added(self, items: List[Dict[str, Any]]):
+        if self._context_rewrite: return
+        for item in items:
+            self._context_upserts[context_key(item)] = item
+
+    def context_files_removed(self, file_paths: Set[str]):
+        if self._context_rewrite: return
+        self._removed_files.update(file_paths)
+        for key in [key for key in self._context_upserts if key[0] in file_paths]:
+            del self._context_upserts[key]
+
+    def context_cleared(self):
+        """Контекст заменяется целиком: при сохранении таблица context_data перезаписывается."""
+        self._context_rewrite = True
+        self._context_upserts.clear()
+        self._removed_files.clear()
+
+    # --- Сохранение ---
+    def needs_full_save(self, filepath: str) -> bool:
+        return filepath != self._filepath
+
+    def needs_context_rewrite(self) -> bool:
+        return self._context_rewrite
+
+    def message_indices_to_save(self, message_count: int) -> List[int]:
+        """Номера сообщений для записи: измененные старые и все новые."""
+        changed = sorted(i for i in self._changed_messages if i < message_count)
+        return changed + list(range(min(self._saved_message_count, message_count), message_count))
+
+    def context_upserts(self) -> List[Dict[str, Any]]:
+        return list(self._context_upserts.values())
+
+    def removed_files(self) -> Set[str]:
+        return set(self._removed_files)
+
+    def context_source(self) -> Optional[str]:
+        """
+        Файл, context_data которого совпадает с контекстом в памяти с точностью до
+        context_upserts() и removed_files(), или None (например, контекст заменен целиком).
+        """
+        return None if self._context_rewrite else self._context_file
+
+    def vector_index_changed(self, version: int) -> bool:
+        return version != self._vector_index_version
@@ -0,0 +1,138 @@
+# --- Файл: session_writer.py ---
+
+import time
+import logging
+import threading
+from typing import Optional, Dict, List, Any
+
+from PySide6.QtCore import QObject, Signal, Slot
+
+import db_manager
+from workspace_catalog import WorkspaceCatalog
+
+logger = logging.getLogger(__name__)
+
+# Как часто проверять, не пора ли автосохранить измененную сессию
+AUTOSAVE_INTERVAL_MS = 60000
+
+
+class SessionWriter(QObject):
+    """
+    Записывает снимки сессии в .cpai в отдельном потоке, не блокируя интерфейс.
+    Снимок (словарь) собирает ChatModel._take_save_snapshot(): полная перезапись
+    (атомарная замена файла, см. db_manager.save_session_data) или только изменения
+    (транзакция SQLite, см. db_manager.save_session_delta).
+    Одновременно выполняется не больше одной записи; повторные запросы на сохранение,
+    пришедшие во время записи, ChatModel объединяет в один следующий снимок.
+    Здесь же выполняется сжатие файла (db_manager.compact_session) и дозапись журнала
+    истории чата (db_manager.append_message_journal) - в том же порядке, в каком
+    ChatModel отправляет запросы, поэтому журнал не обгоняет снимки.
+    После каждой успешной записи обновляется каталог сессий (workspace_catalog), если он передан;
+    ошибка каталога на результат записи не влияет.
+    """
+    write_finished = Signal(str, bool, int) # путь, успех, поколение сессии
+    compact_finished = Signal(str, object, int) # путь, отчет о сжатии (None при ошибке), поколение сессии
+    journal_finished = Signal(str, bool, int) # путь, успех, поколение сессии
+
+    def __init__(self, catalog: Optional[WorkspaceCatalog] = None):
+        super().__init__()
+        self._catalog = catalog
+        self._idle = threading.Event()
+        self._idle.set()
+        self._journal_lock = threading.Lock()
+        self._pending_journal = 0
+        self._journal_idle = threading.Event()
+        self._journal_idle.set()
+
+    def mark_busy(self):
+        """Вызывается в потоке интерфейса перед отправкой снимка."""
+        self._idle.clear()
+
+    def is_busy(self) -> bool:
+        return not self._idle.is_set()
+
+    def mark_journal_pending(self):
+        """Вызывается в потоке интерфейса перед отправкой записей журнала."""
+        with self._journal_lock:
+            self._pending_journal += 1
+            self._journal_idle.clear()
+
+    def has_pending_journal(self) -> bool:
+        return not self._journal_idle.is_set()
+
+    def wait_idle(self, timeout: Optional[float] = None) -> bool:
+        """Ждет окончания текущей записи и дозаписи журнала. Возвращает False, если время ожидания истекло."""
+        return self._idle.wait(timeout) and self._journal_idle.wait(timeout)
+
+    @Slot(dict)
+    def write(self, snapshot: Dict[str, Any]):
+        filepath = snapshot["filepath"]
+        started = time.perf_counter()
+        try:
+            if snapshot["full"]:
+                success = db_manager.save_session_data(
+                    filepath, snapshot["metadata"], snapshot["messages"], snapshot["context"],
+                    vector_index_state=snapshot["vector_index_state"], chunk_vectors=snapshot["chunk_vectors"]
+                )
+            else:
+                success = db_manager.save_session_delta(
+                    filepath, snapshot["metadata"], snapshot["messages"], snapshot["message_indices"],
+                    snapshot["context"], snapshot["removed_files"],
+                    update_vector_index=snapshot["update_vector_index"],
+                    vector_index_state=snapshot["vector_index_state"], chunk_vectors=snapshot["chunk_vectors"]
+                )
+            if success:
+                self._record_in_catalog(snapshot)
+        except Exception as e:
+            logger.error(f"Фоновая запись сессии '{filepath}' завершилась ошибкой: {e}", exc_info=True)
+            success = False
+        finally:
+            self._idle.set()
+        mode = "полная" if snapshot["full"] else "изменения"
+        logger.info(f"Фоновая запись сессии ({mode}) за {time.perf_counter() - started:.2f} с: {'успех' if success else 'ошибка'}.")
+        self.write_finished.emit(filepath, success, snapshot["generation"])
+
+    def _record_in_catalog(self, snapshot: Dict[str, Any]):
+        if not self._catalog: return
+        try:
+            if snapshot["full"]:
+                self._catalog.record_session(snapshot["filepath"], snapshot["catalog_info"], snapshot["messages"], snapshot["context"])
+            else:
+                self._catalog.record_changes(
+                    snapshot["filepath"], snapshot["catalog_info"], snapshot["messages"], snapshot["message_indices"],
+                    snapshot["context"], snapshot["removed_files"]
+                )
+        except Exception as e:
+            logger.warning(f"Не удалось обновить каталог сессий для '{snapshot['filepath']}': {e}", exc_info=True)
+
+    @Slot(dict)
+    def update_catalog(self, snapshot: Dict[str, Any]):
+        """Заносит в каталог открытую сессию, которой в нем нет или чья запись устарела (снимок как при полной записи)."""
+        self._record_in_catalog(snapshot)
+
+    @Slot(str, int)
+    def compact(self, filepath: str, generation: int):
+        try:
+            report = db_manager.compact_session(filepath)
+        except Exception as e:
+            logger.error(f"Сжатие сессии '{filepath}' завершилось ошибкой: {e}", exc_info=True)
+            report = None
+        finally:
+            self._idle.set()
+        self.compact_finished.emit(filepath, report, generation)
+
+    @Slot(str, list, int)
+    def append_journal(self, filepath: str, records: List[Dict[str, Any]], generation: int):
+        try:
+            success = db_manager.append_message_journal(filepath, records)
+            if success and self._catalog:
+                self._catalog.record_messages(filepath, records)
+        except Exception as e:
+            logger.error(f"Запись журнала истории чата '{filepath}' завершилась ошибкой: {e}", exc_info=True)
+            success = False
+        finally:
+            with self._journal_lock:
+                self._pending_journal -= 1
+                if self._pending_journal == 0:
+                    self._journal_idle.set()
+        self.journal_finished.emit(filepath, success, generation)
@@ -3,7 +3,10 @@
 import os
 import sys
 import logging
-from typing import Dict, Optional, List, Any, Tuple
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Dict, Optional, List, Any, Tuple, Set
 
 from PySide6.QtCore import QObject, Signal, Slot, QThread
 import numpy as np
@@ -12,12 +15,35 @@ import google.generativeai as genai
 from google.api_core import exceptions as google_exceptions
 
 # Импортируем наши сплиттеры
-from code_splitter import TreeSitterSplitter, RecursiveCharacterSplitter
-from ast_parser import ASTParser
+from code_splitter import TreeSitterSplitter, RecursiveCharacterSplitter, SPLITTER_VERSION, DEFAULT_CHUNK_TOKENS
+from ast_parser import ASTParser, LANGUAGE_QUERIES, STRUCTURE_VERSION
+from analysis_pool import (
+    AnalysisProcessPool, EncryptedDocumentError, DEFAULT_ANALYSIS_PROCESSES,
+    prepare_source, extract_document_text, is_document_supported
+)
+from analysis_cache import AnalysisCache, content_hash
+from embedding_batcher import EmbeddingBatcher
+from keyword_index import retrieval_uses_embeddings
 
 # Настраиваем логгер для этого модуля
 logger = logging.getLogger(__name__)
 
+# Параметры конвейерного (многопоточного) анализа.
+# Количество файлов, обрабатываемых одновременно (чтение, саммари, эмбеддинги).
+DEFAULT_ANALYSIS_CONCURRENCY = 8
+MAX_ANALYSIS_CONCURRENCY = 32
+# Во сколько раз окно "файлов в работе" может превышать число потоков.
+# Ограничивает память, если один медленный файл задерживает выдачу результатов по порядку.
+ANALYSIS_IN_FLIGHT_FACTOR = 4
+# Батчи эмбеддингов отправляются в отдельных потоках, пока анализ файлов продолжается.
+# Число одновременных запросов к API эмбеддингов и предел отправленных, но не разобранных батчей
+# (при его достижении анализ ждет ответа, чтобы очередь файлов, ожидающих эмбеддинги, не росла без конца).
+EMBEDDING_CONCURRENCY = 4
+EMBEDDING_MAX_PENDING_BATCHES = EMBEDDING_CONCURRENCY * 2
+
+# Модель для построения эмбеддингов чанков и поисковых запросов
+EMBEDDING_MODEL = 'models/text-embedding-004'
+
 # Промпт для создания саммари файла (остается без изменений)
 SUMMARIZATION_PROMPT_RU = """
 Проанализируй содержимое этого файла:
@@ -51,17 +77,6 @@ In the summary, be sure to reflect:
 The response should be only the summary text, without any extra phrases or introductions.
 """
 
-try:
-    import docx
-except ImportError:
-    docx = None
-    logging.warning("Библиотека 'python-docx' не найдена. DOCX файлы будут проигнорированы.")
-try:
-    from PyPDF2 import PdfReader
-except ImportError:
-    PdfReader = None
-    logging.warning("Библиотека 'PyPDF2' не найдена. PDF файлы будут проигнорированы.")
-
 
 class SummarizerWorker(QObject):
     """
@@ -72,6 +87,7 @@ class SummarizerWorker(QObject):
     file_summarized = Signal(str, str)
     context_data_ready = Signal(list)
     error_occurred = Signal(str)
+    cache_stats_ready = Signal(int, int) # hits, misses
     finished = Signal()
 
     def __init__(self,
@@ -83,9 +99,13 @@ class SummarizerWorker(QObject):
                  github_manager: Optional[Any],
                  rag_enabled: bool,
                  semantic_search_enabled: bool,
+                 retrieval_mode: str,
                  gemini_api_key: str,
                  model_name: str,
-                 app_lang: str = 'en'):
+                 app_lang: str = 'en',
+                 max_workers: int = DEFAULT_ANALYSIS_CONCURRENCY,
+                 cache: Optional[AnalysisCache] = None,
+                 processes: int = DEFAULT_ANALYSIS_PROCESSES):
         super().__init__()
         self.file_paths = file_paths
         self.project_type = project_type
@@ -94,10 +114,26 @@ class SummarizerWorker(QObject):
         self.repo_branch = repo_branch
         self.github_manager = github_manager
         self.rag_enabled = rag_enabled
-        self.semantic_search_enabled = semantic_search_enabled
+        # Эмбеддинги чанков нужны, только если включен поиск фрагментов в режиме, который их использует
+        self.embeddings_enabled = semantic_search_enabled and retrieval_uses_embeddings(retrieval_mode)
         self.gemini_api_key = gemini_api_key
         self.model_name = model_name
+        # Число файлов, анализируемых параллельно (1 - последовательный режим)
+        self.max_workers = max(1, min(int(max_workers), MAX_ANALYSIS_CONCURRENCY))
+        # Число процессов для разбора, чанков и документов (0 - в потоках анализа, см. analysis_pool)
+        self.processes = max(0, int(processes))
+        self._process_pool: Optional[AnalysisProcessPool] = None
+        self._grammar_library_path: Optional[str] = None
         self._is_cancelled = False
+        self._tree_sitter_lock = threading.Lock()
+        # Состояние отправки результатов (создается в run)
+        self._batcher: Optional[EmbeddingBatcher] = None
+        self._embedding_executor: Optional[ThreadPoolExecutor] = None
+        self._embedding_futures: Set[Future] = set()
+        self._output_queue: deque = deque()
+        self._awaiting_embeddings: Dict[int, Dict[str, Any]] = {}
+        # Постоянный кэш результатов анализа (может отсутствовать)
+        self.cache = cache if cache is not None and cache.is_available() else None
         self.generative_model: Optional[genai.GenerativeModel] = None
 
         self.ts_splitter: Optional[TreeSitterSplitter] = None
@@ -134,6 +170,7 @@ class SummarizerWorker(QObject):
             # Инициализируем оба парсера с одним и тем же путем к библиотеке
             self.ts_splitter = TreeSitterSplitter(lib_path)
             self.ast_parser = ASTParser(lib_path)
+            self._grammar_library_path = lib_path
             logger.info("Tree-sitter сплиттер и AST-парсер успешно инициализированы.")
 
         except Exception as e:
@@ -163,80 +200,271 @@ class SummarizerWorker(QObject):
             if self._is_cancelled: return
 
             total_count = len(self.file_paths)
-            for i, file_path in enumerate(self.file_paths):
-                if self._is_cancelled: break
-                
-                self.progress_updated.emit(i, total_count, os.path.basename(file_path))
-                content, read_error = self._read_file_content(file_path)
-
-                if self._is_cancelled: break
-
-                if read_error:
-                    self.error_occurred.emit(read_error)
-                    continue
-                if content is None: continue
-
-                display_path = os.path.relpath(file_path, self.project_source_path) if self.project_type == 'local' else file_path
-                context_for_this_file = []
-                
-                # --- НОВЫЙ ШАГ: АНАЛИЗ СТРУКТУРЫ КОДА (AST) ---
-                file_ext = os.path.splitext(display_path)[1]
-                language = self.ast_parser.get_language_from_extension(file_ext) if self.ast_parser else None
-                
-                if language and content:
-                    structure = self.ast_parser.parse_code_structure(content, language)
-                    if any(structure.values()): # Добавляем, только если что-то нашли
-                        context_for_this_file.append({
-                            'file_path': display_path,
-                            'type': 'structure',
-                            'content': structure, # Сохраняем как словарь
-                            'chunk_num': 0,
-                            'embedding': None
-                        })
-                # --- КОНЕЦ НОВОГО ШАГА ---
-
-                if self.rag_enabled:
-                    summary_text = self._create_summary(display_path, content)
-                    if self._is_cancelled: break
-                    self.file_summarized.emit(display_path, summary_text)
-                    context_for_this_file.append({'file_path': display_path, 'type': 'summary', 'chunk_num': 0, 'content': summary_text, 'embedding': None})
-                    
-                    if content.strip():
-                        chunks = self._split_into_chunks(display_path, content)
-                        embeddings = []
-                        if self.semantic_search_enabled and chunks:
-                            embeddings = self._create_embeddings(chunks, display_path)
-                            if self._is_cancelled: break
-
-                        for j, chunk_text in enumerate(chunks):
-                            chunk_embedding = embeddings[j] if embeddings and j < len(embeddings) else None
-                            context_for_this_file.append({
-                                'file_path': display_path,
-                                'type': 'chunk',
-                                'chunk_num': j + 1,
-                                'content': chunk_text,
-                                'embedding': chunk_embedding
-                            })
-                else:
-                    context_for_this_file.append({'file_path': display_path, 'type': 'full_file', 'chunk_num': 0, 'content': content, 'embedding': None})
-                    self.file_summarized.emit(display_path, self.tr("(Режим RAG отключен, файл используется целиком)"))
-
-                if context_for_this_file: self.context_data_ready.emit(context_for_this_file)
+            if self.cache: self.cache.reset_stats()
+            self._output_queue = deque()
+            self._awaiting_embeddings = {}
+            self._batcher = None
+            if self.rag_enabled and self.embeddings_enabled and self.gemini_api_key:
+                # Эмбеддинги запрашиваются батчами, собранными из чанков многих файлов
+                self._batcher = EmbeddingBatcher(
+                    self._embed_texts,
+                    is_cancelled=lambda: self._is_cancelled,
+                    fatal_exceptions=(google_exceptions.ResourceExhausted,)
+                )
+                self._embedding_executor = ThreadPoolExecutor(max_workers=EMBEDDING_CONCURRENCY, thread_name_prefix="embeddings")
+                self._embedding_futures = set()
+
+            if self.processes and self.max_workers > 1 and total_count > 1:
+                logger.info(f"Разбор, чанки и документы - в пуле из {self.processes} процессов.")
+                chunk_tokens = self.ts_splitter.chunk_tokens if self.ts_splitter else DEFAULT_CHUNK_TOKENS
+                self._process_pool = AnalysisProcessPool(self.processes, self._grammar_library_path, self.fallback_splitter, chunk_tokens)
+
+            if self.max_workers > 1 and total_count > 1:
+                self._run_pipelined(total_count)
+            else:
+                self._run_sequential(total_count)
+
+            # Досылаем остаток батча и отправляем последние файлы
+            if not self._is_cancelled:
+                self._flush_embeddings()
+                while self._embedding_futures and not self._is_cancelled:
+                    self._collect_embeddings(block=True)
+                self._drain_output_queue()
+            if self._batcher and self._batcher.total_requests:
+                logger.info(
+                    f"Эмбеддинги за анализ: {self._batcher.total_chunks} чанков, запросов {self._batcher.total_requests} "
+                    f"(неудачных {self._batcher.failed_requests}), {self._batcher.throughput():.1f} чанков/с."
+                )
 
             if self._is_cancelled:
                 logger.warning(self.tr("Операция анализа была отменена пользователем."))
             else:
                 self.progress_updated.emit(total_count, total_count, self.tr("Завершено"))
+
+            if self.cache:
+                stats = self.cache.get_stats()
+                logger.info(f"Кэш анализа: попаданий {stats['hits']}, промахов {stats['misses']}.")
+                self.cache_stats_ready.emit(stats['hits'], stats['misses'])
         
         finally:
+            if self._embedding_executor:
+                # При отмене запущенные батчи сами проверят флаг и завершатся без новых запросов
+                self._embedding_executor.shutdown(wait=True, cancel_futures=True)
+                self._embedding_executor = None
+            if self._process_pool:
+                self._process_pool.shutdown()
+                self._process_pool = None
+            if self.cache:
+                self.cache.flush_usage()
             logger.info(self.tr("Воркер анализа завершил свою работу."))
             self.finished.emit()
 
+    def _run_sequential(self, total_count: int):
+        """Последовательный режим: файлы обрабатываются строго по одному."""
+        for i, file_path in enumerate(self.file_paths):
+            if self._is_cancelled: break
+            self.progress_updated.emit(i, total_count, os.path.basename(file_path))
+            result = self._analyze_file(file_path)
+            if self._is_cancelled: break
+            self._enqueue_file_result(result)
+
+    def _run_pipelined(self, total_count: int):
+        """
+        Конвейерный режим: до max_workers файлов анализируются одновременно
+        в пуле потоков. Результаты отправляются сигналами строго в порядке
+        self.file_paths, чтобы порядок контекста не зависел от скорости API.
+        """
+        logger.info(f"Конвейерный анализ: потоков {self.max_workers}.")
+        in_flight_limit = self.max_workers * ANALYSIS_IN_FLIGHT_FACTOR
+        pending: Dict[Any, int] = {}
+        completed: Dict[int, Optional[Dict[str, Any]]] = {}
+        next_to_submit = 0
+        next_to_emit = 0
+        processed_count = 0
+
+        executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="analysis")
+        try:
+            while next_to_emit < total_count and not self._is_cancelled:
+                # Держим ограниченное окно задач впереди первого неотправленного файла
+                while next_to_submit < total_count and next_to_submit - next_to_emit < in_flight_limit:
+                    future = executor.submit(self._analyze_file, self.file_paths[next_to_submit])
+                    pending[future] = next_to_submit
+                    next_to_submit += 1
+
+                # Ответы API эмбеддингов тоже будят цикл: файлы, которые их ждали, отправляются сразу
+                done, _ = wait(set(pending) | self._embedding_futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    index = pending.pop(future, None)
+                    if index is None: continue
+                    try:
+                        completed[index] = future.result()
+                    except Exception as e:
+                        file_path = self.file_paths[index]
+                        logger.error(f"Непредвиденная ошибка при анализе '{file_path}': {e}", exc_info=True)
+                        completed[index] = {"error": self.tr("Ошибка анализа файла {0}: {1}").format(os.path.basename(file_path), e)}
+                    processed_count += 1
+                    self.progress_updated.emit(processed_count, total_count, os.path.basename(self.file_paths[index]))
+
+                if self._is_cancelled: break
+                self._collect_embeddings()
+                self._drain_output_queue()
+                while next_to_emit in completed:
+                    self._enqueue_file_result(completed.pop(next_to_emit))
+                    next_to_emit += 1
+        finally:
+            # При отмене не ждем еще не начатые задачи; уже запущенные сами проверят флаг
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    def _enqueue_file_result(self, result: Optional[Dict[str, Any]]):
+        """
+        Ставит результат файла в очередь на отправку (в порядке файлов). Чанки без
+        эмбеддингов передаются батчеру; файл отправляется, когда все его эмбеддинги получены.
+        Полный батч отправляется в фоне (см. _flush_embeddings), ожидание не блокирует анализ.
+        """
+        if not result: return
+        pending_chunks = result.get("pending_chunks")
+        if pending_chunks and self._batcher:
+            request_id = id(result) # Уникален, пока результат ждет в очереди
+            self._awaiting_embeddings[request_id] = result
+            self._batcher.add(request_id, [item['content'] for item in pending_chunks])
+        self._output_queue.append(result)
+
+        if self._batcher and self._batcher.is_full():
+            self._flush_embeddings()
+        self._collect_embeddings()
+        self._drain_output_queue()
+
+    def _flush_embeddings(self):
+        """
+        Отправляет накопленный батч эмбеддингов в поток self._embedding_executor, не дожидаясь ответа.
+        Если отправлено уже EMBEDDING_MAX_PENDING_BATCHES батчей, сначала дожидается одного из них.
+        """
+        if not self._batcher or not self._batcher.pending_count(): return
+        while len(self._embedding_futures) >= EMBEDDING_MAX_PENDING_BATCHES and not self._is_cancelled:
+            self._collect_embeddings(block=True)
+        if self._is_cancelled: return
+        self._embedding_futures.add(self._embedding_executor.submit(self._batcher.embed, self._batcher.take_pending()))
+
+    def _collect_embeddings(self, block: bool = False):
+        """
+        Раскладывает по чанкам файлов результаты завершившихся батчей эмбеддингов
+        (block=True - сначала дождаться хотя бы одного). Вызывается только из потока воркера.
+        """
+        if not self._embedding_futures: return
+        if block:
+            wait(self._embedding_futures, return_when=FIRST_COMPLETED)
+        for future in [future for future in self._embedding_futures if future.done()]:
+            self._embedding_futures.discard(future)
+            try:
+                results, errors = future.result()
+            except google_exceptions.ResourceExhausted as e:
+                if not self._is_cancelled:
+                    self.error_occurred.emit(self.tr("Исчерпаны квоты API Gemini. Прерывание. Ошибка: {0}").format(e))
+                    self.cancel()
+                continue
+
+            if errors:
+                msg = self.tr("Не удалось создать эмбеддинги для {0} фрагментов: {1}").format(len(errors), errors[-1])
+                self.error_occurred.emit(msg)
+
+            for request_id, vectors in results.items():
+                result = self._awaiting_embeddings.pop(request_id, None)
+                if result is None: continue
+                for item, vector in zip(result["pending_chunks"], vectors):
+                    item['embedding'] = vector
+                cache_key = result.get("embedding_cache_key")
+                if cache_key and self.cache and all(v is not None for v in vectors):
+                    self.cache.put_embeddings(cache_key, vectors)
+                result["pending_chunks"] = None
+
+    def _drain_output_queue(self):
+        """Отправляет готовые результаты с головы очереди, сохраняя порядок файлов."""
+        while self._output_queue and not self._output_queue[0].get("pending_chunks"):
+            self._emit_file_result(self._output_queue.popleft())
+
+    def _emit_file_result(self, result: Optional[Dict[str, Any]]):
+        """Отправляет результат анализа одного файла сигналами воркера."""
+        if not result: return
+        if result.get("error"):
+            self.error_occurred.emit(result["error"])
+            return
+        if result.get("summary") is not None:
+            self.file_summarized.emit(result["display_path"], result["summary"])
+        if result.get("context"):
+            self.context_data_ready.emit(result["context"])
+
+    def _analyze_file(self, file_path: str) -> Optional[Dict[str, Any]]:
+        """
+        Полностью анализирует один файл: чтение, структура (AST), саммари, чанки и эмбеддинги.
+        Ничего не отправляет в сигналы результатов (кроме ошибок API), а возвращает словарь
+        {'display_path', 'summary', 'context'} или {'error'}. None - файл пропущен или анализ отменен.
+        Может вызываться одновременно из нескольких потоков.
+        """
+        content, read_error = self._read_file_content(file_path)
+        if self._is_cancelled: return None
+        if read_error: return {"error": read_error}
+        if content is None: return None
+
+        display_path = os.path.relpath(file_path, self.project_source_path) if self.project_type == 'local' else file_path
+        context_for_this_file = []
+        summary_for_display: Optional[str] = None
+        pending_embeddings: Dict[str, Any] = {}
+        file_hash = content_hash(content)
+        
+        # --- НОВЫЙ ШАГ: АНАЛИЗ СТРУКТУРЫ КОДА (AST) ---
+        # Структура и чанки получаются вместе, одним разбором файла (если их нет в кэше)
+        structure, chunks = self._prepare_code(display_path, content, file_hash, need_chunks=self.rag_enabled and bool(content.strip()))
+        
+        if structure:
+            if any(structure.values()): # Добавляем, только если что-то нашли
+                context_for_this_file.append({
+                    'file_path': display_path,
+                    'type': 'structure',
+                    'content': structure, # Сохраняем как словарь
+                    'chunk_num': 0,
+                    'embedding': None
+                })
+        # --- КОНЕЦ НОВОГО ШАГА ---
+
+        if self.rag_enabled:
+            summary_text = self._create_summary(display_path, content, file_hash)
+            if self._is_cancelled: return None
+            summary_for_display = summary_text
+            context_for_this_file.append({'file_path': display_path, 'type': 'summary', 'chunk_num': 0, 'content': summary_text, 'embedding': None})
+            
+            if chunks is not None:
+                chunk_items = [{
+                    'file_path': display_path,
+                    'type': 'chunk',
+                    'chunk_num': j + 1,
+                    'content': chunk_text,
+                    'embedding': None
+                } for j, chunk_text in enumerate(chunks)]
+                context_for_this_file.extend(chunk_items)
+
+                if self.embeddings_enabled and chunk_items and self.gemini_api_key:
+                    # Эмбеддинги берутся из кэша, а недостающие запрашивает батчер в run()
+                    embedding_cache_key = None
+                    if self.cache:
+                        embedding_cache_key = AnalysisCache.make_key("embeddings", [self._chunks_cache_parts(display_path, file_hash), EMBEDDING_MODEL])
+                        cached = self.cache.get_embeddings(embedding_cache_key)
+                        if cached is not None and len(cached) == len(chunk_items):
+                            for item, vector in zip(chunk_items, cached):
+                                item['embedding'] = vector
+                            chunk_items = []
+                    if chunk_items:
+                        pending_embeddings = {"pending_chunks": chunk_items, "embedding_cache_key": embedding_cache_key}
+        else:
+            context_for_this_file.append({'file_path': display_path, 'type': 'full_file', 'chunk_num': 0, 'content': content, 'embedding': None})
+            summary_for_display = self.tr("(Режим RAG отключен, файл используется целиком)")
+
+        result = {"display_path": display_path, "summary": summary_for_display, "context": context_for_this_file}
+        result.update(pending_embeddings)
+        return result
+
     def _read_file_content(self, file_path: str) -> Tuple[Optional[str], Optional[str]]:
         """Читает контент файла из локального хранилища или GitHub."""
         try:
-            from io import BytesIO
-
             content_bytes = None
             if self.project_type == 'local':
                 with open(file_path, 'rb') as f:
@@ -247,67 +475,41 @@ class SummarizerWorker(QObject):
             if content_bytes is None: return None, None
 
             file_ext = os.path.splitext(file_path.lower())[1]
-            if file_ext == '.docx':
-                if docx is None: return None, self.tr("Пропущен DOCX (библиотека не установлена): {0}").format(os.path.basename(file_path))
-                doc = docx.Document(BytesIO(content_bytes))
-                return '\n'.join([p.text for p in doc.paragraphs]), None
-            elif file_ext == '.pdf':
-                if PdfReader is None: return None, self.tr("Пропущен PDF (библиотека не установлена): {0}").format(os.path.basename(file_path))
-                reader = PdfReader(BytesIO(content_bytes))
-                if reader.is_encrypted: return None, self.tr("Пропущен зашифрованный PDF: {0}").format(os.path.basename(file_path))
-                return '\n'.join([p.extract_text() or "" for p in reader.pages]), None
+            if file_ext in ('.docx', '.pdf'):
+                if not is_document_supported(file_ext):
+                    if file_ext == '.docx': return None, self.tr("Пропущен DOCX (библиотека не установлена): {0}").format(os.path.basename(file_path))
+                    return None, self.tr("Пропущен PDF (библиотека не установлена): {0}").format(os.path.basename(file_path))
+                if self._process_pool:
+                    return self._process_pool.extract_document_text(file_ext, content_bytes), None
+                return extract_document_text(file_ext, content_bytes), None
             else:
                 return content_bytes.decode('utf-8', errors='ignore'), None
+        except EncryptedDocumentError:
+            return None, self.tr("Пропущен зашифрованный PDF: {0}").format(os.path.basename(file_path))
         except Exception as e:
             return None, self.tr("Ошибка чтения файла {0}: {1}").format(os.path.basename(file_path), e)
 
-    def _create_embeddings(self, chunks: List[str], file_path: str) -> List[Optional[np.ndarray]]:
-        """Создает эмбеддинги для списка чанков с использованием Gemini API."""
-        if not self.gemini_api_key or not chunks:
-            return [None] * len(chunks)
-
-        logger.debug(f"Создание эмбеддингов для {len(chunks)} чанков из файла '{file_path}'...")
-        try:
-            # Модель для эмбеддингов
-            embedding_model = 'models/text-embedding-004'
-
-            # API может принимать список текстов
-            result = genai.embed_content(
-                model=embedding_model,
-                content=chunks,
-                task_type="RETRIEVAL_DOCUMENT",
-                title=f"Фрагменты кода из файла {os.path.basename(file_path)}"
-            )
-
-            if self._is_cancelled:
-                logger.info(f"Отмена создания эмбеддингов для '{file_path}'.")
-                return [None] * len(chunks)
-
-            embeddings = result.get('embedding', [])
-
-            # Преобразуем в numpy массивы
-            numpy_embeddings = [np.array(e) for e in embeddings]
+    def _embed_texts(self, texts: List[str]) -> List[List[float]]:
+        """Один запрос эмбеддингов к Gemini API для батча текстов (вызывается EmbeddingBatcher)."""
+        result = genai.embed_content(
+            model=EMBEDDING_MODEL,
+            content=texts,
+            task_type="RETRIEVAL_DOCUMENT"
+        )
+        return result.get('embedding', [])
 
-            logger.info(f"Успешно создано {len(numpy_embeddings)} эмбеддингов для '{file_path}'.")
-
-            # Убедимся, что количество эмбеддингов соответствует количеству чанков
-            if len(numpy_embeddings) != len(chunks):
-                 logger.error(f"Несоответствие количества чанков и эмбеддингов для '{file_path}'! Ожидалось {len(chunks)}, получено {len(numpy_embeddings)}.")
-                 # Возвращаем None-ы, чтобы избежать падения
-                 return [None] * len(chunks)
-
-            return numpy_embeddings
-
-        except Exception as e:
-            msg = self.tr("Ошибка при создании эмбеддингов для '{0}': {1}").format(file_path, e)
-            logger.error(msg, exc_info=True)
-            self.error_occurred.emit(msg)
-            return [None] * len(chunks) # Возвращаем список None, чтобы не прерывать весь анализ
-    
-    def _create_summary(self, file_path: str, content: str) -> str:
+    def _create_summary(self, file_path: str, content: str, file_hash: Optional[str] = None) -> str:
         """Создает саммари для контента файла с надежной обработкой ответа."""
         if not content.strip() or not self.generative_model:
             return self.tr("(Файл пуст или модель недоступна)")
+
+        # Промпт содержит путь к файлу, поэтому он тоже входит в ключ кэша
+        cache_key = None
+        if self.cache and file_hash:
+            template_hash = content_hash(self.summarization_prompt_template)
+            cache_key = AnalysisCache.make_key("summary", [file_hash, file_path, self.model_name, template_hash])
+            cached = self.cache.get_json("summary", cache_key)
+            if cached: return cached
         
         prompt = self.summarization_prompt_template.format(file_path=file_path, file_content=content)
         try:
@@ -321,7 +523,10 @@ class SummarizerWorker(QObject):
 
             # ГЛАВНОЕ ИЗМЕНЕНИЕ: Надежная проверка наличия контента
             if hasattr(response, "text") and response.text:
-                return response.text.strip()
+                summary_text = response.text.strip()
+                # Кэшируем только настоящие саммари, ошибки должны повторяться при следующем анализе
+                if cache_key: self.cache.put_json("summary", cache_key, summary_text)
+                return summary_text
             else:
                 # Если текста нет, выясняем причину и сообщаем об этом, не падая
                 reason_text = self.tr("неизвестна")
@@ -343,11 +548,68 @@ class SummarizerWorker(QObject):
             self.error_occurred.emit(error_message)
             return self.tr("(Ошибка: {0})").format(type(e).__name__)
 
-    def _split_into_chunks(self, file_path: str, content: str) -> List[str]:
-        """Разбивает контент на чанки."""
+    def _prepare_code(self, file_path: str, content: str, file_hash: Optional[str],
+                      need_chunks: bool) -> Tuple[Optional[Dict[str, Any]], Optional[List[str]]]:
+        """
+        Структура кода (для поддерживаемых ASTParser языков) и чанки файла (если need_chunks).
+        Что есть в кэше, берется оттуда, а остальное получается одним разбором файла -
+        в пуле процессов, если он включен, иначе здесь же (см. analysis_pool.prepare_source).
+        """
         _, file_extension = os.path.splitext(file_path)
         language = TreeSitterSplitter.LANGUAGE_MAP.get(file_extension.lower())
-        if self.ts_splitter and language and self.ts_splitter.is_language_supported(language):
-            return self.ts_splitter.split_text(content, language)
+        need_structure = bool(language and self.ast_parser and content)
+        structure, chunks = None, None
+        structure_key, chunks_key = None, None
+        if self.cache and file_hash:
+            if need_structure:
+                structure_key = AnalysisCache.make_key("structure", [
+                    file_hash, language, f"structure=v{STRUCTURE_VERSION}", content_hash(LANGUAGE_QUERIES.get(language, ""))
+                ])
+                structure = self.cache.get_json("structure", structure_key)
+            if need_chunks:
+                chunks_key = AnalysisCache.make_key("chunks", [self._chunks_cache_parts(file_path, file_hash)])
+                chunks = self.cache.get_json("chunks", chunks_key)
+        need_structure = need_structure and structure is None
+        need_chunks = need_chunks and chunks is None
+        if not need_structure and not need_chunks:
+            return structure, chunks
+
+        new_structure, new_chunks = None, None
+        if self._process_pool:
+            try:
+                new_structure, new_chunks = self._process_pool.prepare_source(content, language, need_structure, need_chunks)
+            except Exception as e:
+                logger.error(f"Пул процессов анализа не обработал '{file_path}': {e}. Файл обрабатывается в потоке анализа.")
+                new_structure, new_chunks = self._prepare_code_locally(content, language, need_structure, need_chunks)
         else:
-            return self.fallback_splitter.split_text(content)
\ No newline at end of file
+            new_structure, new_chunks = self._prepare_code_locally(content, language, need_structure, need_chunks)
+
+        if need_structure:
+            structure = new_structure
+            if structure_key: self.cache.put_json("structure", structure_key, structure)
+        if need_chunks:
+            chunks = new_chunks
+            if chunks_key: self.cache.put_json("chunks", chunks_key, chunks)
+        return structure, chunks
+
+    def _prepare_code_locally(self, content: str, language: Optional[str], need_structure: bool,
+                              need_chunks: bool) -> Tuple[Optional[Dict[str, Any]], Optional[List[str]]]:
+        if not (self.ts_splitter or self.ast_parser):
+            return None, self.fallback_splitter.split_text(content) if need_chunks else None
+        # Парсеры Tree-sitter не потокобезопасны, поэтому защищаем их блокировкой
+        with self._tree_sitter_lock:
+            return prepare_source(content, language, need_structure, need_chunks,
+                                  self.ast_parser, self.ts_splitter, self.fallback_splitter)
+
+    def _chunks_cache_parts(self, file_path: str, file_hash: str) -> str:
+        """Часть ключа кэша, описывающая, как именно файл был разбит на чанки."""
+        _, file_extension = os.path.splitext(file_path)
+        language = TreeSitterSplitter.LANGUAGE_MAP.get(file_extension.lower())
+        use_tree_sitter = bool(self.ts_splitter and language and self.ts_splitter.is_language_supported(language))
+        parts = [
+            file_hash, str(language), f"ts={use_tree_sitter}", f"splitter=v{SPLITTER_VERSION}",
+            f"size={self.fallback_splitter.chunk_size}", f"overlap={self.fallback_splitter.chunk_overlap}"
+        ]
+        if use_tree_sitter:
+            parts.append(f"tokens={self.ts_splitter.chunk_tokens}")
+        return "|".join(parts)
@@ -0,0 +1,82 @@
+# --- Файл: token_estimator.py ---
+
+import math
+import logging
+from typing import Dict, Any, List
+
+logger = logging.getLogger(__name__)
+
+# Базовая оценка: латиница и код - около 4 символов на токен, кириллица и прочий не-ASCII текст - около 2
+ASCII_CHARS_PER_TOKEN = 4.0
+NON_ASCII_CHARS_PER_TOKEN = 2.0
+# Служебные токены на каждое сообщение (роль, разделители)
+MESSAGE_OVERHEAD_TOKENS = 4
+
+# Калибровка по точным подсчетам API: поправочный множитель и его допустимые границы
+CALIBRATION_SCALE_MIN = 0.5
+CALIBRATION_SCALE_MAX = 3.0
+# Вес нового замера в скользящем среднем множителя
+CALIBRATION_SMOOTHING = 0.5
+# Сколько точных замеров нужно, прежде чем оценке можно доверять без сверки с API
+CALIBRATION_SAMPLES_REQUIRED = 3
+
+# Ключ кэша оценки в словаре сообщения истории чата: (хэш частей, оценка без калибровки)
+MESSAGE_CACHE_KEY = "token_estimate"
+
+
+class TokenEstimator:
+    """
+    Локальная оценка числа токенов без обращений к API.
+    Оценка сообщений истории кэшируется прямо в их словарях, поэтому повторная сборка
+    промпта не пересчитывает старые сообщения. Поправочный множитель уточняется по
+    точным подсчетам, которые изредка приходят от API (calibrate()).
+    """
+
+    def __init__(self):
+        self.scale = 1.0
+        self.samples = 0
+
+    @staticmethod
+    def raw_estimate(text: str) -> float:
+        """Оценка без калибровки. Число не-ASCII символов получаем из длины UTF-8 без посимвольного цикла."""
+        if not text: return 0.0
+        extra_bytes = len(text.encode("utf-8", errors="ignore")) - len(text)
+        # Кириллица занимает 2 байта, поэтому extra_bytes примерно равно числу не-ASCII символов
+        non_ascii = min(len(text), extra_bytes)
+        return (len(text) - non_ascii) / ASCII_CHARS_PER_TOKEN + non_ascii / NON_ASCII_CHARS_PER_TOKEN
+
+    def raw_message(self, message: Dict[str, Any]) -> float:
+        """Оценка сообщения без калибровки; результат кэшируется в самом сообщении."""
+        parts = tuple(str(p) for p in message.get("parts", []) if p is not None)
+        parts_hash = hash(parts)
+        cached = message.get(MESSAGE_CACHE_KEY)
+        if cached and cached[0] == parts_hash:
+            return cached[1]
+        raw = sum(self.raw_estimate(p) for p in parts) + MESSAGE_OVERHEAD_TOKENS
+        message[MESSAGE_CACHE_KEY] = (parts_hash, raw)
+        return raw
+
+    def raw_messages(self, messages: List[Dict[str, Any]]) -> float:
+        """Оценка списка сообщений без калибровки и без записи кэша (для собранных на лету частей промпта)."""
+        return sum(
+            sum(self.raw_estimate(str(p)) for p in m.get("parts", []) if p is not None) + MESSAGE_OVERHEAD_TOKENS
+            for m in messages
+        )
+
+    def tokens(self, raw: float) -> int:
+        """Переводит оценку без калибровки в ожидаемое число токенов."""
+        return int(math.ceil(raw * self.scale))
+
+    def needs_calibration(self) -> bool:
+        return self.samples < CALIBRATION_SAMPLES_REQUIRED
+
+    def calibrate(self, raw: float, actual_tokens: int):
+        """Уточняет множитель по точному числу токенов для промпта с оценкой raw."""
+        if raw <= 0 or actual_tokens <= 0: return
+        observed = min(CALIBRATION_SCALE_MAX, max(CALIBRATION_SCALE_MIN, actual_tokens / raw))
+        if self.samples == 0:
+            self.scale = observed
+        else:
+            self.scale += CALIBRATION_SMOOTHING * (observed - self.scale)
+        self.samples += 1
+        logger.info(f"Калибровка оценки токенов: API {actual_tokens}, оценка {int(raw)} -> множитель {self.scale:.3f} (замеров: {self.samples}).")
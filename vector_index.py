@@ -0,0 +1,328 @@
+# --- Файл: vector_index.py ---
+
+import json
+import time
+import logging
+from typing import Optional, Dict, List, Tuple, Any, Iterable, Set
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Ключ вектора: (file_path, chunk_num) - совпадает с уникальным ключом чанка в context_data
+VectorKey = Tuple[str, int]
+
+# Начальная емкость матрицы; дальше она растет удвоением
+_INITIAL_CAPACITY = 1024
+
+# --- Приближенный поиск (IVF: инвертированные списки по кластерам k-means) ---
+# Меньше этого числа векторов точный поиск достаточно быстр, и IVF не используется
+ANN_MIN_VECTORS = 20000
+# Сколько ближайших кластеров просматривается на запрос: больше - выше полнота, но медленнее
+DEFAULT_ANN_NPROBE = 16
+MAX_ANN_NPROBE = 256
+ANN_KMEANS_ITERATIONS = 10
+# Размер обучающей выборки k-means на один кластер
+ANN_TRAIN_SAMPLES_PER_LIST = 64
+# Во сколько раз должен вырасти индекс с момента обучения, чтобы кластеры были переобучены
+ANN_RETRAIN_GROWTH = 2.0
+# Размер блока строк при назначении векторов кластерам (ограничивает пиковую память)
+_ASSIGN_BLOCK_ROWS = 16384
+
+
+def default_nlist(count: int) -> int:
+    """Число кластеров IVF для индекса из count векторов (~sqrt(count))."""
+    return int(min(4096, max(16, round(np.sqrt(count)))))
+
+
+class VectorIndex:
+    """
+    Индекс для семантического поиска по эмбеддингам чанков.
+    Хранит непрерывную float32-матрицу заранее нормированных векторов, поэтому
+    косинусное сходство сводится к одному матричному умножению, а топ-k
+    выбирается через argpartition без полной сортировки.
+    Пополняется инкрементально по мере поступления результатов анализа.
+
+    Для очень больших наборов можно включить приближенный поиск (configure_ann):
+    векторы группируются в кластеры (IVF), и на запрос просматриваются только
+    nprobe ближайших к нему кластеров. Кластеры обучаются лениво при первом
+    запросе и сохраняются в файле сессии (export_state); сами векторы сохраняются
+    только вместе с чанками и при загрузке сессии добавляются в индекс заново.
+    """
+
+    def __init__(self):
+        self._ann_enabled = False
+        self._ann_nprobe = DEFAULT_ANN_NPROBE
+        self._version = 0
+        self.clear()
+
+    def clear(self):
+        self._version += 1
+        self._dim: Optional[int] = None
+        self._matrix = np.empty((0, 0), dtype=np.float32)
+        self._count = 0
+        self._keys: List[VectorKey] = []
+        self._rows: Dict[VectorKey, int] = {}
+        self._reset_ann()
+
+    def _reset_ann(self):
+        self._centroids: Optional[np.ndarray] = None # nlist x dim, нормированные
+        self._assignments = np.empty(0, dtype=np.int32) # номер кластера для каждой строки
+        self._ann_trained_count = 0
+        self._inverted_lists: Optional[List[np.ndarray]] = None # строит _get_inverted_lists()
+
+    def configure_ann(self, enabled: bool, nprobe: int = DEFAULT_ANN_NPROBE):
+        """Включает/выключает приближенный поиск и задает число просматриваемых кластеров."""
+        self._ann_enabled = bool(enabled)
+        self._ann_nprobe = max(1, min(int(nprobe), MAX_ANN_NPROBE))
+
+    def __len__(self) -> int:
+        return self._count
+
+    def __contains__(self, key: VectorKey) -> bool:
+        return key in self._rows
+
+    @property
+    def dim(self) -> Optional[int]:
+        return self._dim
+
+    def keys(self) -> List[VectorKey]:
+        return self._keys[:]
+
+    def version(self) -> int:
+        """Счетчик изменений состояния, сохраняемого в export_state() (кластеры IVF), а не векторов."""
+        return self._version
+
+    # --- Изменение ---
+    def add(self, keys: List[VectorKey], vectors: Iterable[Any]):
+        """Добавляет (или заменяет) векторы. Нулевые векторы и None пропускаются."""
+        new_keys, new_rows = [], []
+        for key, vector in zip(keys, vectors):
+            if vector is None: continue
+            new_keys.append((key[0], int(key[1])))
+            new_rows.append(np.asarray(vector, dtype=np.float32).ravel())
+        if not new_rows: return
+
+        block = np.vstack(new_rows)
+        if self._dim is None:
+            self._dim = block.shape[1]
+            self._matrix = np.empty((max(_INITIAL_CAPACITY, block.shape[0]), self._dim), dtype=np.float32)
+        elif block.shape[1] != self._dim:
+            raise ValueError(f"Размерность эмбеддингов {block.shape[1]} не совпадает с размерностью индекса {self._dim}")
+
+        norms = np.linalg.norm(block, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        block /= norms
+
+        # Заменяемые ключи удаляем, чтобы не держать дубликаты
+        replaced = {key for key in new_keys if key in self._rows}
+        if replaced:
+            self._remove_keys(replaced)
+
+        self._ensure_capacity(self._count + block.shape[0])
+        self._matrix[self._count:self._count + block.shape[0]] = block
+        if self._centroids is not None:
+            # Новые векторы сразу попадают в ближайший кластер; переобучение - при сильном росте
+            self._assignments[self._count:self._count + block.shape[0]] = self._assign_to_centroids(block)
+            self._inverted_lists = None
+        for offset, key in enumerate(new_keys):
+            self._rows[key] = self._count + offset
+        self._keys.extend(new_keys)
+        self._count += block.shape[0]
+
+    def remove_files(self, file_paths: Iterable[str]):
+        """Удаляет все векторы, относящиеся к указанным файлам."""
+        paths = set(file_paths)
+        self._remove_keys({key for key in self._keys if key[0] in paths})
+
+    def remove_keys(self, keys: Iterable[VectorKey]):
+        """Удаляет векторы с указанными ключами (отсутствующие ключи пропускаются)."""
+        self._remove_keys(set(keys))
+
+    def _remove_keys(self, keys: Set[VectorKey]):
+        # Освободившиеся строки занимают последние строки матрицы: время зависит от числа
+        # удаляемых ключей, а не от размера индекса (порядок keys() при этом меняется)
+        rows = sorted((self._rows[key] for key in keys if key in self._rows), reverse=True)
+        if not rows: return
+        for row in rows:
+            last = self._count - 1
+            del self._rows[self._keys[row]]
+            if row != last:
+                moved_key = self._keys[last]
+                self._matrix[row] = self._matrix[last]
+                if self._centroids is not None:
+                    self._assignments[row] = self._assignments[last]
+                self._keys[row] = moved_key
+                self._rows[moved_key] = row
+            self._keys.pop()
+            self._count = last
+        if self._centroids is not None:
+            self._inverted_lists = None
+
+    def _ensure_capacity(self, required: int):
+        if required <= self._matrix.shape[0]: return
+        capacity = max(required, self._matrix.shape[0] * 2)
+        grown = np.empty((capacity, self._dim), dtype=np.float32)
+        grown[:self._count] = self._matrix[:self._count]
+        self._matrix = grown
+        if self._centroids is not None:
+            grown_assignments = np.empty(capacity, dtype=np.int32)
+            grown_assignments[:self._count] = self._assignments[:self._count]
+            self._assignments = grown_assignments
+
+    def vectors(self) -> np.ndarray:
+        """Нормированные векторы в порядке keys() (представление, без копирования)."""
+        return self._matrix[:self._count]
+
+    def export_vectors(self, keys: Optional[Iterable[VectorKey]] = None) -> Dict[VectorKey, np.ndarray]:
+        """
+        Копии нормированных векторов для записи в файл сессии (одна общая матрица, строки - представления):
+        для ключей keys (отсутствующие пропускаются) или для всех ключей индекса.
+        """
+        if keys is None:
+            rows = list(self._rows.items())
+        else:
+            rows = [(key, self._rows[key]) for key in keys if key in self._rows]
+        if not rows: return {}
+        matrix = self._matrix[[row for _, row in rows]]
+        return {key: matrix[i] for i, (key, _) in enumerate(rows)}
+
+    # --- Поиск ---
+    def search(self, query: Any, top_k: int, exact: bool = False) -> List[Tuple[VectorKey, float]]:
+        """
+        Возвращает до top_k пар (ключ, косинусное сходство) по убыванию сходства.
+        Если включен приближенный поиск и индекс достаточно велик, просматриваются
+        только ближайшие кластеры; exact=True принудительно выполняет полный перебор.
+        """
+        if self._count == 0 or top_k <= 0: return []
+        q = np.asarray(query, dtype=np.float32).ravel()
+        if q.shape[0] != self._dim:
+            raise ValueError(f"Размерность запроса {q.shape[0]} не совпадает с размерностью индекса {self._dim}")
+        q_norm = np.linalg.norm(q)
+        if q_norm == 0: return []
+        q = q / q_norm
+
+        if not exact and self.uses_ann():
+            self._ensure_ann_trained()
+            centroid_scores = self._centroids @ q
+            nprobe = min(self._ann_nprobe, centroid_scores.shape[0])
+            probes = np.argpartition(-centroid_scores, nprobe - 1)[:nprobe]
+            lists = self._get_inverted_lists()
+            candidates = np.concatenate([lists[p] for p in probes])
+            if candidates.shape[0] >= top_k:
+                scores = self._matrix[candidates] @ q
+                return self._top_k(scores, candidates, top_k)
+            # Слишком мало кандидатов в ближайших кластерах - точный поиск надежнее
+
+        scores = self.vectors() @ q
+        return self._top_k(scores, np.arange(self._count), top_k)
+
+    def uses_ann(self) -> bool:
+        """True, если запросы будут обслуживаться приближенным поиском."""
+        return self._ann_enabled and self._count >= ANN_MIN_VECTORS
+
+    # --- Кластеры IVF ---
+    def _ensure_ann_trained(self):
+        if self._centroids is not None and self._count <= self._ann_trained_count * ANN_RETRAIN_GROWTH:
+            return
+        started = time.perf_counter()
+        nlist = default_nlist(self._count)
+        vectors = self.vectors()
+        rng = np.random.default_rng(0)
+        sample_size = min(self._count, nlist * ANN_TRAIN_SAMPLES_PER_LIST)
+        sample = vectors[np.sort(rng.choice(self._count, sample_size, replace=False))]
+
+        # Сферический k-means: векторы нормированы, близость - скалярное произведение
+        centroids = sample[rng.choice(sample_size, nlist, replace=False)].copy()
+        for _ in range(ANN_KMEANS_ITERATIONS):
+            labels = np.argmax(sample @ centroids.T, axis=1)
+            counts = np.bincount(labels, minlength=nlist)
+            order = np.argsort(labels, kind="stable")
+            starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+            sums = np.zeros_like(centroids)
+            nonempty = counts > 0
+            sums[nonempty] = np.add.reduceat(sample[order], starts[nonempty], axis=0)
+            empty = counts == 0
+            if empty.any(): # Пустые кластеры пересевают случайными точками выборки
+                sums[empty] = sample[rng.choice(sample_size, int(empty.sum()), replace=False)]
+            norms = np.linalg.norm(sums, axis=1, keepdims=True)
+            norms[norms == 0] = 1.0
+            centroids = (sums / norms).astype(np.float32)
+
+        self._centroids = centroids
+        self._assignments = np.empty(self._matrix.shape[0], dtype=np.int32)
+        self._assignments[:self._count] = self._assign_to_centroids(vectors)
+        self._ann_trained_count = self._count
+        self._inverted_lists = None
+        self._version += 1
+        logger.info(f"Векторный индекс: обучено {nlist} кластеров IVF на {sample_size} векторах ({self._count} всего) за {time.perf_counter() - started:.2f} с.")
+
+    def _assign_to_centroids(self, vectors: np.ndarray) -> np.ndarray:
+        labels = np.empty(vectors.shape[0], dtype=np.int32)
+        for start in range(0, vectors.shape[0], _ASSIGN_BLOCK_ROWS):
+            block = vectors[start:start + _ASSIGN_BLOCK_ROWS]
+            labels[start:start + block.shape[0]] = np.argmax(block @ self._centroids.T, axis=1)
+        return labels
+
+    def _get_inverted_lists(self) -> List[np.ndarray]:
+        """Номера строк для каждого кластера (перестраиваются после изменений индекса)."""
+        if self._inverted_lists is None:
+            assignments = self._assignments[:self._count]
+            order = np.argsort(assignments, kind="stable")
+            bounds = np.searchsorted(assignments[order], np.arange(self._centroids.shape[0] + 1))
+            self._inverted_lists = [order[bounds[i]:bounds[i + 1]] for i in range(self._centroids.shape[0])]
+        return self._inverted_lists
+
+    def _top_k(self, scores: np.ndarray, rows: np.ndarray, top_k: int) -> List[Tuple[VectorKey, float]]:
+        k = min(top_k, scores.shape[0])
+        if k < scores.shape[0]:
+            candidates = np.argpartition(-scores, k - 1)[:k]
+        else:
+            candidates = np.arange(scores.shape[0])
+        ordered = candidates[np.argsort(-scores[candidates], kind="stable")]
+        return [(self._keys[rows[i]], float(scores[i])) for i in ordered]
+
+    # --- Сохранение в сессию ---
+    def export_state(self) -> Optional[Dict[str, Any]]:
+        """
+        Кластеры IVF для сохранения в .cpai (см. db_manager.save_session_data) или None, если они не обучались.
+        Назначения кластеров - по ключам на момент вызова; векторы в состояние не входят.
+        """
+        if self._count == 0 or self._centroids is None: return None
+        return {
+            "dim": self._dim,
+            "count": self._count,
+            "keys": json.dumps(self._keys, ensure_ascii=False),
+            "ann_nlist": self._centroids.shape[0],
+            "ann_trained_count": self._ann_trained_count,
+            "ann_centroids": self._centroids.tobytes(),
+            "ann_assignments": self._assignments[:self._count].tobytes(),
+        }
+
+    def restore_state(self, state: Dict[str, Any]):
+        """
+        Восстанавливает сохраненные кластеры IVF без повторного k-means (векторы уже добавлены в индекс).
+        Ключи, добавленные после сохранения кластеров, назначаются ближайшему кластеру,
+        а назначения удаленных с тех пор ключей пропускаются.
+        """
+        nlist, dim, count = int(state["ann_nlist"]), int(state["dim"]), int(state["count"])
+        if dim != self._dim:
+            raise ValueError(f"Размерность кластеров {dim} не совпадает с размерностью индекса {self._dim}")
+        keys = [(path, int(num)) for path, num in json.loads(state["keys"])]
+        saved = np.frombuffer(state["ann_assignments"], dtype=np.int32)
+        if len(keys) != count or saved.shape[0] != count:
+            raise ValueError(f"Поврежденные кластеры: ключей {len(keys)}, назначений {saved.shape[0]}, ожидалось {count}")
+        self._centroids = np.frombuffer(state["ann_centroids"], dtype=np.float32).reshape(nlist, dim).copy()
+        saved_labels = dict(zip(keys, saved.tolist()))
+        self._assignments = np.empty(self._matrix.shape[0], dtype=np.int32)
+        missing = []
+        for row, key in enumerate(self._keys):
+            label = saved_labels.get(key)
+            if label is None:
+                missing.append(row)
+            else:
+                self._assignments[row] = label
+        if missing:
+            self._assignments[missing] = self._assign_to_centroids(self._matrix[missing])
+        self._ann_trained_count = int(state.get("ann_trained_count") or count)
+        self._inverted_lists = None
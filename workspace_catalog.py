@@ -0,0 +1,334 @@
+# --- Файл: workspace_catalog.py ---
+
+import os
+import time
+import sqlite3
+import logging
+import threading
+from typing import Optional, Dict, List, Any, Iterable, Set
+
+from keyword_index import FTS_TOKENIZE, query_terms
+
+logger = logging.getLogger(__name__)
+
+# Имя файла каталога в каталоге данных приложения
+WORKSPACE_CATALOG_FILENAME = "workspace_catalog.sqlite"
+# Версия схемы каталога (PRAGMA user_version). Каталог восстанавливается из файлов сессий,
+# поэтому при несовпадении версии он просто создается заново.
+WORKSPACE_CATALOG_VERSION = 1
+# Сколько символов сообщения или саммари попадает в поисковый дайджест
+DIGEST_TEXT_CHARS = 4000
+# Сколько совпадений просматривается на одну найденную сессию (совпадения группируются по сессиям)
+SEARCH_HITS_PER_SESSION = 20
+# Типы элементов контекста, попадающие в дайджест (чанки не попадают - их слишком много)
+DIGEST_CONTEXT_TYPES = ("summary", "structure")
+
+CATALOG_SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS sessions (
+    path TEXT PRIMARY KEY,      -- абсолютный путь файла .cpai
+    title TEXT NOT NULL,        -- имя файла без расширения
+    project_type TEXT,          -- 'github' или 'local'
+    project_source TEXT,        -- URL репозитория или локальная папка
+    repo_branch TEXT,
+    model_name TEXT,
+    message_count INTEGER NOT NULL DEFAULT 0,
+    file_count INTEGER NOT NULL DEFAULT 0,
+    chunk_count INTEGER NOT NULL DEFAULT 0,
+    saved_at REAL,              -- время последней записи (time.time())
+    file_mtime REAL,            -- mtime и размер файла сессии на момент записи в каталог
+    file_size INTEGER
+);
+CREATE INDEX IF NOT EXISTS idx_sessions_saved ON sessions (saved_at);
+
+-- Поисковый дайджест сессии: название и источник проекта, сообщения, саммари и структура файлов
+CREATE TABLE IF NOT EXISTS digest (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL,         -- сессия (sessions.path)
+    kind TEXT NOT NULL,         -- 'session', 'message', 'summary' или 'structure'
+    item TEXT NOT NULL,         -- номер сообщения, путь файла проекта или '' для 'session'
+    source TEXT NOT NULL,       -- роль автора сообщения или путь файла проекта
+    text TEXT NOT NULL,
+    UNIQUE(path, kind, item)
+);
+
+CREATE VIRTUAL TABLE IF NOT EXISTS digest_fts USING fts5(
+    source, text, content='digest', content_rowid='id', tokenize='{FTS_TOKENIZE}'
+);
+CREATE TRIGGER IF NOT EXISTS digest_insert AFTER INSERT ON digest BEGIN
+    INSERT INTO digest_fts (rowid, source, text) VALUES (new.id, new.source, new.text);
+END;
+CREATE TRIGGER IF NOT EXISTS digest_delete AFTER DELETE ON digest BEGIN
+    INSERT INTO digest_fts (digest_fts, rowid, source, text) VALUES ('delete', old.id, old.source, old.text);
+END;
+"""
+
+_SESSION_COLUMNS = ("title", "project_type", "project_source", "repo_branch", "model_name",
+                    "message_count", "file_count", "chunk_count", "saved_at", "file_mtime", "file_size")
+
+
+def _structure_text(structure: Any) -> str:
+    """Имена из структуры файла (импорты, классы, функции) одной строкой."""
+    if not isinstance(structure, dict): return ""
+    names = list(structure.get('imports') or []) + list(structure.get('classes') or {}) + list(structure.get('functions') or [])
+    return " ".join(str(name) for name in names)
+
+
+class WorkspaceCatalog:
+    """
+    Каталог сессий рабочего места: метаданные, счетчики и поисковый дайджест (сообщения,
+    саммари, структура файлов) каждой сохраненной сессии в одной небольшой базе SQLite.
+    Список недавних проектов и полнотекстовый поиск по сотням сессий работают по каталогу,
+    не открывая сами файлы .cpai. Каталог обновляется при каждой записи сессии
+    (см. session_writer.SessionWriter) и при открытии сессии, если он устарел.
+    Потокобезопасен: пишет поток записи сессий, читает поток интерфейса.
+    """
+
+    def __init__(self, filepath: str):
+        self.filepath = filepath
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+        self._open()
+
+    def _open(self):
+        try:
+            dir_name = os.path.dirname(self.filepath)
+            if dir_name:
+                os.makedirs(dir_name, exist_ok=True)
+            self._conn = sqlite3.connect(self.filepath, timeout=10, check_same_thread=False)
+            self._conn.row_factory = sqlite3.Row
+            self._conn.execute("PRAGMA journal_mode=WAL;")
+            self._conn.execute("PRAGMA synchronous=NORMAL;")
+            version = self._conn.execute("PRAGMA user_version;").fetchone()[0]
+            if version != WORKSPACE_CATALOG_VERSION:
+                self._conn.executescript(
+                    "DROP TABLE IF EXISTS digest_fts; DROP TABLE IF EXISTS digest; DROP TABLE IF EXISTS sessions;"
+                )
+                self._conn.executescript(CATALOG_SCHEMA)
+                self._conn.execute(f"PRAGMA user_version = {WORKSPACE_CATALOG_VERSION};")
+                self._conn.commit()
+            logger.info(f"Каталог сессий открыт: {self.filepath}")
+        except (sqlite3.Error, OSError) as e:
+            logger.error(f"Не удалось открыть каталог сессий '{self.filepath}': {e}. Поиск по сессиям отключен.")
+            self._conn = None
+
+    def is_available(self) -> bool:
+        return self._conn is not None
+
+    def close(self):
+        with self._lock:
+            if self._conn:
+                self._conn.close()
+                self._conn = None
+
+    # --- Запись ---
+    def record_session(self, session_path: str, info: Dict[str, Any], messages: List[Dict[str, Any]],
+                       context_items: Iterable[Dict[str, Any]]):
+        """Полностью заменяет запись сессии: метаданные и весь дайджест."""
+        path = os.path.abspath(session_path)
+
+        def write(cursor: sqlite3.Cursor):
+            cursor.execute("DELETE FROM digest WHERE path = ?;", (path,))
+            self._upsert_session(cursor, path, info)
+            self._insert_messages(cursor, path, enumerate(messages))
+            self._insert_context(cursor, path, context_items)
+
+        self._write(write, f"запись сессии {os.path.basename(path)}")
+
+    def record_changes(self, session_path: str, info: Dict[str, Any], messages: List[Dict[str, Any]],
+                       message_indices: List[int], context_items: Iterable[Dict[str, Any]], removed_files: Set[str]):
+        """Обновляет запись сессии по изменениям (как db_manager.save_session_delta)."""
+        path = os.path.abspath(session_path)
+        context_items = [item for item in context_items if item.get('type') in DIGEST_CONTEXT_TYPES]
+
+        def write(cursor: sqlite3.Cursor):
+            self._upsert_session(cursor, path, info)
+            self._delete_messages(cursor, path, message_indices)
+            cursor.execute(
+                "DELETE FROM digest WHERE path = ? AND kind = 'message' AND CAST(item AS INTEGER) >= ?;",
+                (path, len(messages))
+            )
+            self._insert_messages(cursor, path, ((index, messages[index]) for index in message_indices if index < len(messages)))
+            files = set(removed_files) | {item.get('file_path') for item in context_items}
+            cursor.executemany(
+                "DELETE FROM digest WHERE path = ? AND kind IN ('summary', 'structure') AND item = ?;",
+                [(path, file_path) for file_path in files]
+            )
+            self._insert_context(cursor, path, context_items)
+
+        self._write(write, f"изменения сессии {os.path.basename(path)}")
+
+    def record_messages(self, session_path: str, records: List[Dict[str, Any]]):
+        """Добавляет сообщения из записей журнала истории чата (db_manager.append_message_journal)."""
+        path = os.path.abspath(session_path)
+        appended = [record for record in records if record.get("op") == "append"]
+        if not appended: return
+
+        def write(cursor: sqlite3.Cursor):
+            if cursor.execute("SELECT 1 FROM sessions WHERE path = ?;", (path,)).fetchone() is None:
+                return # Сессия попадет в каталог целиком при следующей записи или открытии
+            indices = [record["order_index"] for record in appended]
+            self._delete_messages(cursor, path, indices)
+            self._insert_messages(cursor, path, (
+                (record["order_index"], {"role": record.get("role"), "parts": [record.get("content") or ""]})
+                for record in appended
+            ))
+            cursor.execute(
+                "UPDATE sessions SET message_count = MAX(message_count, ?), saved_at = ? WHERE path = ?;",
+                (max(indices) + 1, time.time(), path)
+            )
+            self._update_file_stat(cursor, path)
+
+        self._write(write, f"сообщения сессии {os.path.basename(path)}")
+
+    def remove_session(self, session_path: str):
+        path = os.path.abspath(session_path)
+
+        def write(cursor: sqlite3.Cursor):
+            cursor.execute("DELETE FROM digest WHERE path = ?;", (path,))
+            cursor.execute("DELETE FROM sessions WHERE path = ?;", (path,))
+
+        self._write(write, f"удаление сессии {os.path.basename(path)}")
+
+    def _write(self, write, description: str):
+        if not self._conn: return
+        with self._lock:
+            try:
+                cursor = self._conn.cursor()
+                cursor.execute("BEGIN TRANSACTION;")
+                write(cursor)
+                self._conn.commit()
+            except sqlite3.Error as e:
+                logger.warning(f"Каталог сессий: ошибка записи ({description}): {e}")
+                self._conn.rollback()
+
+    def _upsert_session(self, cursor: sqlite3.Cursor, path: str, info: Dict[str, Any]):
+        title = os.path.splitext(os.path.basename(path))[0]
+        cursor.execute(
+            """
+            INSERT INTO sessions (path, title, project_type, project_source, repo_branch, model_name,
+                                  message_count, file_count, chunk_count, saved_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(path) DO UPDATE SET
+                title = excluded.title, project_type = excluded.project_type, project_source = excluded.project_source,
+                repo_branch = excluded.repo_branch, model_name = excluded.model_name, message_count = excluded.message_count,
+                file_count = excluded.file_count, chunk_count = excluded.chunk_count, saved_at = excluded.saved_at
+            """,
+            (path, title, info.get("project_type"), info.get("project_source"), info.get("repo_branch"),
+             info.get("model_name"), info.get("message_count", 0), info.get("file_count", 0),
+             info.get("chunk_count", 0), time.time())
+        )
+        self._update_file_stat(cursor, path)
+        # Название и источник проекта тоже ищутся
+        cursor.execute("DELETE FROM digest WHERE path = ? AND kind = 'session';", (path,))
+        cursor.execute(
+            "INSERT INTO digest (path, kind, item, source, text) VALUES (?, 'session', '', ?, ?);",
+            (path, info.get("project_source") or "", title)
+        )
+
+    def _update_file_stat(self, cursor: sqlite3.Cursor, path: str):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return
+        cursor.execute("UPDATE sessions SET file_mtime = ?, file_size = ? WHERE path = ?;", (stat.st_mtime, stat.st_size, path))
+
+    def _delete_messages(self, cursor: sqlite3.Cursor, path: str, indices: Iterable[int]):
+        cursor.executemany(
+            "DELETE FROM digest WHERE path = ? AND kind = 'message' AND item = ?;",
+            [(path, str(index)) for index in indices]
+        )
+
+    def _insert_messages(self, cursor: sqlite3.Cursor, path: str, messages: Iterable):
+        cursor.executemany(
+            "INSERT INTO digest (path, kind, item, source, text) VALUES (?, 'message', ?, ?, ?);",
+            [
+                (path, str(index), message.get("role") or "", (message.get("parts") or [""])[0][:DIGEST_TEXT_CHARS])
+                for index, message in messages
+            ]
+        )
+
+    def _insert_context(self, cursor: sqlite3.Cursor, path: str, context_items: Iterable[Dict[str, Any]]):
+        rows = []
+        for item in context_items:
+            item_type, file_path = item.get('type'), item.get('file_path')
+            if item_type not in DIGEST_CONTEXT_TYPES or not file_path: continue
+            if item_type == 'summary':
+                text = item.get('content') if isinstance(item.get('content'), str) else ""
+            else:
+                text = _structure_text(item.get('content'))
+            rows.append((path, item_type, file_path, file_path, text[:DIGEST_TEXT_CHARS]))
+        cursor.executemany(
+            "INSERT OR IGNORE INTO digest (path, kind, item, source, text) VALUES (?, ?, ?, ?, ?);",
+            rows
+        )
+
+    # --- Чтение ---
+    def needs_update(self, session_path: str, info: Dict[str, Any]) -> bool:
+        """
+        True, если сессии нет в каталоге или ее запись не совпадает с открытой сессией (info - как
+        при записи). Сравниваются счетчики, а не mtime: файл в режиме WAL меняется и без записи сессии.
+        """
+        if not self._conn: return False
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM sessions WHERE path = ?;", (os.path.abspath(session_path),)).fetchone()
+        if row is None: return True
+        return any(row[column] != info.get(column) for column in
+                   ("project_source", "repo_branch", "model_name", "message_count", "file_count", "chunk_count"))
+
+    def get_sessions(self, session_paths: Iterable[str]) -> Dict[str, Dict[str, Any]]:
+        """Записи каталога для указанных путей (путь как передан -> запись); отсутствующих в каталоге нет в ответе."""
+        if not self._conn: return {}
+        by_abspath = {os.path.abspath(path): path for path in session_paths}
+        if not by_abspath: return {}
+        placeholders = ", ".join("?" for _ in by_abspath)
+        with self._lock:
+            rows = self._conn.execute(f"SELECT * FROM sessions WHERE path IN ({placeholders});", list(by_abspath)).fetchall()
+        return {by_abspath[row["path"]]: dict(row) for row in rows}
+
+    def list_sessions(self, limit: int = 100) -> List[Dict[str, Any]]:
+        """Последние сохраненные сессии (новые первыми)."""
+        if not self._conn: return []
+        with self._lock:
+            rows = self._conn.execute("SELECT * FROM sessions ORDER BY saved_at DESC LIMIT ?;", (limit,)).fetchall()
+        return [dict(row) for row in rows]
+
+    def search(self, query: str, limit: int = 50) -> List[Dict[str, Any]]:
+        """
+        Полнотекстовый поиск (BM25) по дайджестам всех сессий. Результат - сессии по убыванию
+        релевантности лучшего совпадения: запись каталога плюс 'match_kind', 'match_source',
+        'snippet' (фрагмент лучшего совпадения) и 'match_count'.
+        """
+        if not self._conn: return []
+        terms = query_terms(query)
+        if not terms: return []
+        started = time.perf_counter()
+        with self._lock:
+            try:
+                hits = self._conn.execute(
+                    """
+                    SELECT d.path, d.kind, d.source, snippet(digest_fts, 1, '[', ']', '…', 12) AS snippet
+                    FROM digest_fts JOIN digest d ON d.id = digest_fts.rowid
+                    WHERE digest_fts MATCH ? ORDER BY rank LIMIT ?
+                    """,
+                    (" OR ".join(terms), limit * SEARCH_HITS_PER_SESSION)
+                ).fetchall()
+            except sqlite3.Error as e:
+                logger.warning(f"Каталог сессий: ошибка поиска: {e}")
+                return []
+            results: Dict[str, Dict[str, Any]] = {}
+            for hit in hits:
+                result = results.get(hit["path"])
+                if result is None:
+                    if len(results) >= limit: continue
+                    results[hit["path"]] = {
+                        "path": hit["path"], "match_kind": hit["kind"], "match_source": hit["source"],
+                        "snippet": hit["snippet"], "match_count": 1,
+                    }
+                else:
+                    result["match_count"] += 1
+            if results:
+                placeholders = ", ".join("?" for _ in results)
+                for row in self._conn.execute(f"SELECT * FROM sessions WHERE path IN ({placeholders});", list(results)).fetchall():
+                    results[row["path"]].update({column: row[column] for column in _SESSION_COLUMNS})
+        logger.info(f"Поиск по каталогу сессий: {len(results)} сессий за {(time.perf_counter() - started) * 1000:.1f} мс.")
+        return [result for result in results.values() if "title" in result]